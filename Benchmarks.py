@@ -0,0 +1,299 @@
+import argparse
+import json
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from os import cpu_count
+from time import perf_counter
+
+from BlockHeader import BlockHeader, encode_header, decode_header
+from KeyUtils import *
+from MerkleTree import MerkleTree
+from Transaction import Tx, encode_tx, decode_tx, FORMAT_JSON, FORMAT_BINARY
+
+MERKLE_SIZES = (16, 256, 4096)
+SLOWDOWN = 0.25  # a benchmark more than this much slower than its baseline is a regression
+
+
+def make_tx_list(n, tx_size=300):
+    """
+    Create a list of distinct transactions of about the size of a json transaction
+    :param n: number of transactions
+    :param tx_size: length of each transaction string
+    :return: a list of transactions in string format
+    """
+    return [str(i).rjust(tx_size, 'x') for i in range(n)]
+
+
+def best_time(func, repeat=3):
+    """
+    Run a function several times
+    :param func: a function without arguments
+    :param repeat: number of runs
+    :return: the shortest run time in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func()
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def benchmark_parallel_build(sizes=(1000, 4000, 16000, 64000, 256000), workers=None):
+    """
+    Compare the serial merkle tree build against thread and process pools, and find the smallest block size where
+    each pool is faster than the serial build.
+    :param sizes: block sizes, in number of transactions
+    :param workers: pool size, the number of cores by default
+    :return: a list of (size, serial time, thread time, process time) tuples
+    """
+    workers = workers or cpu_count() or 1
+    results = []
+    with ThreadPoolExecutor(workers) as threads, ProcessPoolExecutor(workers) as processes:
+        for n in sizes:
+            tx_list = make_tx_list(n)
+            serial = MerkleTree(tx_list)
+
+            # the parallel builds must give the same tree
+            for pool in (threads, processes):
+                if MerkleTree(tx_list, executor=pool).levels != serial.levels:
+                    raise RuntimeError('Parallel build differs from the serial build.')
+
+            results.append((n,
+                            best_time(lambda: MerkleTree(tx_list)),
+                            best_time(lambda: MerkleTree(tx_list, executor=threads)),
+                            best_time(lambda: MerkleTree(tx_list, executor=processes))))
+
+    print('\nmerkle tree build on ' + str(workers) + ' workers (ms)')
+    print('{:>10} {:>10} {:>10} {:>10}'.format('txs', 'serial', 'threads', 'processes'))
+    for n, serial, threaded, multiprocess in results:
+        print('{:>10} {:>10.2f} {:>10.2f} {:>10.2f}'.format(n, serial * 1e3, threaded * 1e3, multiprocess * 1e3))
+
+    for name, column in (('threads', 2), ('processes', 3)):
+        crossover = next((r[0] for r in results if r[column] < r[1]), None)
+        print(name + ' faster from: ' + (str(crossover) + ' txs' if crossover else 'never in this range'))
+    return results
+
+
+def benchmark_codec(n=20000):
+    """
+    Compare the json and binary formats of transactions and block headers
+    :param n: number of objects encoded and decoded per run
+    :return: a dict of format -> (tx encodes per second, tx decodes per second, header encodes per second, header
+    decodes per second, bytes per tx)
+    """
+    # transactions with hex keys and encrypted content, like the ones built in Examples.py
+    txs = [Tx('connect', '%0128x' % i, '%0128x' % (i + 1), '%0256x' % i, 1546300800.0 + i) for i in range(n)]
+    headers = [BlockHeader('%064x' % i, i, '%064x' % (i + 1), 1546300800.0 + i) for i in range(n)]
+
+    results = {}
+    print('\ncodec throughput for ' + str(n) + ' objects (per second)')
+    print('{:>8} {:>12} {:>12} {:>12} {:>12} {:>10}'.format('format', 'tx enc', 'tx dec', 'header enc', 'header dec',
+                                                            'tx bytes'))
+    for fmt in (FORMAT_JSON, FORMAT_BINARY):
+        encoded_txs = [encode_tx(tx, fmt) for tx in txs]
+        encoded_headers = [encode_header(header, fmt) for header in headers]
+        row = (n / best_time(lambda: [encode_tx(tx, fmt) for tx in txs]),
+               n / best_time(lambda: [decode_tx(b, fmt) for b in encoded_txs]),
+               n / best_time(lambda: [encode_header(header, fmt) for header in headers]),
+               n / best_time(lambda: [decode_header(b, fmt) for b in encoded_headers]),
+               sum(len(b) for b in encoded_txs) / n)
+        results[fmt] = row
+        print('{:>8} {:>12.0f} {:>12.0f} {:>12.0f} {:>12.0f} {:>10.1f}'.format(fmt, *row))
+    return results
+
+
+def time_per_op(func, number, repeat=5):
+    """
+    Time a function the way timeit does, the fastest run is the one least disturbed by the rest of the machine
+    :param func: a function without arguments
+    :param number: number of calls per run
+    :param repeat: number of runs
+    :return: seconds per call of the fastest run
+    """
+    def run():
+        for _ in range(number):
+            func()
+    return best_time(run, repeat) / number
+
+
+def suite_merkle(sizes=MERKLE_SIZES, repeat=5):
+    """
+    Merkle tree build, path lookup, proof generation and confirmation, for several block sizes
+    :param sizes: block sizes, in number of transactions
+    :param repeat: number of runs of each benchmark
+    :return: a dict of benchmark name -> (seconds per operation, calls per run)
+    """
+    results = {}
+    for n in sizes:
+        tx_list = make_tx_list(n)
+        tree = MerkleTree(tx_list)
+        root = tree.root.hash
+        tx_hash = MerkleTree.calculate_hash(tx_list[n // 2])
+        path = tree.find_tx_path(tx_hash)
+        hashes = tree.find_hashes_for_confirmation(path)
+        proof = tree.find_compact_proof(tx_hash)
+
+        build_number = max(1, 4096 // n)
+        cases = (('merkle.build', lambda: MerkleTree(tx_list), build_number),
+                 ('merkle.find_tx_path', lambda: tree.find_tx_path(tx_hash), 2000),
+                 ('merkle.find_hashes_for_confirmation', lambda: tree.find_hashes_for_confirmation(path), 2000),
+                 ('merkle.find_compact_proof', lambda: tree.find_compact_proof(tx_hash), 2000),
+                 ('merkle.confirm_tx', lambda: MerkleTree.confirm_tx(tx_hash, path, root, hashes), 2000),
+                 ('merkle.confirm_compact_proof', lambda: MerkleTree.confirm_compact_proof(tx_hash, proof, root), 2000))
+        for name, func, number in cases:
+            results['%s[%d]' % (name, n)] = (time_per_op(func, number, repeat), number)
+    return results
+
+
+def suite_codec(repeat=5):
+    """
+    Encoding and decoding of transactions and block headers, in both formats
+    :param repeat: number of runs of each benchmark
+    :return: a dict of benchmark name -> (seconds per operation, calls per run)
+    """
+    tx = Tx('connect', '0a' * 64, 'b1' * 64, 'c2' * 128, 1546300800.0)
+    header = BlockHeader('ab' * 32, 12345, 'cd' * 32, 1546300800.0)
+
+    results = {}
+    for fmt in (FORMAT_JSON, FORMAT_BINARY):
+        encoded_tx = encode_tx(tx, fmt)
+        encoded_header = encode_header(header, fmt)
+        # a new object for every encode, the cached fields would skip the work otherwise
+        cases = (('codec.tx_encode', lambda: encode_tx(Tx(tx.message, tx.sender, tx.recipient, tx.content,
+                                                             tx.timestamp), fmt)),
+                 ('codec.tx_decode', lambda: decode_tx(encoded_tx, fmt)),
+                 ('codec.header_encode', lambda: encode_header(header, fmt)),
+                 ('codec.header_decode', lambda: decode_header(encoded_header, fmt)))
+        for name, func in cases:
+            results['%s[%s]' % (name, fmt)] = (time_per_op(func, 2000, repeat), 2000)
+    return results
+
+
+def suite_crypto(repeat=5):
+    """
+    ECDSA signing and verification, and rsa encryption and decryption of messages
+    :param repeat: number of runs of each benchmark
+    :return: a dict of benchmark name -> (seconds per operation, calls per run)
+    """
+    private_key_ecc = generate_private_key_ecc()
+    public_key_ecc = generate_public_key_ecc(private_key_ecc)
+    message = b'hello world.'
+    signature = private_key_ecc.sign(message)
+    precomputed = KeyRegistry(precompute_after=1).ecc_key(public_key_ecc.to_string().hex())
+
+    private_key_rsa = generate_private_key_rsa()
+    public_key_rsa = generate_public_key_rsa(private_key_rsa)
+    short = encrypt_message(public_key_rsa, 'hello world.')
+    payload = 'x' * 4096
+    envelope = encrypt_message(public_key_rsa, payload, envelope=True)
+
+    cases = (('ecdsa.sign', lambda: private_key_ecc.sign(message), 20),
+             ('ecdsa.verify', lambda: public_key_ecc.verify(signature, message), 20),
+             ('ecdsa.verify_precomputed', lambda: precomputed.verify(signature, message), 20),
+             ('rsa.encrypt_message', lambda: encrypt_message(public_key_rsa, 'hello world.'), 200),
+             ('rsa.decrypt_message', lambda: decrypt_message(private_key_rsa, short), 50),
+             ('rsa.encrypt_envelope[4096]', lambda: encrypt_message(public_key_rsa, payload, envelope=True), 200),
+             ('rsa.decrypt_envelope[4096]', lambda: decrypt_message(private_key_rsa, envelope), 200))
+    return {name: (time_per_op(func, number, repeat), number) for name, func, number in cases}
+
+
+SUITES = {'merkle': suite_merkle, 'codec': suite_codec, 'crypto': suite_crypto}
+
+
+def run_suites(names=None, repeat=5, only=None):
+    """
+    Run benchmark suites
+    :param names: names of suites in SUITES, all of them by default
+    :param repeat: number of runs of each benchmark
+    :param only: a substring, only the benchmarks with it in their name are kept
+    :return: the results in a json style dict
+    """
+    results = {}
+    for name in names or SUITES:
+        for bench, (seconds, number) in SUITES[name](repeat=repeat).items():
+            if only is None or only in bench:
+                results[bench] = {'seconds': seconds, 'number': number}
+    return {'meta': {'python': platform.python_version(),
+                     'platform': platform.platform(),
+                     'cpu_count': cpu_count(),
+                     'time': time.time(),
+                     'repeat': repeat},
+            'results': results}
+
+
+def compare(results, baseline, threshold=SLOWDOWN):
+    """
+    Compare results against a baseline
+    :param results: results of run_suites()
+    :param baseline: earlier results of run_suites()
+    :param threshold: the slowdown that counts as a regression, 0.25 for 25% slower
+    :return: a list of (name, baseline seconds, seconds, ratio) of the regressions, the worst first
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = result['seconds'] / base['seconds']
+        if ratio > 1 + threshold:
+            regressions.append((name, base['seconds'], result['seconds'], ratio))
+    return sorted(regressions, key=lambda r: -r[3])
+
+
+def print_results(results, baseline=None):
+    """
+    Print results as a table, with the ratio to the baseline if there is one
+    """
+    print('{:<48} {:>14} {:>8}'.format('benchmark', 'us per op', 'ratio'))
+    for name, result in sorted(results['results'].items()):
+        base = None if baseline is None else baseline['results'].get(name)
+        ratio = '' if base is None else '%.2f' % (result['seconds'] / base['seconds'])
+        print('{:<48} {:>14.2f} {:>8}'.format(name, result['seconds'] * 1e6, ratio))
+
+
+def main(argv=None):
+    """
+    Run the benchmarks from the command line
+    :param argv: the arguments, sys.argv by default
+    :return: 1 if a benchmark is slower than its baseline by more than the threshold, else 0
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the hashing, serialization, crypto and proofs.')
+    parser.add_argument('--suite', action='append', choices=sorted(SUITES),
+                        help='a suite to run, can be repeated, all of them by default')
+    parser.add_argument('--only', help='only run the benchmarks with this substring in their name')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each benchmark, the fastest counts')
+    parser.add_argument('--output', help='write the results to this json file, it can be a later baseline')
+    parser.add_argument('--baseline', help='compare against the results in this json file')
+    parser.add_argument('--threshold', type=float, default=SLOWDOWN,
+                        help='slowdown that fails the run, 0.25 for 25%% slower than the baseline')
+    parser.add_argument('--reports', action='store_true',
+                        help='also print the parallel build and codec format reports')
+    args = parser.parse_args(argv)
+
+    results = run_suites(args.suite, args.repeat, args.only)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.reports:
+        benchmark_parallel_build()
+        benchmark_codec()
+
+    if baseline is None:
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for name, base, seconds, ratio in regressions:
+        print('regression: %s %.2f us -> %.2f us (%.2fx)' % (name, base * 1e6, seconds * 1e6, ratio))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
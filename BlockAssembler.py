@@ -0,0 +1,250 @@
+import time
+from time import perf_counter
+
+from BlockHeader import BlockHeader
+from MerkleTree import MerkleTree
+
+BLOCK_BYTES = 1024 * 1024  # budget of the transactions of a block, as the total size in binary format
+EMPTY_MERKLE_ROOT = '00' * 32  # the merkle root of a block without transactions
+
+
+class BlockTemplate:
+    """
+    A block being assembled: its transactions, their merkle tree and the header to mine.
+    """
+
+    def __init__(self, prev_hash, max_bytes):
+        """
+        Initialize an empty template
+        :param prev_hash: hash of the block the template extends
+        :param max_bytes: the budget of the transactions
+        """
+        self.max_bytes = max_bytes
+        self.txs = []
+        self.txids = set()
+        self.bytes = 0
+        self.tree = None
+        self.header = BlockHeader(prev_hash, 0, EMPTY_MERKLE_ROOT, time.time())
+        self.timings = {}  # stage -> seconds spent in it for this template
+
+    def add(self, txs):
+        """
+        add transactions and update the merkle tree, only the new transactions are hashed
+        :param txs: a list of transaction objects that are not in the template and fit in the budget
+        """
+        if not txs:
+            return
+        started = perf_counter()
+        for tx in txs:
+            self.txs.append(tx)
+            self.txids.add(tx.txid)
+            self.bytes += len(tx.to_bytes)
+        if self.tree is None:
+            self.tree = MerkleTree([tx.to_string for tx in self.txs])
+        else:
+            self.tree.extend([tx.to_string for tx in txs])
+        self.__time('merkle', started)
+
+        started = perf_counter()
+        self.header.merkle_root = self.tree.root.hash
+        self.header.timestamp = time.time()
+        self.header.nonce = 0
+        self.__time('header', started)
+
+    def __time(self, stage, started):
+        """
+        a private method that adds the time since started to a stage
+        """
+        self.timings[stage] = self.timings.get(stage, 0.0) + perf_counter() - started
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class BlockAssembler:
+    """
+    Pipeline that turns the mempool into blocks: select the transactions with the highest priority up to the budget,
+    build their merkle tree, fill the header, and once the block is accepted confirm its transactions. A template is
+    kept between calls, the transactions that arrive later are appended to it instead of starting again.
+    """
+
+    def __init__(self, mempool, tx_db, headers, max_bytes=BLOCK_BYTES):
+        """
+        Initialize a block assembler
+        :param mempool: the Mempool to take transactions from
+        :param tx_db: the TxDB where the transactions of accepted blocks are confirmed
+        :param headers: the HeaderChain the blocks extend
+        :param max_bytes: the budget of the transactions of a block
+        """
+        self.mempool = mempool
+        self.tx_db = tx_db
+        self.headers = headers
+        self.max_bytes = max_bytes
+        self.template = None
+        self.sequence = 0  # the sequence counter of the mempool when the template was last updated
+
+        # counters
+        self.rebuilds = 0
+        self.updates = 0
+        self.timings = {}  # stage -> total seconds over all templates
+
+    def update(self):
+        """
+        Bring the template up to date. It is rebuilt if the chain moved or one of its transactions left the mempool,
+        else the transactions that arrived since are appended to it.
+        :return: the template
+        """
+        template = self.template
+        if template is None or template.header.prev_hash != self.headers.tip_hash or \
+                any(txid not in self.mempool for txid in template.txids):
+            return self.build()
+
+        started = perf_counter()
+        txs = self.__select(self.mempool.since(self.sequence), template)
+        self.sequence = self.mempool.sequence
+        self.__time(template, 'select', started)
+
+        self.__add(template, txs)
+        self.updates += 1
+        return template
+
+    def build(self):
+        """
+        Build a template from scratch, from the transactions of the mempool with the highest priority
+        :return: the template
+        """
+        template = BlockTemplate(self.headers.tip_hash, self.max_bytes)
+        self.sequence = self.mempool.sequence
+
+        started = perf_counter()
+        txs = self.__select(self.mempool.best(), template)
+        self.__time(template, 'select', started)
+
+        self.__add(template, txs)
+        self.template = template
+        self.rebuilds += 1
+        return template
+
+    def accept(self, template):
+        """
+        Accept a mined block: append its header to the chain, confirm its transactions and remove them from the
+        mempool. Nothing changes if one of the transactions was already confirmed, except that the transactions
+        already confirmed leave the mempool and the template is dropped, so the next update builds a valid one.
+        :param template: a template whose header has a valid nonce
+        :return: the height of the block
+        """
+        if template.header.prev_hash != self.headers.tip_hash:
+            raise RuntimeError('Block does not extend the chain.')
+
+        started = perf_counter()
+        # the transactions only seen by the mempool enter the database unconfirmed, so they can all move at once
+        added = [tx for tx in template.txs if tx.txid not in self.tx_db]
+        for tx in added:
+            self.tx_db.add_in_uc(tx)
+        try:
+            self.tx_db.confirm_all([tx.txid for tx in template.txs])
+        except ValueError:
+            for tx in added:
+                self.tx_db.del_in_uc(tx)
+            for tx in template.txs:
+                if self.tx_db.is_confirmed(tx.txid):
+                    self.mempool.remove(tx.txid)
+            self.template = None
+            raise
+        height = self.headers.append(template.header)
+        for tx in template.txs:
+            self.mempool.remove(tx.txid)
+        self.__time(template, 'confirm', started)
+
+        # the next template starts from the transactions that arrived meanwhile, they are still in the mempool
+        self.template = None
+        return height
+
+    def __select(self, candidates, template):
+        """
+        a private method that picks, in order, the candidates that are not in the template, not already confirmed and
+        fit in what is left of its budget. A transaction too large is skipped, a smaller one after it can still fit.
+        """
+        budget = template.max_bytes - template.bytes
+        txs = []
+        chosen = set()
+        for tx in candidates:
+            size = len(tx.to_bytes)
+            if size <= budget and tx.txid not in template.txids and tx.txid not in chosen and \
+                    not self.tx_db.is_confirmed(tx.txid):
+                txs.append(tx)
+                chosen.add(tx.txid)
+                budget -= size
+        return txs
+
+    def __add(self, template, txs):
+        """
+        a private method that adds transactions to a template and records the time of its stages
+        """
+        before = dict(template.timings)
+        template.add(txs)
+        for stage, seconds in template.timings.items():
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds - before.get(stage, 0.0)
+
+    def __time(self, template, stage, started):
+        """
+        a private method that adds the time since started to a stage of a template and to the totals
+        """
+        seconds = perf_counter() - started
+        template.timings[stage] = template.timings.get(stage, 0.0) + seconds
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+
+# test cases
+def test():
+    from HeaderChain import HeaderChain
+    from Mempool import Mempool
+    from Miner import Miner
+    from Transaction import Tx, TxDB
+
+    mempool = Mempool()
+    assembler = BlockAssembler(mempool, TxDB(), HeaderChain(), max_bytes=100 * 1024)
+    miner = Miner(difficulty=8, workers=1)
+
+    txs = [Tx('connect', '%0128x' % i, '00' * 64, 'data %d' % i, 1546300800.0 + i) for i in range(1000)]
+    for tx in txs[:500]:
+        mempool.add(tx)
+    template = assembler.build()
+    print(len(template.txs), template.bytes, sorted(template.timings))
+
+    # late transactions are appended to the template, the tree is not built again
+    for tx in txs[500:520]:
+        mempool.add(tx)
+    template = assembler.update()
+    print(len(template.txs), assembler.rebuilds, assembler.updates)
+    print(template.header.merkle_root == MerkleTree([tx.to_string for tx in template.txs]).root.hash)
+
+    miner.mine(template.header)
+    print(assembler.accept(template), len(assembler.tx_db.in_co), len(mempool))
+
+    # the next block starts from what is left
+    template = assembler.update()
+    print(len(template.txs), template.header.prev_hash == assembler.headers.tip_hash)
+
+    # a transaction that is already confirmed does not go in a template again
+    for tx in (txs[0], txs[600]):
+        mempool.add(tx)
+    template = assembler.update()
+    print(txs[0].txid in template.txids, txs[600].txid in template.txids)
+
+    # a block with a transaction confirmed meanwhile is refused and nothing moves, but the transaction leaves the
+    # mempool so the next block is valid
+    assembler.tx_db.add_in_co(txs[600])
+    miner.mine(template.header)
+    try:
+        assembler.accept(template)
+    except ValueError as e:
+        print(e, len(assembler.tx_db.in_uc), len(assembler.headers), txs[600].txid in mempool)
+    template = assembler.update()
+    miner.mine(template.header)
+    print(assembler.accept(template), len(template.txs))
+    print({stage: '%.4f' % seconds for stage, seconds in assembler.timings.items()})
+
+
+if __name__ == '__main__':
+    test()
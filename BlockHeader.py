@@ -1,7 +1,22 @@
+from hashlib import sha256
 from json import dumps, loads
+from struct import Struct
+
+# formats a block header can be sent in, the same names as for transactions
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+
+# binary block header: previous hash, merkle root, timestamp and nonce, always 80 bytes
+HEADER = Struct('>32s32sdQ')
+
+# the previous hash of the first block of a chain
+GENESIS_PREV_HASH = '00' * 32
 
 
 class BlockHeader:
+    # fields of a block header, kept in slots like the fields of a transaction
+    FIELDS = ('prev_hash', 'nonce', 'merkle_root', 'timestamp')
+    __slots__ = FIELDS + ('_hash',)
 
     def __init__(self, prev_hash, nonce, merkle_root, timestamp):
         self.prev_hash = prev_hash
@@ -9,12 +24,48 @@ class BlockHeader:
         self.merkle_root = merkle_root
         self.timestamp = timestamp
 
+    def __setattr__(self, name, value):
+        """
+        Set a field, and forget the cached hash since the header changed
+        """
+        object.__setattr__(self, name, value)
+        if name != '_hash':
+            object.__setattr__(self, '_hash', None)
+
+    @property
+    def hash(self):
+        """
+        :return: the hash of the block, sha256 of the binary header in hex. It is computed on first use and kept until
+        a field changes.
+        """
+        if self._hash is None:
+            self._hash = sha256(self.to_bytes).hexdigest()
+        return self._hash
+
+    @property
+    def to_json(self):
+        """
+        :return: a dict of the fields of the block header
+        """
+        return {field: getattr(self, field) for field in self.FIELDS}
+
     @property
     def to_string(self):
         """
         :return: a string representation of the block header with double quotes surround the key values.
         """
-        return dumps(self.__dict__)
+        return dumps(self.to_json)
+
+    @property
+    def to_bytes(self):
+        """
+        :return: a fixed width binary representation of the block header, with the nonce in the last 8 bytes
+        """
+        prev_hash = bytes.fromhex(self.prev_hash)
+        merkle_root = bytes.fromhex(self.merkle_root)
+        if len(prev_hash) != 32 or len(merkle_root) != 32:
+            raise ValueError('Block header hashes must be 32 bytes.')
+        return HEADER.pack(prev_hash, merkle_root, self.timestamp, self.nonce)
 
 
 def header_from_string(s):
@@ -26,6 +77,45 @@ def header_from_string(s):
     return header_from_json(loads(s))
 
 
+def header_from_bytes(b, offset=0):
+    """
+    Create a block header from its binary representation
+    :param b: bytes or a memoryview holding one or more binary block headers
+    :param offset: position of the header in b
+    :return: a block header object
+    """
+    prev_hash, merkle_root, timestamp, nonce = HEADER.unpack_from(b, offset)
+    return BlockHeader(prev_hash.hex(), nonce, merkle_root.hex(), timestamp)
+
+
+def encode_header(header, fmt=FORMAT_JSON):
+    """
+    Encode a block header in the format agreed with the other node
+    :param header: a block header object
+    :param fmt: FORMAT_JSON or FORMAT_BINARY
+    :return: the block header in bytes
+    """
+    if fmt == FORMAT_BINARY:
+        return header.to_bytes
+    if fmt == FORMAT_JSON:
+        return header.to_string.encode('utf-8')
+    raise ValueError('Unknown block header format ' + str(fmt) + '.')
+
+
+def decode_header(b, fmt=FORMAT_JSON):
+    """
+    Decode a block header encoded by encode_header()
+    :param b: the block header in bytes
+    :param fmt: FORMAT_JSON or FORMAT_BINARY
+    :return: a block header object
+    """
+    if fmt == FORMAT_BINARY:
+        return header_from_bytes(b)
+    if fmt == FORMAT_JSON:
+        return header_from_string(bytes(b).decode('utf-8'))
+    raise ValueError('Unknown block header format ' + str(fmt) + '.')
+
+
 def header_from_json(j):
     """
     Create a block header from a json object
@@ -33,3 +123,28 @@ def header_from_json(j):
     :return: a block header object
     """
     return BlockHeader(j["prev_hash"], j["nonce"], j["merkle_root"], j["timestamp"])
+
+
+# test cases
+def test():
+    h1 = BlockHeader(GENESIS_PREV_HASH, 12345, 'ab' * 32, 1546300800.25)
+
+    print(h1.to_string)
+
+    h2 = header_from_string(h1.to_string)
+
+    print(h2.to_string)
+
+    # test the binary format
+    for fmt in (FORMAT_JSON, FORMAT_BINARY):
+        b = encode_header(h1, fmt)
+        print(fmt, len(b), decode_header(b, fmt).to_string == h1.to_string)
+
+    # the hash follows the fields
+    print(h1.hash)
+    h2.nonce += 1
+    print(h2.hash != h1.hash)
+
+
+if __name__ == "__main__":
+    test()
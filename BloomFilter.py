@@ -0,0 +1,168 @@
+import time
+from hashlib import blake2b
+from math import ceil, log
+
+
+def filter_geometry(capacity, fp_rate):
+    """
+    Size a Bloom filter
+    :param capacity: number of items the filter is made for
+    :param fp_rate: the false positive rate once it holds capacity items
+    :return: the number of bits, a multiple of 8 so the filter is whole bytes, and the number of hashes
+    """
+    bits = max(8, 8 * ceil(-capacity * log(fp_rate) / log(2) ** 2 / 8))
+    hashes = max(1, round(bits / capacity * log(2)))
+    return bits, hashes
+
+
+def item_positions(item, bits, hashes):
+    """
+    Find the bits of an item, by double hashing one blake2b digest
+    :param item: bytes, or a string
+    :param bits: number of bits of the filter
+    :param hashes: number of bits set for an item
+    :return: a list of bit positions
+    """
+    if isinstance(item, str):
+        item = item.encode('utf-8')
+    digest = blake2b(item, digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+
+class BloomFilter:
+    """
+    Set of items that can answer a false yes but never a false no, in a fixed number of bits.
+    """
+
+    def __init__(self, capacity=10000, fp_rate=0.001, bits=None, hashes=None):
+        """
+        Initialize an empty filter
+        :param capacity: number of items the filter is made for
+        :param fp_rate: the false positive rate once it holds capacity items
+        :param bits: number of bits, a multiple of 8, to build a filter with the geometry of another one
+        :param hashes: number of hashes, to build a filter with the geometry of another one
+        """
+        if bits is None:
+            bits, hashes = filter_geometry(capacity, fp_rate)
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray((bits + 7) // 8)
+        self.count = 0
+
+    def add(self, item):
+        """
+        add an item
+        :param item: bytes, or a string
+        :return: the positions of its bits
+        """
+        positions = item_positions(item, self.bits, self.hashes)
+        for p in positions:
+            self.data[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+        return positions
+
+    def clear(self):
+        """
+        remove every item
+        """
+        self.data = bytearray(len(self.data))
+        self.count = 0
+
+    def to_bytes(self):
+        """
+        :return: the bits of the filter
+        """
+        return bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, data, hashes):
+        """
+        Build a filter from its bits, like a filter sent by a peer
+        :param data: the bits
+        :param hashes: number of hashes
+        :return: a filter object
+        """
+        bloom = cls(bits=8 * len(data), hashes=hashes)
+        bloom.data[:] = data
+        return bloom
+
+    def __contains__(self, item):
+        return all(self.data[p >> 3] & (1 << (p & 7)) for p in item_positions(item, self.bits, self.hashes))
+
+    def __len__(self):
+        return self.count
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class RotatingBloomFilter:
+    """
+    Bloom filter of the recent items. A new generation starts when the current one is full or old, and the oldest one
+    is dropped, so the memory stays bounded and old items are forgotten.
+    """
+
+    def __init__(self, capacity=100000, fp_rate=1e-6, max_age=600, generations=2, clock=time.time):
+        """
+        Initialize a rotating filter
+        :param capacity: number of items of a generation
+        :param fp_rate: the false positive rate of a full generation
+        :param max_age: seconds after which a generation is replaced, None to only replace full ones
+        :param generations: number of generations looked into
+        :param clock: a function that gives the current time
+        """
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.max_age = max_age
+        self.clock = clock
+        self.filters = [BloomFilter(capacity, fp_rate) for _ in range(generations)]  # the newest first
+        self.started = clock()
+        self.rotations = 0
+
+    def add(self, item):
+        """
+        add an item to the newest generation
+        :param item: bytes, or a string
+        """
+        now = self.clock()
+        current = self.filters[0]
+        if current.count >= self.capacity or (self.max_age is not None and now - self.started >= self.max_age):
+            oldest = self.filters.pop()
+            oldest.clear()
+            self.filters.insert(0, oldest)
+            self.started = now
+            self.rotations += 1
+        self.filters[0].add(item)
+
+    def __contains__(self, item):
+        return any(item in bloom for bloom in self.filters)
+
+    def __len__(self):
+        return sum(bloom.count for bloom in self.filters)
+
+
+# test cases
+def test():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add('item %d' % i)
+    false_positives = sum('other %d' % i in bloom for i in range(10000))
+    print(bloom.bits, bloom.hashes, all('item %d' % i in bloom for i in range(10000)), false_positives / 10000)
+    print('item 5' in BloomFilter.from_bytes(bloom.to_bytes(), bloom.hashes))
+
+    now = [0.0]
+    seen = RotatingBloomFilter(capacity=100, max_age=60, clock=lambda: now[0])
+    for i in range(250):
+        seen.add(b'%d' % i)
+    print(b'0' in seen, b'150' in seen, b'249' in seen, seen.rotations)
+    now[0] += 60
+    seen.add(b'new')
+    now[0] += 60
+    seen.add(b'newer')
+    print(b'249' in seen, b'new' in seen, seen.rotations)
+
+
+if __name__ == '__main__':
+    test()
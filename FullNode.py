@@ -1,17 +1,38 @@
+import asyncio
+import os
 from KeyUtils import *
-from Transaction import TxDB
+from KeyStore import NodeKeys
+from BlockAssembler import BlockAssembler
+from BloomFilter import BloomFilter
+from Gossip import Gossip
+from HeaderChain import HeaderChain
+from Mempool import Mempool
+from Network import Network, ROLE_FULL, ROLE_LIGHT, CMD_HEADERS, CMD_TX, HEADERS_REQUEST
+from Subscriptions import Subscriptions, CMD_FILTERLOAD, CMD_FILTERADD, CMD_FILTERCLEAR, CMD_MATCH_TX, CMD_MERKLE_TX, \
+    CMD_BLOCK
+from Transaction import TxDB, tx_from_bytes
+from TxStore import TxStore
+from TxValidator import TxValidator
 
 
 class FullNode:
 
-    def __init__(self):
-        # generate keys for ecc
-        self.private_key_ecc = generate_private_key_ecc()
-        self.public_key_ecc = generate_public_key_ecc(self.private_key_ecc)
-
-        # generate keys for rsa
-        self.private_key_rsa = generate_private_key_rsa()
-        self.public_key_rsa = generate_public_key_rsa(self.private_key_rsa)
+    def __init__(self, data_dir=None, mempool_bytes=64 * 1024 * 1024, keystore=None, key_pool=None):
+        """
+        Initialize a node
+        :param data_dir: a directory to keep the transaction database and the block headers on disk, None to keep them
+        in memory
+        :param mempool_bytes: the budget of the pool of unconfirmed transactions
+        :param keystore: a KeyStore to load the keys from, or to save new keys to
+        :param key_pool: a KeyPool to take new keys from, when there is no keystore
+        """
+        # ecc and rsa keys, loaded or generated on first use
+        if keystore is not None:
+            self.keys = keystore.load_or_create()
+        elif key_pool is not None:
+            self.keys = key_pool.take()
+        else:
+            self.keys = NodeKeys()
 
         # connected full nodes
         self.heavy_peers_limit = 10
@@ -22,4 +43,184 @@ class FullNode:
         self.light_peers = []
 
         # transaction database
-        self.tx_db = TxDB()
+        self.tx_db = TxDB(None if data_dir is None else TxStore(data_dir))
+
+        # block headers
+        self.headers = HeaderChain(None if data_dir is None else os.path.join(data_dir, 'headers.dat'))
+
+        # unconfirmed transactions waiting for a block
+        self.mempool = Mempool(mempool_bytes)
+
+        # signature verification, a transaction verified for the mempool is not verified again for its block
+        self.tx_validator = TxValidator()
+
+        # peer networking and transaction relay, made by create_network()
+        self.network = None
+        self.gossip = None
+
+        # bloom filters of the light weight nodes, they only get the transactions that match
+        self.subscriptions = Subscriptions()
+
+        # the next block, kept up to date as transactions arrive
+        self.assembler = BlockAssembler(self.mempool, self.tx_db, self.headers)
+
+    @property
+    def private_key_ecc(self):
+        """
+        :return: the private ecc key
+        """
+        return self.keys.private_key_ecc
+
+    @property
+    def public_key_ecc(self):
+        """
+        :return: the public ecc key
+        """
+        return self.keys.public_key_ecc
+
+    @property
+    def private_key_rsa(self):
+        """
+        :return: the private rsa key
+        """
+        return self.keys.private_key_rsa
+
+    @property
+    def public_key_rsa(self):
+        """
+        :return: the public rsa key
+        """
+        return self.keys.public_key_rsa
+
+    def create_network(self):
+        """
+        Create the network of the node, the connections to its peers are kept in heavy_peers and light_peers
+        :return: a Network, call its start() to accept connections
+        """
+        self.network = Network(ROLE_FULL, self.heavy_peers_limit, self.light_peers_limit,
+                               self.heavy_peers, self.light_peers)
+        self.network.handlers[CMD_HEADERS] = self.__serve_headers
+        self.network.handlers[CMD_TX] = self.__receive_tx
+        self.gossip = Gossip(self.network, self.mempool, self.tx_validator, self.tx_db)
+        self.gossip.listeners.append(self.__forward_tx)
+        self.network.handlers[CMD_FILTERLOAD] = self.__filter_load
+        self.network.handlers[CMD_FILTERADD] = self.__filter_add
+        self.network.handlers[CMD_FILTERCLEAR] = self.__filter_clear
+        self.network.close_handlers.append(self.subscriptions.remove)
+        return self.network
+
+    def mine_block(self, miner):
+        """
+        Mine the current block template and accept it
+        :param miner: a Miner
+        :return: the height of the block, None if no nonce was found
+        """
+        template = self.assembler.update()
+        if miner.mine(template.header) is None:
+            return None
+        return self.accept_block(template)
+
+    def accept_block(self, template):
+        """
+        Accept a mined block: its transactions are confirmed, its header is announced to the light weight nodes, and the
+        transactions they subscribed to are sent to them
+        :param template: a block template with a valid nonce
+        :return: the height of the block
+        """
+        height = self.assembler.accept(template)
+        self.publish_block(template.header, template.tree, template.txs)
+        return height
+
+    def publish_block(self, header, tree, txs):
+        """
+        Announce the header of a new block to the light weight nodes, then send them the transactions of the block
+        their filter matches, each with the proof that it is in the block
+        :param header: the block header object
+        :param tree: the merkle tree of the block, None for a block without transactions
+        :param txs: the transactions of the block
+        :return: the number of transactions sent
+        """
+        if self.network is None:
+            return 0
+        # the header goes first, so the proofs can be checked when they arrive
+        for connection in list(self.light_peers):
+            asyncio.ensure_future(self.__notify(connection, CMD_BLOCK, header.to_bytes))
+        if not len(self.subscriptions):
+            return 0
+        block_hash = bytes.fromhex(header.hash)
+        sent = 0
+        for tx in txs:
+            subscribers = self.subscriptions.match_tx(tx)
+            if not subscribers:
+                continue
+            payload = block_hash + tx.to_bytes + tree.find_compact_proof(tx.txid)
+            for connection in subscribers:
+                asyncio.ensure_future(self.__notify(connection, CMD_MERKLE_TX, payload))
+            sent += len(subscribers)
+        return sent
+
+    def __forward_tx(self, tx, source):
+        """
+        a private method that sends a new unconfirmed transaction to the light weight nodes whose filter matches it
+        """
+        for connection in self.subscriptions.match_tx(tx):
+            if connection is not source:
+                asyncio.ensure_future(self.__notify(connection, CMD_MATCH_TX, tx.to_bytes))
+
+    @staticmethod
+    async def __notify(connection, command, payload):
+        """
+        a private method that sends a message to a light weight node, a node that went away is skipped
+        """
+        try:
+            await connection.notify(command, payload)
+        except ConnectionError:
+            pass
+
+    async def __filter_load(self, connection, payload):
+        """
+        a private method that sets the bloom filter of a light weight node
+        :param payload: the number of hashes in 1 byte, then the bits of the filter
+        """
+        if connection.role != ROLE_LIGHT:
+            raise RuntimeError('Only light weight nodes subscribe.')
+        self.subscriptions.load(connection, BloomFilter.from_bytes(payload[1:], payload[0]))
+
+    async def __filter_add(self, connection, payload):
+        """
+        a private method that adds an item to the bloom filter of a light weight node
+        """
+        self.subscriptions.add(connection, payload)
+
+    async def __filter_clear(self, connection, payload):
+        """
+        a private method that removes the bloom filter of a light weight node
+        """
+        self.subscriptions.remove(connection)
+
+    async def __serve_headers(self, connection, payload):
+        """
+        a private method that sends binary headers to a peer
+        :param payload: HEADERS_REQUEST, the first height and the maximum number of headers
+        :return: the headers in bytes
+        """
+        start, count = HEADERS_REQUEST.unpack(payload)
+        stop = min(len(self.headers), start + min(count, 2000))
+        return b''.join(bytes(self.headers.header_bytes(height)) for height in range(start, stop))
+
+    async def __receive_tx(self, connection, payload):
+        """
+        a private method that adds a transaction from a peer to the mempool and relays it, a signed transaction must be
+        valid
+        :param payload: a binary transaction
+        :return: 1 if it was added, else 0
+        """
+        tx = tx_from_bytes(payload)[0]
+        if self.tx_db.is_confirmed(tx.txid):
+            return b'\x00'
+        if tx.signature is not None and not self.tx_validator.verify(tx):
+            raise RuntimeError('Invalid signature.')
+        if not self.mempool.add(tx):
+            return b'\x00'
+        self.gossip.announce(tx, connection)
+        return b'\x01'
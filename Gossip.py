@@ -0,0 +1,219 @@
+import asyncio
+import time
+from collections import deque
+
+from BloomFilter import RotatingBloomFilter
+from Transaction import tx_from_bytes
+
+# commands
+CMD_INV = 'inv'  # notify, payload: txids of 32 bytes
+CMD_GETDATA = 'getdata'  # request, payload: txids of 32 bytes, response: the binary transactions the peer has
+
+TXID_SIZE = 32
+MAX_INV = 1000  # txids in an announcement
+
+
+class Gossip:
+    """
+    Relay of transactions between full nodes. A node announces the ids of new transactions, and a peer fetches only the
+    ones it does not know yet, so a transaction crosses a link once instead of once per path. The ids seen recently are
+    kept in a rotating Bloom filter, so a transaction that left the mempool is not fetched and relayed again.
+    """
+
+    def __init__(self, network, mempool, validator=None, tx_db=None, inv_interval=0.05, request_timeout=10,
+                 clock=time.time):
+        """
+        Initialize a gossip relay, and register its commands on the network
+        :param network: the Network of the node, transactions are relayed to its full node peers
+        :param mempool: the Mempool transactions are added to
+        :param validator: a TxValidator for the signed transactions, None to skip signature verification
+        :param tx_db: the TxDB of the node, its confirmed transactions are not fetched again, None to fetch them
+        :param inv_interval: seconds during which announcements are collected before they are sent together
+        :param request_timeout: seconds after which a transaction asked to a peer can be asked to another one
+        :param clock: a function that gives the current time
+        """
+        self.network = network
+        self.mempool = mempool
+        self.validator = validator
+        self.tx_db = tx_db
+        self.inv_interval = inv_interval
+        self.request_timeout = request_timeout
+        self.clock = clock
+
+        self.seen = RotatingBloomFilter()
+        self.requested = {}  # txid -> time it was asked to a peer, the answer is still expected
+        self.outbox = {}  # connection -> txids to announce to it
+        self.flushing = False
+        self.listeners = []  # functions called with every new transaction and the connection it came from
+
+        # counters
+        self.bytes_received = 0  # inv and transactions
+        self.redundant_bytes = 0  # inv entries and transactions that were already known
+        self.relayed = 0
+        self.latencies = deque(maxlen=10000)  # seconds from the creation of a transaction to its arrival
+
+        network.handlers[CMD_INV] = self.__receive_inv
+        network.handlers[CMD_GETDATA] = self.__serve_getdata
+
+    @property
+    def redundancy(self):
+        """
+        :return: the share of the received bytes that carried nothing new
+        """
+        return self.redundant_bytes / self.bytes_received if self.bytes_received else 0.0
+
+    @property
+    def stats(self):
+        """
+        :return: a dict of the counters, with the median and 95th percentile propagation latency
+        """
+        latencies = sorted(self.latencies)
+        return {'bytes_received': self.bytes_received,
+                'redundant_bytes': self.redundant_bytes,
+                'redundancy': self.redundancy,
+                'relayed': self.relayed,
+                'latency_p50': latencies[len(latencies) // 2] if latencies else None,
+                'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else None}
+
+    def announce(self, tx, source=None):
+        """
+        announce a transaction to the full node peers, like a new transaction from a light weight node
+        :param tx: a transaction object
+        :param source: the connection it came from, it is not announced back
+        """
+        txid = bytes.fromhex(tx.txid)
+        self.seen.add(txid)
+        for peer in self.network.heavy_peers:
+            if peer is not source:
+                self.outbox.setdefault(peer, []).append(txid)
+        self.relayed += 1
+        for listener in self.listeners:
+            listener(tx, source)
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_running_loop().call_later(self.inv_interval, self.__flush)
+
+    def __flush(self):
+        """
+        a private method that sends the collected announcements, one message per peer
+        """
+        self.flushing = False
+        outbox, self.outbox = self.outbox, {}
+        for peer, txids in outbox.items():
+            if peer.closed:
+                continue
+            for i in range(0, len(txids), MAX_INV):
+                asyncio.ensure_future(self.__send(peer, CMD_INV, b''.join(txids[i:i + MAX_INV])))
+
+    @staticmethod
+    async def __send(peer, command, payload):
+        """
+        a private method that sends a message, a peer that went away is skipped
+        """
+        try:
+            await peer.notify(command, payload)
+        except ConnectionError:
+            pass
+
+    def __known(self, txid):
+        """
+        a private method that checks if a transaction does not need to be fetched
+        """
+        if txid in self.seen:
+            return True
+        txid = txid.hex()
+        return txid in self.mempool or (self.tx_db is not None and self.tx_db.is_confirmed(txid))
+
+    async def __receive_inv(self, connection, payload):
+        """
+        a private method that fetches the announced transactions that are new
+        """
+        self.bytes_received += len(payload)
+        now = self.clock()
+        wanted = []
+        for i in range(0, len(payload) - len(payload) % TXID_SIZE, TXID_SIZE):
+            txid = payload[i:i + TXID_SIZE]
+            asked = self.requested.get(txid)
+            if self.__known(txid) or (asked is not None and now - asked < self.request_timeout):
+                self.redundant_bytes += TXID_SIZE
+                continue
+            self.requested[txid] = now
+            wanted.append(txid)
+        if not wanted:
+            return
+
+        try:
+            data = await connection.request(CMD_GETDATA, b''.join(wanted), self.request_timeout)
+        except (ConnectionError, RuntimeError, asyncio.TimeoutError):
+            data = b''
+        finally:
+            for txid in wanted:
+                self.requested.pop(txid, None)
+        self.__receive_txs(connection, data)
+
+    def __receive_txs(self, connection, data):
+        """
+        a private method that adds fetched transactions to the mempool and relays the new ones
+        """
+        self.bytes_received += len(data)
+        now = self.clock()
+        offset = 0
+        while offset < len(data):
+            start = offset
+            tx, offset = tx_from_bytes(data, offset)
+            txid = bytes.fromhex(tx.txid)
+            if self.__known(txid):
+                self.redundant_bytes += offset - start
+                continue
+            self.seen.add(txid)
+            if tx.signature is not None and self.validator is not None and not self.validator.verify(tx):
+                continue
+            if self.mempool.add(tx):
+                self.latencies.append(now - tx.timestamp)
+                self.announce(tx, connection)
+
+    async def __serve_getdata(self, connection, payload):
+        """
+        a private method that sends the asked transactions that are still in the mempool
+        """
+        txs = (self.mempool.get(payload[i:i + TXID_SIZE].hex()) for i in range(0, len(payload), TXID_SIZE))
+        return b''.join(tx.to_bytes for tx in txs if tx is not None)
+
+
+# test cases
+def test():
+    from FullNode import FullNode
+    from Transaction import Tx
+
+    async def run():
+        # a ring of full nodes, each also linked to the node across the ring
+        nodes = [FullNode() for _ in range(6)]
+        addresses = []
+        for node in nodes:
+            node.create_network()
+            addresses.append(await node.network.start())
+        for i, node in enumerate(nodes):
+            await node.network.connect(*addresses[(i + 1) % len(nodes)])
+            if i < len(nodes) // 2:
+                await node.network.connect(*addresses[i + len(nodes) // 2])
+
+        txs = [Tx('connect', '%0128x' % i, '00' * 64, 'data') for i in range(300)]
+        for tx in txs:
+            nodes[0].mempool.add(tx)
+            nodes[0].gossip.announce(tx)
+
+        while not all(len(node.mempool) == len(txs) for node in nodes):
+            await asyncio.sleep(0.01)
+        print([len(node.mempool) for node in nodes])
+        stats = [node.gossip.stats for node in nodes[1:]]
+        print('redundancy %.3f' % (sum(s['redundant_bytes'] for s in stats) / sum(s['bytes_received'] for s in stats)))
+        print('latency p95 %.3f seconds' % max(s['latency_p95'] for s in stats))
+
+        for node in nodes:
+            await node.network.close()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    test()
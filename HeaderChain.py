@@ -0,0 +1,211 @@
+import os
+from mmap import mmap, ACCESS_READ
+
+from BlockHeader import HEADER, GENESIS_PREV_HASH, header_from_bytes
+
+# a record of the chain file: the 80 bytes binary header followed by its 32 bytes hash, so opening a chain never
+# hashes the headers again
+RECORD_SIZE = HEADER.size + 32
+
+
+class HeaderChain:
+    """
+    Chain of block headers, indexed by height and by hash. The headers are kept in a file of fixed width records that
+    is memory mapped, the header at a height is read straight from its offset.
+    """
+
+    def __init__(self, path=None):
+        """
+        Open a chain file, create it if it does not exist
+        :param path: path of the chain file, None to keep the chain in memory
+        """
+        self.path = path
+        self.by_hash = None  # hash -> height, built on the first lookup by hash
+        if path is None:
+            self.file = None
+            self.data = bytearray()
+            self.length = 0
+            return
+
+        # a record cut short by a crash is dropped
+        self.file = open(path, 'a+b')
+        size = os.path.getsize(path)
+        if size % RECORD_SIZE:
+            self.file.truncate(size - size % RECORD_SIZE)
+        self.length = size // RECORD_SIZE
+        self.data = None
+        self.__map()
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def height(self):
+        """
+        :return: the height of the last header, -1 for an empty chain
+        """
+        return self.length - 1
+
+    @property
+    def tip(self):
+        """
+        :return: the last header, None for an empty chain
+        """
+        return self.get(self.height) if self.length else None
+
+    @property
+    def tip_hash(self):
+        """
+        :return: the hash of the last header, the previous hash of a genesis block for an empty chain
+        """
+        return self.hash_at(self.height) if self.length else GENESIS_PREV_HASH
+
+    def append(self, header):
+        """
+        add a header to the end of the chain
+        :param header: a block header object, its previous hash must be the hash of the last header
+        :return: the height of the header
+        """
+        if header.prev_hash != self.tip_hash:
+            raise RuntimeError('Block header does not extend the chain.')
+
+        record = header.to_bytes + bytes.fromhex(header.hash)
+        if self.file is None:
+            self.data += record
+        else:
+            self.file.write(record)
+            self.file.flush()
+        if self.by_hash is not None:
+            self.by_hash[header.hash] = self.length
+        self.length += 1
+        return self.height
+
+    def get(self, height):
+        """
+        :param height: height of a header, negative heights count from the tip
+        :return: the block header object, with its hash already set
+        """
+        view = self.header_bytes(height)
+        header = header_from_bytes(view)
+        header._hash = self.hash_at(height)
+        return header
+
+    def header_bytes(self, height):
+        """
+        :param height: height of a header, negative heights count from the tip
+        :return: the 80 bytes binary header, a memoryview of the mapped file that stays valid after appends, or bytes
+        for a chain in memory since its buffer is resized by appends
+        """
+        offset = self.__offset(height)
+        if self.file is None:
+            return bytes(self.data[offset:offset + HEADER.size])
+        return memoryview(self.__view(offset + RECORD_SIZE))[offset:offset + HEADER.size]
+
+    def hash_at(self, height):
+        """
+        :param height: height of a header, negative heights count from the tip
+        :return: the hash of the header in hex
+        """
+        offset = self.__offset(height) + HEADER.size
+        return self.__view(offset + 32)[offset:offset + 32].hex()
+
+    def height_of(self, block_hash):
+        """
+        :param block_hash: hash of a block in hex
+        :return: the height of its header, None if it is not in the chain
+        """
+        if self.by_hash is None:
+            self.by_hash = {self.hash_at(height): height for height in range(self.length)}
+        return self.by_hash.get(block_hash)
+
+    def get_by_hash(self, block_hash):
+        """
+        :param block_hash: hash of a block in hex
+        :return: the block header object, None if it is not in the chain
+        """
+        height = self.height_of(block_hash)
+        return None if height is None else self.get(height)
+
+    def ancestor(self, block_hash, height):
+        """
+        find the ancestor of a block at a given height
+        :param block_hash: hash of a block in hex
+        :param height: height of the ancestor, no more than the height of the block
+        :return: the block header object of the ancestor, None if the block is not in the chain
+        """
+        block_height = self.height_of(block_hash)
+        if block_height is None or not 0 <= height <= block_height:
+            return None
+        return self.get(height)
+
+    def sync(self):
+        """
+        write the chain file to disk
+        """
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+
+    def __offset(self, height):
+        """
+        a private method that gives the offset of the record at a height
+        """
+        if height < 0:
+            height += self.length
+        if not 0 <= height < self.length:
+            raise IndexError('No block header at height ' + str(height) + '.')
+        return height * RECORD_SIZE
+
+    def __view(self, end):
+        """
+        a private method that gives the buffer holding the records, mapped again if the file grew past the old map
+        """
+        if self.file is None:
+            return self.data
+        if len(self.data) < end:
+            self.__map()
+        return self.data
+
+    def __map(self):
+        """
+        a private method that memory maps the chain file, an old map is not closed so memoryviews of it stay valid
+        """
+        if self.length:
+            self.data = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        else:
+            self.data = b''
+
+
+# test cases
+def test():
+    from tempfile import mkdtemp
+    from BlockHeader import BlockHeader
+
+    path = os.path.join(mkdtemp(), 'headers.dat')
+    chain = HeaderChain(path)
+    for i in range(1000):
+        chain.append(BlockHeader(chain.tip_hash, i, '%064x' % i, 1546300800.0 + i))
+    chain.close()
+
+    # reopen, the headers are mapped and not read
+    chain = HeaderChain(path)
+    print(len(chain), chain.tip.nonce, chain.height_of(chain.tip.hash))
+    print(chain.ancestor(chain.tip_hash, 10).merkle_root == '%064x' % 10)
+    print(chain.get_by_hash(chain.hash_at(500)).prev_hash == chain.hash_at(499))
+    chain.close()
+
+    # a header held by the caller does not stop the chain in memory from growing
+    chain = HeaderChain()
+    chain.append(BlockHeader(chain.tip_hash, 0, '00' * 32, 1546300800.0))
+    first = chain.header_bytes(0)
+    chain.append(BlockHeader(chain.tip_hash, 1, '01' * 32, 1546300801.0))
+    print(len(chain), first == chain.header_bytes(0))
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,211 @@
+import time
+from collections import deque
+from queue import Queue, Full
+from threading import Thread, Event
+
+from BlockHeader import BlockHeader, HEADER, header_from_bytes
+from Miner import target_from_difficulty
+
+MEDIAN_SPAN = 11  # a header must be later than the median timestamp of this many headers before it
+MAX_FUTURE = 2 * 3600  # a header can not be more than this many seconds ahead of the local clock
+
+
+class HeaderSync:
+    """
+    Streaming synchronization of a header chain. A thread decodes the incoming headers in batches while the caller
+    validates and stores the previous batch. The headers already in the chain are skipped, so an interrupted sync
+    resumes where it stopped.
+    """
+
+    def __init__(self, chain, difficulty=16, batch_size=2000, queue_batches=4, clock=time.time):
+        """
+        Initialize a header synchronization
+        :param chain: a HeaderChain, the headers are appended to it
+        :param difficulty: number of leading zero bits the hash of a header must have
+        :param batch_size: number of headers in a batch
+        :param queue_batches: number of decoded batches waiting for validation, this bounds the memory used
+        :param clock: a function that gives the current time
+        """
+        self.chain = chain
+        self.target = target_from_difficulty(difficulty)
+        self.batch_size = batch_size
+        self.queue_batches = queue_batches
+        self.clock = clock
+
+        # statistics of the last sync
+        self.added = 0
+        self.skipped = 0
+        self.elapsed = 0.0
+
+    @property
+    def locator(self):
+        """
+        :return: the height and the hash of the last header, what a peer needs to stream the headers that follow
+        """
+        return self.chain.height, self.chain.tip_hash
+
+    @property
+    def rate(self):
+        """
+        :return: headers added per second in the last sync
+        """
+        return self.added / self.elapsed if self.elapsed else 0.0
+
+    def sync(self, source):
+        """
+        Validate and append the headers of a source to the chain. The chain is written to disk after every batch,
+        the valid headers before an invalid one are kept.
+        :param source: an iterable of block header objects, an iterable of byte chunks holding binary headers, or a file
+        object to read binary headers from
+        :return: the number of headers added
+        """
+        started = time.perf_counter()
+        self.added = 0
+        self.skipped = 0
+
+        batches = Queue(self.queue_batches)
+        stop = Event()
+        decoder = Thread(target=self.__decode, args=(source, batches, stop), daemon=True)
+        decoder.start()
+
+        # timestamps of the last headers of the chain, for the median time check
+        recent = deque((self.chain.get(height).timestamp
+                        for height in range(max(0, len(self.chain) - MEDIAN_SPAN), len(self.chain))), MEDIAN_SPAN)
+        try:
+            while True:
+                batch = batches.get()
+                if isinstance(batch, BaseException):
+                    raise batch
+                if batch is None:
+                    break
+                self.__validate_batch(batch, recent)
+        finally:
+            # let the decoder finish if it is blocked on a full queue
+            stop.set()
+            while decoder.is_alive():
+                while not batches.empty():
+                    batches.get_nowait()
+                decoder.join(0.01)
+            self.chain.sync()
+            self.elapsed = time.perf_counter() - started
+        return self.added
+
+    def __validate_batch(self, batch, recent):
+        """
+        a private method that checks the headers of a batch in order and appends them to the chain
+        :param batch: a list of block header objects
+        :param recent: timestamps of the last headers of the chain
+        """
+        latest = self.clock() + MAX_FUTURE
+        for header in batch:
+            if header.prev_hash != self.chain.tip_hash:
+                # a header the chain already has, from a sync that was interrupted
+                if self.chain.height_of(header.hash) is not None:
+                    self.skipped += 1
+                    continue
+                raise RuntimeError('Block header ' + header.hash + ' does not extend the chain.')
+
+            if recent and header.timestamp <= sorted(recent)[len(recent) // 2]:
+                raise RuntimeError('Block header ' + header.hash + ' is not later than the median time.')
+            if header.timestamp > latest:
+                raise RuntimeError('Block header ' + header.hash + ' is too far in the future.')
+            if bytes.fromhex(header.hash) > self.target:
+                raise RuntimeError('Block header ' + header.hash + ' does not have enough proof of work.')
+
+            self.chain.append(header)
+            recent.append(header.timestamp)
+            self.added += 1
+        self.chain.sync()
+
+    def __decode(self, source, batches, stop):
+        """
+        a private method, run by the decoder thread, that turns the source into batches of block header objects
+        """
+        try:
+            batch = []
+            for header in self.__headers(source):
+                batch.append(header)
+                if len(batch) == self.batch_size:
+                    if not self.__put(batches, batch, stop):
+                        return
+                    batch = []
+            if batch and not self.__put(batches, batch, stop):
+                return
+            self.__put(batches, None, stop)
+        except Exception as e:
+            self.__put(batches, e, stop)
+
+    def __headers(self, source):
+        """
+        a private method that reads the headers of a source one by one
+        """
+        if hasattr(source, 'read'):
+            read = source.read
+            source = iter(lambda: read(self.batch_size * HEADER.size), b'')
+
+        pending = bytearray()
+        for item in source:
+            if isinstance(item, BlockHeader):
+                yield item
+                continue
+
+            # binary headers can be split anywhere between two chunks
+            pending += item
+            end = len(pending) - len(pending) % HEADER.size
+            view = memoryview(pending)
+            for offset in range(0, end, HEADER.size):
+                yield header_from_bytes(view, offset)
+            view.release()
+            del pending[:end]
+        if pending:
+            raise RuntimeError('Header stream ends with an incomplete header.')
+
+    @staticmethod
+    def __put(batches, item, stop):
+        """
+        a private method that waits for room in the queue, unless the sync stopped
+        :return: false if the sync stopped
+        """
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+
+# test cases
+def test():
+    import io
+    from HeaderChain import HeaderChain
+    from Miner import Miner
+
+    # mine a short chain with a low difficulty
+    miner = Miner(difficulty=8, workers=1)
+    source = HeaderChain()
+    for i in range(300):
+        header = BlockHeader(source.tip_hash, 0, '%064x' % i, 1546300800.0 + 600 * i)
+        miner.mine(header)
+        source.append(header)
+    stream = b''.join(bytes(source.header_bytes(height)) for height in range(len(source)))
+
+    # an interrupted sync, then a sync of the whole stream that resumes after the known headers
+    chain = HeaderChain()
+    sync = HeaderSync(chain, difficulty=8, batch_size=64)
+    head = stream[:100 * HEADER.size]
+    print(sync.sync(head[i:i + 1000] for i in range(0, len(head), 1000)))
+    print(sync.sync(io.BytesIO(stream)), sync.skipped, chain.tip_hash == source.tip_hash)
+
+    # a header without enough proof of work is rejected
+    bad = BlockHeader(chain.tip_hash, 0, '00' * 32, 1546300800.0 + 600 * 300)
+    while bytes.fromhex(bad.hash) <= target_from_difficulty(8):
+        bad.nonce += 1
+    try:
+        sync.sync([bad])
+    except RuntimeError as e:
+        print(e)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,276 @@
+import os
+from json import dumps, loads
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+
+from Crypto.Cipher import AES
+from Crypto.Protocol.KDF import scrypt
+from Crypto.PublicKey import RSA
+from Crypto.Random import get_random_bytes
+from ecdsa import SigningKey, SECP256k1
+
+from KeyUtils import generate_private_key_ecc, generate_public_key_ecc, generate_private_key_rsa, \
+    generate_public_key_rsa
+
+KEYSTORE_VERSION = 1
+KDF_COST = 1 << 14  # scrypt N, the work to turn the passphrase into the key of the file
+
+
+def generate_keys(key_length=1024):
+    """
+    Generate the keys of a node
+    :param key_length: length of the rsa key
+    :return: the private ecc key and the private rsa key
+    """
+    return generate_private_key_ecc(), generate_private_key_rsa(key_length)
+
+
+class NodeKeys:
+    """
+    The keys of a node, made on first use. Loading them from a keystore or generating them is only paid by a node that
+    needs them.
+    """
+
+    def __init__(self, loader=generate_keys):
+        """
+        Initialize the keys of a node
+        :param loader: a function that returns the private ecc key and the private rsa key, new keys by default
+        """
+        self.loader = loader
+        self.keys = None
+
+    @property
+    def materialized(self):
+        """
+        :return: true once the keys were loaded
+        """
+        return self.keys is not None
+
+    @property
+    def private_key_ecc(self):
+        """
+        :return: the private ecc key, of type ecdsa.SigningKey
+        """
+        return self.__load()[0]
+
+    @property
+    def public_key_ecc(self):
+        """
+        :return: the public ecc key, of type ecdsa.VerifyingKey
+        """
+        return self.__load()[1]
+
+    @property
+    def private_key_rsa(self):
+        """
+        :return: the private rsa key
+        """
+        return self.__load()[2]
+
+    @property
+    def public_key_rsa(self):
+        """
+        :return: the public rsa key
+        """
+        return self.__load()[3]
+
+    def __load(self):
+        """
+        a private method that loads the private keys and derives the public keys, the first time
+        """
+        if self.keys is None:
+            private_key_ecc, private_key_rsa = self.loader()
+            self.keys = (private_key_ecc, generate_public_key_ecc(private_key_ecc),
+                         private_key_rsa, generate_public_key_rsa(private_key_rsa))
+            self.loader = None
+        return self.keys
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class KeyStore:
+    """
+    File holding the keys of a node, encrypted with AES-GCM under a key derived from a passphrase with scrypt.
+    """
+
+    def __init__(self, path, passphrase, kdf_cost=KDF_COST):
+        """
+        Initialize a keystore
+        :param path: path of the keystore file
+        :param passphrase: the passphrase in string format
+        :param kdf_cost: scrypt N for new files, a power of 2. Existing files keep their own.
+        """
+        self.path = path
+        self.passphrase = passphrase.encode('utf-8')
+        self.kdf_cost = kdf_cost
+
+    @property
+    def exists(self):
+        """
+        :return: true if the keystore file exists
+        """
+        return os.path.exists(self.path)
+
+    def load(self):
+        """
+        Load the keys, the file is read and decrypted on first use of a key
+        :return: a NodeKeys object
+        """
+        if not self.exists:
+            raise RuntimeError('No keystore at ' + self.path + '.')
+        return NodeKeys(self.__read)
+
+    def load_or_create(self, key_length=1024):
+        """
+        Load the keys, or generate and save new ones if the file does not exist yet
+        :param key_length: length of a new rsa key
+        :return: a NodeKeys object
+        """
+        if self.exists:
+            return self.load()
+        keys = NodeKeys(lambda: generate_keys(key_length))
+        self.save(keys)
+        return keys
+
+    def save(self, keys):
+        """
+        Encrypt and write keys, the old file is replaced only once the new one is complete
+        :param keys: a NodeKeys object
+        """
+        plain = dumps({'ecc': keys.private_key_ecc.to_string().hex(),
+                       'rsa': keys.private_key_rsa.export_key(format='DER').hex()})
+        salt = get_random_bytes(16)
+        nonce = get_random_bytes(12)
+        cipher = AES.new(scrypt(self.passphrase, salt, 32, self.kdf_cost, 8, 1), AES.MODE_GCM, nonce=nonce)
+        content, tag = cipher.encrypt_and_digest(plain.encode('utf-8'))
+        j = {'version': KEYSTORE_VERSION,
+             'kdf_cost': self.kdf_cost,
+             'salt': salt.hex(),
+             'nonce': nonce.hex(),
+             'keys': (content + tag).hex()}
+
+        tmp = self.path + '.tmp'
+        with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(dumps(j))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def __read(self):
+        """
+        a private method that reads and decrypts the file
+        :return: the private ecc key and the private rsa key
+        """
+        with open(self.path) as f:
+            j = loads(f.read())
+        if j['version'] != KEYSTORE_VERSION:
+            raise RuntimeError('Unknown keystore version ' + str(j['version']) + '.')
+
+        key = scrypt(self.passphrase, bytes.fromhex(j['salt']), 32, j['kdf_cost'], 8, 1)
+        data = bytes.fromhex(j['keys'])
+        cipher = AES.new(key, AES.MODE_GCM, nonce=bytes.fromhex(j['nonce']))
+        try:
+            plain = loads(cipher.decrypt_and_verify(data[:-16], data[-16:]))
+        except ValueError:
+            raise ValueError('Wrong passphrase or damaged keystore.')
+        return (SigningKey.from_string(bytes.fromhex(plain['ecc']), curve=SECP256k1),
+                RSA.import_key(bytes.fromhex(plain['rsa'])))
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class KeyPool:
+    """
+    Keys generated ahead by a background thread, for simulations and tests that start many nodes.
+    """
+
+    def __init__(self, size=8, key_length=1024):
+        """
+        Initialize a key pool and start filling it
+        :param size: number of keys kept ready
+        :param key_length: length of the rsa keys
+        """
+        self.key_length = key_length
+        self.ready = Queue(size)
+        self.stop = Event()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+
+        self.thread = Thread(target=self.__fill, daemon=True)
+        self.thread.start()
+
+    def take(self):
+        """
+        Take keys from the pool, they are generated right away if the pool is empty
+        :return: a NodeKeys object
+        """
+        try:
+            keys = self.ready.get_nowait()
+            self.hits += 1
+        except Empty:
+            keys = generate_keys(self.key_length)
+            self.misses += 1
+        return NodeKeys(lambda: keys)
+
+    def close(self):
+        """
+        Stop the background thread
+        """
+        self.stop.set()
+        self.thread.join()
+
+    def __fill(self):
+        """
+        a private method, run by the background thread, that keeps the pool full
+        """
+        while not self.stop.is_set():
+            keys = generate_keys(self.key_length)
+            while not self.stop.is_set():
+                try:
+                    self.ready.put(keys, timeout=0.1)
+                    break
+                except Full:
+                    continue
+
+
+# test cases
+def test():
+    import time
+    from tempfile import mkdtemp
+
+    path = os.path.join(mkdtemp(), 'keys.json')
+    store = KeyStore(path, 'passphrase')
+    keys = store.load_or_create()
+    print(keys.public_key_ecc.to_string().hex())
+
+    # loading does not decrypt anything until a key is used
+    started = time.perf_counter()
+    loaded = store.load()
+    print(loaded.materialized, '%.6f seconds' % (time.perf_counter() - started))
+    print(loaded.public_key_ecc.to_string() == keys.public_key_ecc.to_string())
+    print(loaded.public_key_rsa == keys.public_key_rsa)
+
+    try:
+        KeyStore(path, 'wrong').load().private_key_rsa
+    except ValueError as e:
+        print(e)
+
+    # a pool gives keys generated ahead
+    pool = KeyPool(size=2)
+    time.sleep(1)
+    nodes = [pool.take() for _ in range(3)]
+    print(len(set(k.public_key_ecc.to_string() for k in nodes)), pool.hits + pool.misses)
+    pool.close()
+
+    # a node built on a keystore has the same keys every time
+    from LightWeightNode import LightWeightNode
+    node = LightWeightNode(keystore=store)
+    print(node.export_public_key_ecc() == keys.public_key_ecc.to_string().hex(), node.keys.materialized)
+
+
+if __name__ == '__main__':
+    test()
@@ -1,13 +1,24 @@
 from ecdsa import SigningKey, VerifyingKey, SECP256k1
+from ecdsa.ellipticcurve import PointJacobi
 from Crypto.PublicKey import RSA
-from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Cipher import PKCS1_OAEP, AES
+from Crypto.Random import get_random_bytes
 from base64 import b64encode, b64decode
+from collections import OrderedDict
 from json import loads
 
 
 # comments:
 # BTC uses base58 encode to avoid special characters. It requires another library. So I use base64 here.
 
+# envelope: version, the session key wrapped with the rsa key of the recipient, a nonce, the content encrypted with
+# AES-GCM and its tag. The version and the wrapped key are authenticated with the content.
+ENVELOPE_VERSION = 1
+ENVELOPE_NONCE = 12
+ENVELOPE_TAG = 16
+SESSION_KEY_SIZE = 32
+SESSION_MESSAGES = 1 << 20  # messages encrypted with a session key before a new one is made
+
 
 # -------------------------------------------ECC key functions-------------------------------------------------------
 
@@ -53,7 +64,9 @@ def import_public_key_ecc(s):
     :param s: a hex string generated by export_keys()
     :return: a VerifyingKey object
     """
-    return VerifyingKey.from_string(bytes.fromhex(s), curve=SECP256k1)
+    # the point keeps the order of the curve, without it the key can not be precomputed
+    point = PointJacobi.from_bytes(SECP256k1.curve, bytes.fromhex(s), order=SECP256k1.order)
+    return VerifyingKey.from_public_point(point, curve=SECP256k1)
 
 
 # -------------------------------------------RSA key functions-------------------------------------------------------
@@ -99,24 +112,255 @@ def import_public_key_rsa(public_key):
 
 def string_to_keys(s):
     """
-    Import keys from string.
+    Import keys from string. The keys of a peer are parsed once and then taken from the key registry.
     :param s: a json style string created by export_keys() method
     :return: ecc key and rsa key objects
     """
-    j = loads(s)
-    public_key_ecc = import_public_key_ecc(j["public_key_ecc"])
-    public_key_rsa = import_public_key_rsa(j["public_key_rsa"])
-    return public_key_ecc, public_key_rsa
+    return key_registry.keys(s)
 
 
-def encrypt_message(public_key_recipient, message):
+def encrypt_message(public_key_recipient, message, envelope=False):
     """
     Encrypt a message using recipient's public key
     :param public_key_recipient: public key of recipient
-    :param message: message in string format
-    :return: an rsa encrypted message
+    :param message: message in string format, or bytes
+    :param envelope: false to encrypt with rsa, which takes at most 86 bytes with a 1024 bits key. True to encrypt
+    with a session key shared by the messages to the same recipient, for messages of any size.
+    :return: an rsa encrypted message, or an envelope, in hex
+    """
+    data = message if isinstance(message, bytes) else message.encode('utf-8')
+    if envelope:
+        return key_registry.session(public_key_recipient).seal(data).hex()
+    return key_registry.rsa_cipher(public_key_recipient).encrypt(data).hex()
+
+
+def decrypt_message(private_key, message):
+    """
+    Decrypt a message made by encrypt_message(), with or without envelope
+    :param private_key: private rsa key of the recipient
+    :param message: the encrypted message in hex
+    :return: the message in bytes
     """
-    return PKCS1_OAEP.new(public_key_recipient).encrypt(message.encode('utf-8')).hex()
+    data = bytes.fromhex(message)
+    # an rsa encrypted message is exactly the size of the key, an envelope holds such a block and more
+    if len(data) > private_key.size_in_bytes():
+        return open_envelope(private_key, data)
+    return key_registry.rsa_cipher(private_key).decrypt(data)
+
+
+def open_envelope(private_key, envelope):
+    """
+    Decrypt an envelope, the session key is unwrapped once and then taken from the key registry
+    :param private_key: private rsa key of the recipient
+    :param envelope: the envelope in bytes
+    :return: the content in bytes
+    """
+    header_size = 1 + private_key.size_in_bytes()
+    if len(envelope) < header_size + ENVELOPE_NONCE + ENVELOPE_TAG or envelope[0] != ENVELOPE_VERSION:
+        raise ValueError('Malformed envelope.')
+    header = envelope[:header_size]
+    nonce = envelope[header_size:header_size + ENVELOPE_NONCE]
+
+    cipher = AES.new(key_registry.session_key(private_key, header[1:]), AES.MODE_GCM, nonce=nonce)
+    cipher.update(header)
+    return cipher.decrypt_and_verify(envelope[header_size + ENVELOPE_NONCE:-ENVELOPE_TAG], envelope[-ENVELOPE_TAG:])
+
+
+# -------------------------------------------Envelope session--------------------------------------------------------
+
+
+class EnvelopeSession:
+    """
+    Session key for the messages to one recipient. The key is wrapped with rsa once, every message is then encrypted
+    with AES-GCM under a nonce made of a random prefix and a counter.
+    """
+
+    def __init__(self, public_key_recipient, max_messages=SESSION_MESSAGES):
+        """
+        Initialize a session with a new key
+        :param public_key_recipient: public rsa key of the recipient
+        :param max_messages: number of messages before the session expires
+        """
+        self.key = get_random_bytes(SESSION_KEY_SIZE)
+        self.header = bytes([ENVELOPE_VERSION]) + key_registry.rsa_cipher(public_key_recipient).encrypt(self.key)
+        self.prefix = get_random_bytes(ENVELOPE_NONCE - 8)
+        self.count = 0
+        self.max_messages = max_messages
+
+    @property
+    def expired(self):
+        """
+        :return: true once the session encrypted max_messages messages
+        """
+        return self.count >= self.max_messages
+
+    def seal(self, data):
+        """
+        Encrypt a message in an envelope
+        :param data: the message in bytes
+        :return: the envelope in bytes
+        """
+        if self.expired:
+            raise RuntimeError('Envelope session expired.')
+        nonce = self.prefix + self.count.to_bytes(8, 'big')
+        self.count += 1
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(self.header)
+        content, tag = cipher.encrypt_and_digest(data)
+        return self.header + nonce + content + tag
+
+
+# -------------------------------------------Key registry-------------------------------------------------------------
+
+
+class KeyRegistry:
+    """
+    Bounded cache of the imported keys of peers and of the ciphers built on them, the least recently used are dropped
+    first. An ecc key used often enough is precomputed, which makes verifying its signatures faster.
+    """
+
+    def __init__(self, max_keys=1024, precompute_after=8):
+        """
+        Initialize a key registry
+        :param max_keys: number of keys and ciphers to keep
+        :param precompute_after: number of uses of an ecc key before it is precomputed. Precomputing costs about as
+        much as ten verifications, so it does not pay for a key seen only a few times. 0 to never precompute.
+        """
+        self.max_keys = max_keys
+        self.precompute_after = precompute_after
+        self.entries = OrderedDict()  # (kind, key string or numbers) -> [object, uses]
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.precomputed = 0
+
+    @property
+    def hit_rate(self):
+        """
+        :return: the share of lookups that found the key in the registry
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def stats(self):
+        """
+        :return: a dict of the size of the registry and its counters
+        """
+        return {'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate,
+                'precomputed': self.precomputed}
+
+    def ecc_key(self, s):
+        """
+        :param s: a public ecc key in hex, or its address made by key_to_address_ecc()
+        :return: a VerifyingKey object
+        """
+        entry = self.__lookup(('ecc', s), self.__import_ecc, s)
+        entry[1] += 1
+        if entry[1] == self.precompute_after:
+            entry[0].precompute()
+            self.precomputed += 1
+        return entry[0]
+
+    def rsa_key(self, s):
+        """
+        :param s: a public rsa key in string format
+        :return: a public key object
+        """
+        return self.__lookup(('rsa', s), import_public_key_rsa, s)[0]
+
+    def rsa_cipher(self, key):
+        """
+        :param key: a public or private rsa key object, or a public key in string format
+        :return: a PKCS1_OAEP cipher of the key, it can encrypt or decrypt any number of messages
+        """
+        if isinstance(key, str):
+            key = self.rsa_key(key)
+        name = ('cipher', key.n, key.e, key.has_private())
+        return self.__lookup(name, PKCS1_OAEP.new, key)[0]
+
+    def session(self, public_key_recipient):
+        """
+        :param public_key_recipient: public rsa key of the recipient
+        :return: the envelope session for the recipient, a new one once the last one expired
+        """
+        key = public_key_recipient
+        name = ('session', key.n, key.e)
+        session = self.__lookup(name, EnvelopeSession, key)[0]
+        if session.expired:
+            del self.entries[name]
+            session = self.__lookup(name, EnvelopeSession, key)[0]
+        return session
+
+    def session_key(self, private_key, wrapped):
+        """
+        :param private_key: private rsa key of the recipient
+        :param wrapped: a session key wrapped with the public key
+        :return: the session key
+        """
+        # the recipient is part of the name, a key unwrapped by one node must not open the envelopes of another one
+        name = ('unwrapped', private_key.n, bytes(wrapped))
+        return self.__lookup(name, self.rsa_cipher(private_key).decrypt, wrapped)[0]
+
+    def keys(self, s):
+        """
+        :param s: a json style string created by export_keys() method
+        :return: ecc key and rsa key objects
+        """
+        j = loads(s)
+        return self.ecc_key(j["public_key_ecc"]), self.rsa_key(j["public_key_rsa"])
+
+    def invalidate(self, key=None):
+        """
+        drop a key and the ciphers built on it, like when a peer changes its keys
+        :param key: a key in string format or an rsa key object, None to drop everything
+        """
+        if key is None:
+            self.entries.clear()
+            return
+        if isinstance(key, (str, bytes)):
+            self.entries.pop(('ecc', key), None)
+            entry = self.entries.pop(('rsa', key), None)
+            if entry is None:
+                return
+            key = entry[0]
+        self.entries.pop(('cipher', key.n, key.e, key.has_private()), None)
+        self.entries.pop(('session', key.n, key.e), None)
+        for name in [name for name in self.entries if name[0] == 'unwrapped' and name[1] == key.n]:
+            del self.entries[name]
+
+    def __lookup(self, name, build, arg):
+        """
+        a private method that finds an entry, or builds it and drops the least recently used entry if the registry is
+        full
+        """
+        entry = self.entries.get(name)
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(name)
+            return entry
+        self.misses += 1
+        entry = self.entries[name] = [build(arg), 0]
+        if len(self.entries) > self.max_keys:
+            self.entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def __import_ecc(s):
+        """
+        a private method that imports an ecc key from hex or from an address
+        """
+        if isinstance(s, bytes) or len(s) != 2 * SECP256k1.verifying_key_length:
+            s = address_to_key_ecc(s)
+        return import_public_key_ecc(s)
+
+
+# the registry shared by the functions of this module
+key_registry = KeyRegistry()
 
 
 def test():
@@ -156,6 +400,30 @@ def test():
 
     print(vk)
 
+    # imported keys come from the registry after the first time, and are precomputed once used enough
+    registry = KeyRegistry(max_keys=2, precompute_after=3)
+    for _ in range(4):
+        key = registry.ecc_key(vk.to_string().hex())
+    print(key.verify(signature, message.encode('utf-8')), registry.ecc_key(vadd) == key)
+    rsa = generate_private_key_rsa()
+    cipher = registry.rsa_cipher(export_public_key_rsa(generate_public_key_rsa(rsa)))
+    print(registry.rsa_cipher(rsa).decrypt(cipher.encrypt(b'hello')))
+    print(registry.stats)
+
+    # an envelope takes a message larger than rsa alone can, and the session key is wrapped once for many messages
+    public = generate_public_key_rsa(rsa)
+    payload = bytes(range(256)) * 16
+    envelopes = [encrypt_message(public, payload, envelope=True) for _ in range(3)]
+    print(len(envelopes[0]) // 2, len(set(e[:258] for e in envelopes)), len(set(envelopes)))
+    print(all(decrypt_message(rsa, e) == payload for e in envelopes))
+    print(decrypt_message(rsa, encrypt_message(public, 'hello')))
+
+    # the session key unwrapped for one recipient does not open the envelope for another key
+    try:
+        decrypt_message(generate_private_key_rsa(), envelopes[0])
+    except ValueError as e:
+        print(e)
+
 
 if __name__ == '__main__':
     test()
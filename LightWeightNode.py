@@ -1,25 +1,91 @@
+import os
+from collections import OrderedDict
+from json import dumps
 from KeyUtils import *
-from Transaction import TxDB
-from Crypto.Cipher import PKCS1_OAEP
+from BlockHeader import header_from_bytes
+from KeyStore import NodeKeys
+from BloomFilter import BloomFilter
+from HeaderChain import HeaderChain
+from HeaderSync import HeaderSync
+from MerkleTree import MerkleTree
+from Network import Network, ROLE_LIGHT, CMD_HEADERS, CMD_TX, HEADERS_REQUEST
+from Subscriptions import CMD_FILTERLOAD, CMD_FILTERADD, CMD_MATCH_TX, CMD_MERKLE_TX, CMD_BLOCK
+from Transaction import TxDB, tx_from_bytes
+from TxStore import TxStore
 
+PENDING_BLOCKS = 16  # blocks whose transaction proofs are kept until their header arrives
 
-class LightWeightNode:
 
-    def __init__(self):
-        # generate keys for ecc
-        self.private_key_ecc = generate_private_key_ecc()
-        self.public_key_ecc = generate_public_key_ecc(self.private_key_ecc)
+class LightWeightNode:
 
-        # generate keys for rsa
-        self.private_key_rsa = generate_private_key_rsa()
-        self.public_key_rsa = generate_public_key_rsa(self.private_key_rsa)
+    def __init__(self, data_dir=None, difficulty=16, keystore=None, key_pool=None):
+        """
+        Initialize a node
+        :param data_dir: a directory to keep the transaction database and the block headers on disk, None to keep them
+        in memory
+        :param difficulty: number of leading zero bits the hash of a block header must have
+        :param keystore: a KeyStore to load the keys from, or to save new keys to
+        :param key_pool: a KeyPool to take new keys from, when there is no keystore
+        """
+        # ecc and rsa keys, loaded or generated on first use
+        if keystore is not None:
+            self.keys = keystore.load_or_create()
+        elif key_pool is not None:
+            self.keys = key_pool.take()
+        else:
+            self.keys = NodeKeys()
 
         # connected full nodes
         self.heavy_peers_limit = 10
         self.peers_heavy = []
 
         # transaction database
-        self.tx_db = TxDB()
+        self.tx_db = TxDB(None if data_dir is None else TxStore(data_dir))
+
+        # block headers
+        self.headers = HeaderChain(None if data_dir is None else os.path.join(data_dir, 'headers.dat'))
+        self.header_sync = HeaderSync(self.headers, difficulty)
+
+        # peer networking, the connections to full nodes are kept in peers_heavy
+        self.network = Network(ROLE_LIGHT, self.heavy_peers_limit, 0, self.peers_heavy)
+        self.network.handlers[CMD_MATCH_TX] = self.__receive_match
+        self.network.handlers[CMD_MERKLE_TX] = self.__receive_merkle_tx
+        self.network.handlers[CMD_BLOCK] = self.__receive_block
+
+        # addresses the full nodes send transactions of, and the bloom filter they match them with
+        self.watched = set()
+        self.bloom = None
+        self.false_positives = 0  # transactions that matched the filter but none of the addresses
+        self.unproven = 0  # block transactions without a valid proof
+        self.pending = OrderedDict()  # hash of a block without header -> list of (transaction, proof) waiting for it
+
+    @property
+    def private_key_ecc(self):
+        """
+        :return: the private ecc key
+        """
+        return self.keys.private_key_ecc
+
+    @property
+    def public_key_ecc(self):
+        """
+        :return: the public ecc key
+        """
+        return self.keys.public_key_ecc
+
+    @property
+    def private_key_rsa(self):
+        """
+        :return: the private rsa key
+        """
+        return self.keys.private_key_rsa
+
+    @property
+    def public_key_rsa(self):
+        """
+        :return: the public rsa key
+        """
+        return self.keys.public_key_rsa
 
     def export_keys(self):
         """
@@ -30,21 +96,180 @@ class LightWeightNode:
                      ('public_key_rsa', self.export_public_key_rsa())])
         return dumps(keys)
 
-    def find_peers(self):
+    async def find_peers(self, addresses):
+        """
+        connect to full nodes, until heavy_peers_limit of them are connected
+        :param addresses: a list of (host, port) of full nodes
+        :return: the list of connections to full nodes
+        """
+        error = None
+        for host, port in addresses:
+            if len(self.peers_heavy) >= self.heavy_peers_limit:
+                break
+            try:
+                await self.network.connect(host, port)
+            except (RuntimeError, OSError) as e:
+                error = e
+        if not self.peers_heavy and error is not None:
+            raise error
+        return self.peers_heavy
+
+    async def download_headers(self, peer, batch=2000):
+        """
+        Download the block headers after the ones already stored from a full node
+        :param peer: a connection to a full node
+        :param batch: number of headers asked at once
+        :return: the number of headers added
+        """
+        added = 0
+        while True:
+            data = await peer.request(CMD_HEADERS, HEADERS_REQUEST.pack(len(self.headers), batch))
+            synced = self.sync_headers([data]) if data else 0
+            if not synced:
+                return added
+            added += synced
+
+    async def subscribe(self, addresses=(), capacity=10, fp_rate=0.001):
+        """
+        Ask the full nodes for the transactions of the node's own ecc key and of other addresses. A higher false
+        positive rate sends more unrelated transactions, but tells the full nodes less about which addresses are the
+        node's.
+        :param addresses: other public ecc keys in hex
+        :param capacity: number of addresses the filter is made for
+        :param fp_rate: the false positive rate of the filter once it holds capacity addresses
+        """
+        self.watched = {self.export_public_key_ecc()} | set(addresses)
+        self.bloom = BloomFilter(max(capacity, len(self.watched)), fp_rate)
+        for address in self.watched:
+            self.bloom.add(address)
+        payload = bytes([self.bloom.hashes]) + self.bloom.to_bytes()
+        for peer in list(self.peers_heavy):
+            await peer.notify(CMD_FILTERLOAD, payload)
+
+    async def watch(self, address):
         """
-        connect to peers
-        :return:
+        Add an address to the filter of the full nodes, without sending the whole filter again
+        :param address: a public ecc key in hex
         """
-        # Todo: implement, connect to full nodes and other light weight nodes
-        return [], [], self
+        if self.bloom is None:
+            raise RuntimeError('Not subscribed.')
+        self.watched.add(address)
+        self.bloom.add(address)
+        for peer in list(self.peers_heavy):
+            await peer.notify(CMD_FILTERADD, address.encode('utf-8'))
+
+    async def __receive_match(self, connection, payload):
+        """
+        a private method that stores an unconfirmed transaction sent by a full node
+        :param payload: a binary transaction
+        """
+        tx = tx_from_bytes(payload)[0]
+        if tx.sender not in self.watched and tx.recipient not in self.watched:
+            self.false_positives += 1
+        elif tx.txid not in self.tx_db:
+            if tx.recipient in self.watched:
+                self.tx_db.add_in_uc(tx)
+            else:
+                self.tx_db.add_out_uc(tx)
+
+    async def __receive_block(self, connection, payload):
+        """
+        a private method that adds the header of a new block announced by a full node, the headers before it are
+        downloaded first if the chain is behind
+        :param payload: a binary block header
+        """
+        header = header_from_bytes(payload)
+        if self.headers.get_by_hash(header.hash) is not None:
+            return
+        if header.prev_hash == self.headers.tip_hash:
+            self.sync_headers([payload])
+        else:
+            await self.download_headers(connection)
+
+    async def __receive_merkle_tx(self, connection, payload):
+        """
+        a private method that confirms a transaction of a block, once its proof matches a header of the chain. The
+        proof of a block whose header is not there yet waits for it, and the headers are asked to the full node.
+        :param payload: the hash of the block, a binary transaction and its compact proof
+        """
+        block_hash = payload[:32].hex()
+        tx, end = tx_from_bytes(payload, 32)
+        header = self.headers.get_by_hash(block_hash)
+        if header is not None:
+            self.__confirm_block_tx(header, tx, payload[end:])
+            return
+
+        first = block_hash not in self.pending
+        self.pending.setdefault(block_hash, []).append((tx, payload[end:]))
+        if len(self.pending) > PENDING_BLOCKS:
+            self.unproven += len(self.pending.popitem(last=False)[1])
+        if first:
+            await self.download_headers(connection)
+
+    def __confirm_pending(self):
+        """
+        a private method that checks the waiting proofs of the blocks whose header arrived
+        """
+        for block_hash in [h for h in self.pending if self.headers.get_by_hash(h) is not None]:
+            header = self.headers.get_by_hash(block_hash)
+            for tx, proof in self.pending.pop(block_hash):
+                self.__confirm_block_tx(header, tx, proof)
+
+    def __confirm_block_tx(self, header, tx, proof):
+        """
+        a private method that confirms a transaction of a block if its proof matches the header
+        """
+        if not MerkleTree.confirm_compact_proof(tx.txid, proof, header.merkle_root):
+            self.unproven += 1
+            return
+        if tx.sender not in self.watched and tx.recipient not in self.watched:
+            self.false_positives += 1
+            return
+
+        if tx.txid in self.tx_db.in_uc or tx.txid in self.tx_db.out_uc:
+            self.tx_db.confirm(tx.txid)
+        elif tx.txid not in self.tx_db:
+            if tx.recipient in self.watched:
+                self.tx_db.add_in_co(tx)
+            else:
+                self.tx_db.add_out_co(tx)
+
+    async def send_tx(self, tx, peer=None):
+        """
+        Send a transaction to a full node
+        :param tx: a transaction object
+        :param peer: a connection to a full node, the first one by default
+        :return: true if the full node added it to its mempool
+        """
+        peer = self.peers_heavy[0] if peer is None else peer
+        return await peer.request(CMD_TX, tx.to_bytes) == b'\x01'
+
+    def sync_headers(self, source):
+        """
+        Download block headers from a full node, only the headers after the ones already stored are added
+        :param source: an iterable of block header objects or of byte chunks, or a file object of binary headers
+        :return: the number of headers added
+        """
+        added = self.header_sync.sync(source)
+        if added and self.pending:
+            self.__confirm_pending()
+        return added
 
     def decrypt_message(self, message):
         """
         Decrypt an encrypted message using private key
-        :param message: an rsa encrypted message
+        :param message: an rsa encrypted message or an envelope, in hex
         :return: the decrypted message
         """
-        return PKCS1_OAEP.new(self.private_key_rsa).decrypt(bytes.fromhex(message)).decode('utf-8')
+        return self.decrypt_payload(message).decode('utf-8')
+
+    def decrypt_payload(self, message):
+        """
+        Decrypt an encrypted binary payload, like sensor data sent in an envelope
+        :param message: an rsa encrypted message or an envelope, in hex
+        :return: the decrypted payload in bytes
+        """
+        return decrypt_message(self.private_key_rsa, message)
 
     def export_public_key_ecc(self):
         """
@@ -70,6 +295,10 @@ def test():
     message_de = lwn.decrypt_message(message_en)
     print(message_de)
 
+    # a large message goes in an envelope
+    message_en = encrypt_message(lwn.public_key_rsa, message * 1000, envelope=True)
+    print(lwn.decrypt_message(message_en) == message * 1000)
+
     # test export
     exp_s = lwn.export_keys()
     print(exp_s)
@@ -0,0 +1,228 @@
+import time
+from collections import deque
+from heapq import heappush, heappop, heapify, nlargest
+
+
+def priority_by_age(tx):
+    """
+    The older a transaction, the higher its priority
+    :param tx: a transaction object
+    :return: the priority, higher is better
+    """
+    return -tx.timestamp
+
+
+class Mempool:
+    """
+    Bounded pool of unconfirmed transactions. When the pool is full, the transactions with the lowest priority are
+    evicted to make room for better ones, and transactions that stay too long expire.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, priority=priority_by_age, expiry=3600, clock=time.time):
+        """
+        Initialize a mempool
+        :param max_bytes: the budget, as the total size of the transactions in binary format
+        :param priority: a function that gives the priority of a transaction, higher is better
+        :param expiry: seconds after which a transaction is dropped, None to keep transactions until evicted
+        :param clock: a function that gives the current time
+        """
+        self.max_bytes = max_bytes
+        self.priority = priority
+        self.expiry = expiry
+        self.clock = clock
+
+        self.entries = {}  # txid -> (priority, sequence, tx, size)
+        self.heap = []  # (priority, -sequence, txid) with the lowest priority first, removed txs stay until popped
+        self.arrivals = deque()  # (arrival time, sequence, txid) in arrival order, empty without expiry
+        self.sequence = 0  # breaks priority ties, the earlier transaction wins
+        self.bytes = 0
+
+        # counters for tuning
+        self.evictions = 0
+        self.expirations = 0
+        self.duplicates = 0
+        self.rejections = 0
+
+    def add(self, tx):
+        """
+        add a transaction, evicting transactions with a lower priority if the pool is full
+        :param tx: a transaction object
+        :return: true if the transaction is in the pool, false if it was a duplicate or rejected
+        """
+        txid = tx.txid
+        if txid in self.entries:
+            self.duplicates += 1
+            return False
+        self.expire()
+
+        size = len(tx.to_bytes)
+        priority = self.priority(tx)
+        if not self.__make_room(size, priority):
+            self.rejections += 1
+            return False
+
+        self.sequence += 1
+        self.entries[txid] = (priority, self.sequence, tx, size)
+        heappush(self.heap, (priority, -self.sequence, txid))
+        if self.expiry is not None:
+            self.arrivals.append((self.clock(), self.sequence, txid))
+        self.bytes += size
+        return True
+
+    def remove(self, txid):
+        """
+        remove a transaction, like when it is included in a block
+        :param txid: the id of the transaction
+        :return: the transaction, None if it is not in the pool
+        """
+        entry = self.entries.pop(txid, None)
+        if entry is None:
+            return None
+        self.bytes -= entry[3]
+
+        # the heap entry is skipped when it comes up, rebuild the heap once it is mostly dead entries
+        if len(self.heap) > 2 * len(self.entries) + 64:
+            self.heap = [(p, s, t) for p, s, t in self.heap if self.__is_live(t, -s)]
+            heapify(self.heap)
+        return entry[2]
+
+    def get(self, txid):
+        """
+        :param txid: the id of a transaction
+        :return: the transaction, None if it is not in the pool
+        """
+        entry = self.entries.get(txid)
+        return None if entry is None else entry[2]
+
+    def since(self, sequence):
+        """
+        :param sequence: a value the sequence counter had
+        :return: the transactions added after it that are still in the pool, in arrival order
+        """
+        # entries are kept in arrival order, so only the new ones at the end are looked at
+        txs = []
+        for entry in reversed(self.entries.values()):
+            if entry[1] <= sequence:
+                break
+            txs.append(entry[2])
+        txs.reverse()
+        return txs
+
+    def best(self, n=None):
+        """
+        :param n: number of transactions, None for all of them
+        :return: the transactions with the highest priority first
+        """
+        entries = self.entries.values()
+        if n is None:
+            ordered = sorted(entries, key=lambda e: (-e[0], e[1]))
+        else:
+            ordered = nlargest(n, entries, key=lambda e: (e[0], -e[1]))
+        return [entry[2] for entry in ordered]
+
+    def expire(self, now=None):
+        """
+        drop the transactions that arrived more than expiry seconds ago
+        :param now: the current time, the clock by default
+        :return: the list of dropped transactions
+        """
+        if self.expiry is None:
+            return []
+        deadline = (self.clock() if now is None else now) - self.expiry
+
+        expired = []
+        while self.arrivals and self.arrivals[0][0] < deadline:
+            _, sequence, txid = self.arrivals.popleft()
+            if self.__is_live(txid, sequence):
+                expired.append(self.remove(txid))
+        self.expirations += len(expired)
+        return expired
+
+    @property
+    def stats(self):
+        """
+        :return: a dict of the size of the pool and its counters
+        """
+        return {'size': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'duplicates': self.duplicates,
+                'rejections': self.rejections}
+
+    def __contains__(self, txid):
+        return txid in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __is_live(self, txid, sequence):
+        """
+        a private method that checks if a heap or arrival entry still stands for a transaction in the pool
+        """
+        entry = self.entries.get(txid)
+        return entry is not None and entry[1] == sequence
+
+    def __make_room(self, size, priority):
+        """
+        a private method that evicts the transactions with the lowest priority until a new transaction fits. Nothing is
+        evicted if the room can only be made by evicting a transaction with the same or a higher priority.
+        :param size: size of the new transaction
+        :param priority: priority of the new transaction
+        :return: true if the new transaction fits
+        """
+        if size > self.max_bytes:
+            return False
+
+        # pop candidates first, and put them back if the new transaction is not worth it
+        candidates = []
+        freed = 0
+        while self.bytes - freed + size > self.max_bytes:
+            entry = heappop(self.heap)
+            if not self.__is_live(entry[2], -entry[1]):
+                continue
+            candidates.append(entry)
+            if entry[0] >= priority:
+                for candidate in candidates:
+                    heappush(self.heap, candidate)
+                return False
+            freed += self.entries[entry[2]][3]
+
+        for _, _, txid in candidates:
+            self.remove(txid)
+        self.evictions += len(candidates)
+        return True
+
+
+# test cases
+def test():
+    from Transaction import Tx
+
+    now = [1000.0]
+    pool = Mempool(max_bytes=400, expiry=60, clock=lambda: now[0])
+    txs = [Tx('connect', '%0128x' % i, '%0128x' % (i + 1), 'data', 1000.0 + i) for i in range(5)]
+
+    # each transaction takes about 160 bytes, newer transactions are rejected once the pool is full
+    for tx in txs:
+        print(pool.add(tx), end=' ')
+    print(pool.add(txs[0]))
+    print(pool.stats)
+
+    # an older transaction pushes out a newer one
+    print(pool.add(Tx('connect', '00' * 64, '01' * 64, 'data', 900.0)), pool.stats['evictions'])
+
+    print([tx.timestamp for tx in pool.since(2)])
+
+    now[0] += 120
+    print(len(pool.expire()), pool.stats)
+
+    # without expiry nothing is kept for it
+    pool = Mempool(expiry=None)
+    for tx in txs:
+        pool.add(tx)
+    print(len(pool), len(pool.arrivals))
+
+
+if __name__ == '__main__':
+    test()
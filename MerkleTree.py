@@ -1,29 +1,195 @@
 # package function import
-from math import log2
 from hashlib import sha256
+from itertools import repeat
+from os import cpu_count
+
+# versions of the scheme used to hash two nodes together
+HASH_VERSION_HEX = 1  # legacy scheme, hash the utf-8 encoding of the two hex digests
+HASH_VERSION_BYTES = 2  # hash the two 32 byte digests directly
+
+
+def hash_pair_hex(left, right):
+    """
+    hash two nodes together with the legacy scheme
+    :param left: digest of the left node in bytes
+    :param right: digest of the right node in bytes
+    :return: digest of the parent node in bytes
+    """
+    return sha256((left.hex() + right.hex()).encode('utf-8')).digest()
+
+
+def hash_pair_bytes(left, right):
+    """
+    hash two nodes together, 64 bytes in total
+    :param left: digest of the left node in bytes
+    :param right: digest of the right node in bytes
+    :return: digest of the parent node in bytes
+    """
+    hash_func = sha256(left)
+    hash_func.update(right)
+    return hash_func.digest()
+
+
+def get_hash_pair(version):
+    """
+    :param version: a merkle hash version, HASH_VERSION_HEX or HASH_VERSION_BYTES
+    :return: the function that hashes two nodes together under this version
+    """
+    if version == HASH_VERSION_BYTES:
+        return hash_pair_bytes
+    if version == HASH_VERSION_HEX:
+        return hash_pair_hex
+    raise RuntimeError('Unknown merkle hash version ' + str(version) + '.')
+
+
+# in a parallel build, levels smaller than this are hashed on the calling thread, the pool costs more than it saves
+PARALLEL_MIN_TXS = 1024
+PARALLEL_MIN_NODES = 8192
+
+# smallest chunk handed to a worker, internal nodes are cheap so they go in larger chunks than transactions
+TX_CHUNK_MIN = 256
+NODE_CHUNK_MIN = 2048
+
+
+def hash_tx_chunk(tx_list):
+    """
+    hash a chunk of transactions, run by the workers of a parallel build
+    :param tx_list: a list of transactions in string format
+    :return: a list of digests in bytes
+    """
+    return [sha256(tx.encode('utf-8')).digest() for tx in tx_list]
+
+
+def hash_level_chunk(nodes, version):
+    """
+    hash a chunk of one level in pair of 2, run by the workers of a parallel build
+    :param nodes: an even number of digests in bytes
+    :param version: the merkle hash version of the tree
+    :return: the digests of the parent nodes
+    """
+    hash_pair = get_hash_pair(version)
+    return [hash_pair(nodes[j], nodes[j + 1]) for j in range(0, len(nodes), 2)]
+
+
+def split_chunks(items, chunk_min):
+    """
+    split a level into chunks for the workers, about 4 chunks per core so a slow worker does not hold up the level
+    :param items: transactions or digests of one level
+    :param chunk_min: the smallest chunk size
+    :return: a list of chunks, each of even length except maybe the last one
+    """
+    chunk_size = max(chunk_min, -(-len(items) // (4 * (cpu_count() or 1))))
+    chunk_size += chunk_size & 1  # never split a pair of nodes
+    return [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+
+
+def encode_varint(n):
+    """
+    encode a non-negative integer in 7 bit groups, lowest group first, the high bit of a byte is set if more follow
+    :param n: the integer
+    :return: 1 to 10 bytes for a 64 bit integer
+    """
+    if n < 0:
+        raise ValueError('A varint can not be negative.')
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_varint(buf, offset=0):
+    """
+    decode an integer written by encode_varint()
+    :param buf: bytes or a memoryview
+    :param offset: position of the first byte of the varint
+    :return: the integer and the position right after it
+    """
+    n = 0
+    shift = 0
+    while True:
+        if offset >= len(buf):
+            raise ValueError('Truncated varint.')
+        byte = buf[offset]
+        offset += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, offset
+        shift += 7
+
+
+def hash_to_digest(h):
+    """
+    convert a hash to its raw digest, hashes are passed around as hex strings outside of the tree
+    :param h: a hash in hex string, or a digest in bytes
+    :return: the digest in bytes
+    """
+    if isinstance(h, str):
+        return bytes.fromhex(h)
+    return bytes(h)
 
 
 class MerkleTreeNode:
 
-    def __init__(self, h, depth=0, left=None, right=None):
+    def __init__(self, tree, depth=0, index=0):
         """
-        Initialize a merkle tree node
-        :param h: hash value stored in this node
+        Initialize a view of one node in a merkle tree. The hashes live in the level arrays of the tree, the node only
+        remembers where to look them up.
+        :param tree: the merkle tree the node belongs to
         :param depth: the depth of the node, 0 for the root node
-        :param left: left node
-        :param right:  right node
+        :param index: the position of the node within its level, counted from the left
         """
+        self.tree = tree
         self.depth = depth
-        self.hash = h
-        self.parent = None
-        self.left = left
-        self.right = right
+        self.index = index
+
+    @property
+    def hash(self):
+        """
+        :return: hash value stored in this node in hex string
+        """
+        return self.digest.hex()
+
+    @property
+    def digest(self):
+        """
+        :return: hash value stored in this node in bytes
+        """
+        return self.tree.levels[self.tree.height - self.depth][self.index]
+
+    @property
+    def parent(self):
+        """
+        :return: the parent node, None for the root node
+        """
+        if self.is_root():
+            return None
+        return MerkleTreeNode(self.tree, self.depth - 1, self.index // 2)
+
+    @property
+    def left(self):
+        """
+        :return: the left child, None for a leaf node
+        """
+        if self.depth == self.tree.height:
+            return None
+        return MerkleTreeNode(self.tree, self.depth + 1, 2 * self.index)
+
+    @property
+    def right(self):
+        """
+        :return: the right child, None for a leaf node
+        """
+        if self.depth == self.tree.height:
+            return None
+        return MerkleTreeNode(self.tree, self.depth + 1, 2 * self.index + 1)
 
     def is_root(self):
         """
         :return: true if the node is the root
         """
-        return self.parent is None
+        return self.depth == 0
 
     def has_left(self):
         return self.left is not None
@@ -36,10 +202,7 @@ class MerkleTreeNode:
         """
         :return: true if the node is a leaf node
         """
-        return self.has_left() and self.has_right()
-
-    def set_parent(self, parent):
-        self.parent = parent
+        return not self.has_left() and not self.has_right()
 
 
 "---------------------------------------------------------------------------------------------------------------------"
@@ -48,122 +211,187 @@ class MerkleTreeNode:
 # noinspection PyTypeChecker
 class MerkleTree:
 
-    def __init__(self, tx_list):
+    def __init__(self, tx_list, version=HASH_VERSION_BYTES, executor=None):
         """
         Initialize a merkle tree.
         :param tx_list: a list of transactions in string format
+        :param version: the scheme used to hash two nodes together, HASH_VERSION_HEX to reproduce legacy roots
+        :param executor: a thread or process pool from concurrent.futures, to hash the leaves and the lower levels of
+        large trees in parallel. The tree is the same as the one built on a single thread.
         """
-        self.tx_list = tx_list
-        self.root = ''
+        self.version = version
+        self.executor = executor
+        self.tx_list = list(tx_list)  # a copy, extend() appends to it
+        self.tx_hashes = []  # hashes of the transactions, without the copies added for padding
+        self.tx_index = {}  # hash of a tx -> position of its first occurrence in the transaction list
+        self.levels = []  # digests of every level, levels[0] holds the leaves and levels[-1] holds the root
+        self.height = 0
+        self.root = None
         self.build_tree()
 
     def build_tree(self):
         """
         Build the merkle tree from the transaction list.
+        The tree is stored level by level in flat arrays. The children of node i are at 2i and 2i + 1 on the level
+        below, its parent is at i // 2 on the level above.
         """
-        list_length = len(self.tx_list)
-        tx_list_copy = self.tx_list.copy()
-
-        # calculate the required number of leaf nodes
-        leaf_number = next(n for n in [2 ** i for i in range(10)] if n >= list_length)
-
-        tree_height = int(log2(leaf_number))  # calculate the height of the tree
-        # shuffle(tx_list_copy)  # shuffle the transactions
+        if len(self.tx_list) == 0:
+            raise RuntimeError('Cannot build a merkle tree from an empty transaction list.')
 
-        # start building the tree from the transactions
-        nodes = []
-        for i in range(tree_height):
-            # for the transaction layer
-            if i == 0:
-                j = 0
-                while j < list_length:
-                    tx_string = tx_list_copy.pop(0)  # pop one transaction from the list
-                    curr_hash = self.calculate_hash(tx_string)  # calculate hash
-                    nodes.append(MerkleTreeNode(curr_hash, tree_height - i))  # create the node and add to node array
-
-                    # for first (leaf_number - list_length) transactions, add another copy of each tx to the node array
-                    if j < leaf_number - list_length:
-                        nodes.append(MerkleTreeNode(curr_hash, tree_height - i))
+        if self.executor is not None and len(self.tx_list) >= PARALLEL_MIN_TXS:
+            digests = []
+            for chunk in self.executor.map(hash_tx_chunk, split_chunks(self.tx_list, TX_CHUNK_MIN)):
+                digests.extend(chunk)
+        else:
+            digests = hash_tx_chunk(self.tx_list)
 
-                    j += 1
+        self.tx_hashes = []
+        self.tx_index = {}
+        for digest in digests:
+            self.__add_tx_hash(digest)
 
-            # for non transaction layer
-            else:
-                nodes_copy = nodes.copy()  # copy hashes from previous layer
-                nodes_length = len(nodes)
-                nodes.clear()  # clear the node array
+        self.__update_levels(0, self.executor)
+        self.root = MerkleTreeNode(self)
 
-                # hash hashes in pair of 2
-                j = 0
-                while j < nodes_length / 2:
-                    # pop 2 nodes from the node array
-                    node_left = nodes_copy.pop(0)
-                    node_right = nodes_copy.pop(0)
+    def append(self, tx):
+        """
+        Add one transaction to the end of the transaction list and update the tree
+        :param tx: a transaction in string format
+        """
+        self.extend([tx])
 
-                    # hash the two nodes together
-                    curr_hash = self.calculate_hash(node_left.hash + node_right.hash)
+    def extend(self, tx_list):
+        """
+        Add transactions to the end of the transaction list and update the tree. Only the new transactions are hashed,
+        the tree is updated from the first leaf that changed, and the nodes on its left are kept.
+        :param tx_list: a list of transactions in string format
+        """
+        if len(tx_list) == 0:
+            return
+        leaf_number = len(self.levels[0])
 
-                    # using the hash to create a new node, add to array
-                    nodes.append(MerkleTreeNode(curr_hash, tree_height - i, node_left, node_right))
+        for tx_string in tx_list:
+            self.tx_list.append(tx_string)
+            self.__add_tx_hash(self.calculate_digest(tx_string.encode('utf-8')))
 
-                    # set the parent of the two children nodes
-                    node_left.set_parent(nodes[-1])
-                    node_right.set_parent(nodes[-1])
-                    j += 1
+        if self.calculate_leaf_number(len(self.tx_hashes)) != leaf_number:
+            # the tree grows one level, the padding of every leaf changes
+            self.__update_levels(0)
+        else:
+            # the leaves before the last padded tx keep their place, everything after shifts to the left
+            self.__update_levels(2 * self.padding + 1)
 
-            # print out the tree
-            # for node in nodes:
-            #     print(node.hash)
-            # print('\n--')
+    @property
+    def padding(self):
+        """
+        :return: the number of transactions at the front of the list that have a second copy in the leaf level
+        """
+        return len(self.levels[0]) - len(self.tx_hashes)
 
-        # final step, calculate the root hash
-        if len(nodes) == 2:
+    def __add_tx_hash(self, tx_hash):
+        """
+        a private method that records the hash of a tx appended to the transaction list
+        :param tx_hash: hash value of a tx in bytes
+        """
+        # a tx that appears twice in the block is found at its first occurrence
+        self.tx_index.setdefault(tx_hash, len(self.tx_hashes))
+        self.tx_hashes.append(tx_hash)
 
-            # pop two nodes from the beginning of the list
-            node_left = nodes.pop(0)
-            node_right = nodes.pop(0)
+    def __update_levels(self, first, executor=None):
+        """
+        a private method that recalculates the leaves from a given index, and the nodes above them, from the hashes of
+        the transactions
+        :param first: index of the first leaf that changed, 0 to rebuild the whole tree
+        :param executor: a pool to hash the large levels of a rebuild in parallel, None to hash on this thread
+        """
+        # calculate the required number of leaf nodes, the smallest power of 2 that holds all transactions
+        leaf_number = self.calculate_leaf_number(len(self.tx_hashes))
+        if first == 0:
+            self.height = leaf_number.bit_length() - 1  # calculate the height of the tree
+            self.levels = [[] for _ in range(self.height + 1)]
+
+        # for first (leaf_number - list_length) transactions, add another copy of each tx to the leaf level
+        padding = leaf_number - len(self.tx_hashes)
+        tx_hashes = self.tx_hashes
+        self.levels[0][first:] = [tx_hashes[j >> 1] if j < 2 * padding else tx_hashes[j - padding]
+                                  for j in range(first, leaf_number)]
+
+        # hash hashes in pair of 2 until only the root is left
+        hash_pair = get_hash_pair(self.version)
+        for level in range(1, self.height + 1):
+            first >>= 1
+            nodes = self.levels[level - 1]
+            if executor is not None and first == 0 and len(nodes) >= PARALLEL_MIN_NODES:
+                parents = []
+                chunks = split_chunks(nodes, NODE_CHUNK_MIN)
+                for chunk in executor.map(hash_level_chunk, chunks, repeat(self.version)):
+                    parents.extend(chunk)
+                self.levels[level] = parents
+                continue
+            self.levels[level][first:] = [hash_pair(nodes[2 * j], nodes[2 * j + 1])
+                                          for j in range(first, len(nodes) >> 1)]
 
-            # calculate their hash
-            root_hash = self.calculate_hash(node_left.hash + node_right.hash)
+    @staticmethod
+    def calculate_leaf_number(list_length):
+        """
+        Calculate the number of leaf nodes required for a number of transactions
+        :param list_length: the number of transactions
+        :return: the smallest power of 2 that is no less than the number of transactions, and at least 2
+        """
+        return 1 << max(1, (list_length - 1).bit_length())
 
-            # create the root node
-            self.root = MerkleTreeNode(root_hash, left=node_left, right=node_right)
-        else:
-            # raise runtime error, this is very unlikely to happen
-            raise RuntimeError("Error occurred during merkle tree building process. Hashes didn't converge to one root")
+    @staticmethod
+    def path_to_index(path):
+        """
+        Convert the path of a leaf to its position in the leaf level
+        :param path: a list that indicate the path of a node, like [1, -1, -1, 1]
+        :return: the index of the node in its level
+        """
+        index = 0
+        for direction in path:
+            if direction == -1:
+                index <<= 1
+            elif direction == 1:
+                index = (index << 1) | 1
+            else:
+                raise RuntimeError('Input path incorrect.')
+        return index
 
-    def find_tx_path(self, tx_hash):
+    @staticmethod
+    def index_to_path(index, height):
         """
-        traverse the tree to find a tx
-        :param tx_hash:
-        :return: the path of a tx
+        Convert the position of a node to the path from the root
+        :param index: the index of the node in its level
+        :param height: the depth of the node
+        :return: a list that indicate the path of the node, like [1, -1, -1, 1]
         """
-        # find the path recursively
-        path = self.__find_tx_path_recursive(self.root, tx_hash)
+        return [1 if (index >> i) & 1 else -1 for i in range(height - 1, -1, -1)]
 
-        # if the tx is found, remove the ending 0 from the path
-        if len(path) > 0:
-            path.pop()
-        return path
+    def find_tx_index(self, tx_hash):
+        """
+        look up the leaf of a tx
+        :param tx_hash: hash value of a tx, in hex string or bytes
+        :return: the index of the leftmost leaf holding the tx, None if the tx hash is not in the tree
+        """
+        try:
+            position = self.tx_index.get(hash_to_digest(tx_hash))
+        except ValueError:
+            return None
+        if position is None:
+            return None
+        padding = self.padding
+        return 2 * position if position < padding else position + padding
 
-    def __find_tx_path_recursive(self, root, tx_hash):
+    def find_tx_path(self, tx_hash):
         """
-        a private recursive method that traverse the tree to find the path of a tx
-        :param root:
-        :param tx_hash: hash value of a tx
-        :return: empty list if the tx hash is not in the tree
+        look up the leaf of a tx and convert its index to a path
+        :param tx_hash:
+        :return: the path of a tx, empty list if the tx hash is not in the tree
         """
-        if root is None:
+        index = self.find_tx_index(tx_hash)
+        if index is None:
             return []
-        if root.hash == tx_hash:
-            return [0]
-        res = self.__find_tx_path_recursive(root.left, tx_hash)
-        if res:
-            return [-1] + res
-        res = self.__find_tx_path_recursive(root.right, tx_hash)
-        if res:
-            return [1] + res
-        return []
+        return self.index_to_path(index, self.height)
 
     def find_node_from_path(self, path):
         """
@@ -171,15 +399,9 @@ class MerkleTree:
         :param path: a list that indicate the path of a node, like [1, -1, -1, 1]
         :return: the merkle tree node
         """
-        node = self.root
-        for direction in path:
-            if direction == -1:
-                node = node.left
-            elif direction == 1:
-                node = node.right
-            else:
-                raise RuntimeError('Input path incorrect.')
-        return node
+        if len(path) > self.height:
+            raise RuntimeError('Input path incorrect.')
+        return MerkleTreeNode(self, len(path), self.path_to_index(path))
 
     def find_hashes_for_confirmation(self, tx_path):
         """
@@ -187,14 +409,105 @@ class MerkleTree:
         :param tx_path: the path of the tx we want to verify
         :return: hashes
         """
-        paths = self.calculate_hash_paths(tx_path)
+        depth = len(tx_path)
+        index = self.path_to_index(tx_path)
+
+        # walk from the node up to the root, collect the sibling on every level
         hashes = []
-        for path in paths:
-            print(path)
-            node = self.find_node_from_path(path)
-            hashes.append(node.hash)
+        for level in range(self.height - depth, self.height):
+            hashes.append(self.levels[level][index ^ 1].hex())
+            index >>= 1
         return hashes
 
+    def find_multiproof(self, tx_hashes):
+        """
+        find the hashes required to verify several txs of this tree at once. A sibling that can be computed from the
+        other txs, or that is shared by several of them, is not repeated.
+        :param tx_hashes: hash values of the txs we want to verify
+        :return: the paths of the txs, in the order given, and the hashes ordered level by level from the leaves up and
+        from left to right within a level
+        """
+        tx_paths = []
+        indices = set()
+        for tx_hash in tx_hashes:
+            index = self.find_tx_index(tx_hash)
+            if index is None:
+                raise RuntimeError('Transaction ' + str(tx_hash) + ' is not in the merkle tree.')
+            tx_paths.append(self.index_to_path(index, self.height))
+            indices.add(index)
+
+        # on every level, a sibling is only needed when it is not one of the nodes we can compute
+        hashes = []
+        for level in range(self.height):
+            for index in sorted(indices):
+                if index ^ 1 not in indices:
+                    hashes.append(self.levels[level][index ^ 1].hex())
+            indices = {index >> 1 for index in indices}
+        return tx_paths, hashes
+
+    def find_compact_proof(self, tx_hash):
+        """
+        find the proof of a tx in the binary format of encode_proof()
+        :param tx_hash: hash value of the tx we want to verify
+        :return: the proof in bytes
+        """
+        index = self.find_tx_index(tx_hash)
+        if index is None:
+            raise RuntimeError('Transaction ' + str(tx_hash) + ' is not in the merkle tree.')
+
+        siblings = []
+        node = index
+        for level in range(self.height):
+            siblings.append(self.levels[level][node ^ 1])
+            node >>= 1
+        return self.encode_proof(index, len(self.tx_hashes), siblings)
+
+    @staticmethod
+    def encode_proof(tx_index, tx_number, hashes):
+        """
+        Encode a proof in binary: the leaf index and the number of transactions in the tree as varints, followed by the
+        32 bytes of every sibling from the leaf up. The path is given by the bits of the index and the number of
+        siblings by the size of the tree.
+        :param tx_index: index of the leaf of the tx
+        :param tx_number: number of transactions in the tree
+        :param hashes: the sibling hashes from the leaf up, in hex string or bytes
+        :return: the proof in bytes
+        """
+        out = bytearray(encode_varint(tx_index))
+        out += encode_varint(tx_number)
+        for h in hashes:
+            out += hash_to_digest(h)
+        return bytes(out)
+
+    @staticmethod
+    def decode_proof(proof):
+        """
+        Decode a proof written by encode_proof()
+        :param proof: the proof in bytes
+        :return: the path of the tx and the hashes in hex string, as used by confirm_tx()
+        """
+        tx_index, height, view = MerkleTree.__read_proof(proof)
+        hashes = [view[32 * i:32 * (i + 1)].hex() for i in range(height)]
+        return MerkleTree.index_to_path(tx_index, height), hashes
+
+    @staticmethod
+    def __read_proof(proof):
+        """
+        a private method that reads the header of a binary proof
+        :param proof: the proof in bytes, or a memoryview
+        :return: the leaf index, the height of the tree and a memoryview of the siblings
+        """
+        view = memoryview(proof)
+        tx_index, offset = decode_varint(view)
+        tx_number, offset = decode_varint(view, offset)
+        if tx_number == 0:
+            raise ValueError('A proof needs at least one transaction in the tree.')
+        leaf_number = MerkleTree.calculate_leaf_number(tx_number)
+        height = leaf_number.bit_length() - 1
+        if tx_index >= leaf_number or len(view) - offset != 32 * height:
+            raise ValueError('Malformed merkle proof.')
+        return tx_index, height, view[offset:]
+
     @staticmethod
     def calculate_hash_paths(path):
         """
@@ -237,27 +550,167 @@ class MerkleTree:
         return hash_func.hexdigest()
 
     @staticmethod
-    def confirm_tx(tx_hash, tx_path, merkle_root, hashes):
+    def calculate_digest(data):
+        """
+        calculate the raw hash of some bytes
+        :param data: bytes, like the utf-8 encoding of a transaction
+        :return: a 32 bytes hash value
+        """
+        return sha256(data).digest()
+
+    @staticmethod
+    def confirm_tx(tx_hash, tx_path, merkle_root, hashes, version=HASH_VERSION_BYTES):
         """
         Confirm if a transaction is in one block
         :param tx_hash: hash of the tx
         :param tx_path: path of the tx
-        :param merkle_root: the merkle root in a header of the block
+        :param merkle_root: the merkle root in a header of the block, a hash or a merkle tree node
         :param hashes: the corresponding tx hashes given by the full node
+        :param version: the merkle hash version of the block
         :return: true if the tx exist under given merkle root and hashes
         """
-        tx_path.reverse()  # reverse the path
+        hash_pair = get_hash_pair(version)
 
-        txhs = tx_hash
-        # hash the tx all the way up to get the merkle root
+        txhs = hash_to_digest(tx_hash)
+        # hash the tx all the way up to get the merkle root, reading the path from the end
         for i, h in enumerate(hashes):
-            if tx_path[i] == -1:
-                txhs = MerkleTree.calculate_hash(txhs + h)
+            if tx_path[-1 - i] == -1:
+                txhs = hash_pair(txhs, hash_to_digest(h))
             else:
-                txhs = MerkleTree.calculate_hash(h + txhs)
+                txhs = hash_pair(hash_to_digest(h), txhs)
 
         # check if the resulting hash equals the merkle root
-        return txhs == merkle_root.hash
+        return txhs == hash_to_digest(getattr(merkle_root, 'hash', merkle_root))
+
+    @staticmethod
+    def confirm_compact_proof(tx_hash, proof, merkle_root, version=HASH_VERSION_BYTES):
+        """
+        Confirm if a transaction is in one block with a binary proof. The siblings are hashed straight from the proof
+        buffer without copying them.
+        :param tx_hash: hash of the tx
+        :param proof: the proof in the format of encode_proof(), in bytes or a memoryview
+        :param merkle_root: the merkle root in a header of the block, a hash or a merkle tree node
+        :param version: the merkle hash version of the block
+        :return: true if the tx exist under given merkle root and proof
+        """
+        hash_pair = get_hash_pair(version)
+        try:
+            index, height, siblings = MerkleTree.__read_proof(proof)
+        except ValueError:
+            return False
+
+        txhs = hash_to_digest(tx_hash)
+        for i in range(height):
+            sibling = siblings[32 * i:32 * (i + 1)]
+            if index & 1:
+                txhs = hash_pair(sibling, txhs)
+            else:
+                txhs = hash_pair(txhs, sibling)
+            index >>= 1
+        return txhs == hash_to_digest(getattr(merkle_root, 'hash', merkle_root))
+
+    @staticmethod
+    def confirm_txs(proofs, merkle_root, version=HASH_VERSION_BYTES):
+        """
+        Confirm many transactions of one block, each with its own proof. Nodes proved by an earlier proof are
+        remembered by their position, so a later proof stops hashing as soon as it reaches one of them.
+        :param proofs: a list of (tx hash, tx path, hashes) tuples, as used by confirm_tx()
+        :param merkle_root: the merkle root in a header of the block, a hash or a merkle tree node
+        :param version: the merkle hash version of the block
+        :return: a list of booleans, true if the tx at the same position exists under given merkle root and hashes
+        """
+        hash_pair = get_hash_pair(version)
+
+        # (depth, index) -> digest of the nodes known to be in the tree, the root is the first one
+        verified = {(0, 0): hash_to_digest(getattr(merkle_root, 'hash', merkle_root))}
+        height = None  # the level of the txs, known once a proof reached the root
+        results = []
+        for tx_hash, tx_path, hashes in proofs:
+            # all txs of a block sit on the same level, and need one hash for every level above it. A bad proof
+            # fails alone, it does not decide the level for the others.
+            if len(tx_path) != len(hashes) or (height is not None and len(tx_path) != height):
+                results.append(False)
+                continue
+
+            depth = len(tx_path)
+            try:
+                index = MerkleTree.path_to_index(tx_path)
+                txhs = hash_to_digest(tx_hash)
+                visited = []
+                for h in hashes:
+                    if (depth, index) in verified:
+                        break
+                    sibling = hash_to_digest(h)
+                    visited.append(((depth, index), txhs))
+                    visited.append(((depth, index ^ 1), sibling))
+                    if index & 1:
+                        txhs = hash_pair(sibling, txhs)
+                    else:
+                        txhs = hash_pair(txhs, sibling)
+                    depth -= 1
+                    index >>= 1
+            except (ValueError, TypeError):
+                results.append(False)
+                continue
+
+            # the proof holds if it joins a known node with the same hash, every node it passed is then known too
+            confirmed = verified.get((depth, index)) == txhs
+            if confirmed:
+                verified.update(visited)
+                height = len(tx_path)
+            results.append(confirmed)
+        return results
+
+    @staticmethod
+    def confirm_multiproof(tx_hashes, tx_paths, merkle_root, hashes, version=HASH_VERSION_BYTES):
+        """
+        Confirm if several transactions are in one block, hashing every node up to the root only once
+        :param tx_hashes: hashes of the txs
+        :param tx_paths: paths of the txs, in the same order as the hashes
+        :param merkle_root: the merkle root in a header of the block, a hash or a merkle tree node
+        :param hashes: the hashes given by the full node with find_multiproof()
+        :param version: the merkle hash version of the block
+        :return: true if all txs exist under given merkle root and hashes
+        """
+        if len(tx_hashes) == 0 or len(tx_hashes) != len(tx_paths):
+            return False
+        hash_pair = get_hash_pair(version)
+
+        height = len(tx_paths[0])
+        nodes = {}
+        for tx_hash, tx_path in zip(tx_hashes, tx_paths):
+            if len(tx_path) != height:
+                return False
+            index = MerkleTree.path_to_index(tx_path)
+            tx_hash = hash_to_digest(tx_hash)
+
+            # two different txs can not sit on the same leaf
+            if nodes.setdefault(index, tx_hash) != tx_hash:
+                return False
+
+        # hash the nodes level by level, taking the missing siblings from the proof in order
+        hashes = iter([hash_to_digest(h) for h in hashes])
+        for _ in range(height):
+            parents = {}
+            for index in sorted(nodes):
+                if index >> 1 in parents:
+                    continue  # already hashed together with its left sibling
+                if index ^ 1 in nodes:
+                    sibling = nodes[index ^ 1]
+                else:
+                    sibling = next(hashes, None)
+                    if sibling is None:
+                        return False
+                if index & 1:
+                    parents[index >> 1] = hash_pair(sibling, nodes[index])
+                else:
+                    parents[index >> 1] = hash_pair(nodes[index], sibling)
+            nodes = parents
+
+        # every hash of the proof must be used, and the nodes must converge to the root
+        if next(hashes, None) is not None:
+            return False
+        return nodes.get(0) == hash_to_digest(getattr(merkle_root, 'hash', merkle_root))
 
 
 "---------------------------------------------------------------------------------------------------------------------"
@@ -287,16 +740,64 @@ def test():
     print(path)
 
     print('\nMerkle proof node paths: ')
-    s = tree.find_hashes_for_confirmation(path.copy())
+    for p in tree.calculate_hash_paths(path.copy()):
+        print(p)
+
+    s = tree.find_hashes_for_confirmation(path)
     print('\nMerkle proof node hashes: ')
     print(s)
 
     print('\nMerkle root: ')
-    # print(tree.root.hash)
+    print(tree.root.hash)
 
     # noinspection PyTypeChecker
     print(tree.confirm_tx(ha, path, tree.root, s))
 
+    print('\nMultiproof for three transactions: ')
+    tx_hashes = [tree.calculate_hash(tx) for tx in ['123', 'def', 'mno']]
+    paths, hashes = tree.find_multiproof(tx_hashes)
+    print(paths)
+    print(len(hashes), 'hashes')
+    print(tree.confirm_multiproof(tx_hashes, paths, tree.root, hashes))
+
+    print('\nAppend transactions one by one: ')
+    streamed = MerkleTree(tx_list[:1])
+    for tx in tx_list[1:]:
+        streamed.append(tx)
+    print(streamed.root.hash == tree.root.hash)
+
+    print('\nLegacy hex hashing: ')
+    legacy = MerkleTree(tx_list, version=HASH_VERSION_HEX)
+    print(legacy.root.hash)
+    legacy_path = legacy.find_tx_path(ha)
+    legacy_hashes = legacy.find_hashes_for_confirmation(legacy_path)
+    print(legacy.confirm_tx(ha, legacy_path, legacy.root, legacy_hashes, version=HASH_VERSION_HEX))
+
+    print('\nBatch verification: ')
+    proofs = []
+    for tx in tx_list:
+        tx_hash = tree.calculate_hash(tx)
+        tx_path = tree.find_tx_path(tx_hash)
+        proofs.append((tx_hash, tx_path, tree.find_hashes_for_confirmation(tx_path)))
+    proofs.append((tree.calculate_hash('stu'), path, s))
+    print(tree.confirm_txs(proofs, tree.root))
+
+    # a truncated or malformed proof first in the batch fails alone
+    print(tree.confirm_txs([(proofs[0][0], proofs[0][1][:-1], proofs[0][2][:-1])] + proofs[1:5], tree.root))
+    print(tree.confirm_txs([(proofs[0][0], proofs[0][1], ['zz'] * len(proofs[0][2]))] + proofs[1:5], tree.root))
+
+    print('\nCompact proof: ')
+    compact = tree.find_compact_proof(ha)
+    print(compact.hex())
+    print(len(compact), 'bytes')
+    print(tree.decode_proof(compact) == (path, s))
+    print(tree.confirm_compact_proof(ha, memoryview(compact), tree.root.hash))
+
+    print('\nExtend: ')
+    grown = MerkleTree(tx_list)
+    grown.append('stu')
+    print(len(tx_list), grown.root.hash == MerkleTree(tx_list + ['stu']).root.hash)
+
 
 if __name__ == "__main__":
     test()
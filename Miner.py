@@ -0,0 +1,190 @@
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from hashlib import sha256
+from multiprocessing import Value
+from os import cpu_count
+from time import perf_counter
+
+from BlockHeader import HEADER
+
+NONCE_LIMIT = 1 << 64  # the nonce is an unsigned 64 bits integer
+NO_CHUNK = (1 << 63) - 1
+
+# set in every worker process by init_worker(), the index of the first chunk where a nonce was found
+found_chunk = None
+
+
+def target_from_difficulty(difficulty):
+    """
+    Calculate the target of a difficulty, the hash of a header must not be above the target
+    :param difficulty: number of leading zero bits the hash of a header must have
+    :return: the target as 32 bytes big endian, hashes compare with it as bytes
+    """
+    return ((1 << (256 - difficulty)) - 1).to_bytes(32, 'big')
+
+
+def check_pow(header, difficulty):
+    """
+    Check the proof of work of a block header
+    :param header: a block header object
+    :param difficulty: number of leading zero bits the hash of the header must have
+    :return: true if the hash of the header is not above the target
+    """
+    return bytes.fromhex(header.hash) <= target_from_difficulty(difficulty)
+
+
+def init_worker(shared_found_chunk):
+    """
+    Keep the shared chunk index in the worker process, so the search of a chunk can stop early
+    :param shared_found_chunk: a multiprocessing Value
+    """
+    global found_chunk
+    found_chunk = shared_found_chunk
+
+
+def search_nonces(prefix, target, start, stop, chunk=0, check_every=4096):
+    """
+    Search a range of nonces. The 72 bytes before the nonce are hashed once, and every attempt continues from a copy
+    of that state with the 8 bytes of the nonce.
+    :param prefix: the binary header without its nonce
+    :param target: the target in bytes
+    :param start: first nonce
+    :param stop: the nonce after the last one
+    :param chunk: index of the range, the search stops when a nonce is found in a range with a lower index
+    :param check_every: number of attempts between two checks of the other workers
+    :return: the first nonce with a hash not above the target, None if there is none, and the number of attempts
+    """
+    midstate = sha256(prefix)
+    nonce = start
+    while nonce < stop:
+        if found_chunk is not None and found_chunk.value < chunk:
+            break
+        for nonce in range(nonce, min(nonce + check_every, stop)):
+            h = midstate.copy()
+            h.update(nonce.to_bytes(8, 'big'))
+            if h.digest() <= target:
+                return nonce, nonce - start + 1
+        nonce += 1
+    return None, nonce - start
+
+
+class Miner:
+    """
+    Proof of work nonce search, split over a pool of processes. The nonce space is cut in chunks handed out in order,
+    the result is the lowest valid nonce whatever the number of workers.
+    """
+
+    def __init__(self, difficulty=16, workers=None, chunk_size=1 << 16):
+        """
+        Initialize a miner
+        :param difficulty: number of leading zero bits the hash of a header must have
+        :param workers: number of processes, 1 to search in this process, the number of cores by default
+        :param chunk_size: number of nonces in a chunk
+        """
+        self.difficulty = difficulty
+        self.target = target_from_difficulty(difficulty)
+        self.workers = workers or cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.executor = None
+        self.found_chunk = None
+
+        # statistics of the last search
+        self.attempts = 0
+        self.elapsed = 0.0
+
+    @property
+    def hashrate(self):
+        """
+        :return: hashes per second of the last search
+        """
+        return self.attempts / self.elapsed if self.elapsed else 0.0
+
+    def mine(self, header, start_nonce=0, max_nonce=NONCE_LIMIT):
+        """
+        Search a nonce for a block header, and set it on the header
+        :param header: a block header object
+        :param start_nonce: first nonce to try
+        :param max_nonce: the nonce after the last one to try
+        :return: the nonce, None if there is no valid nonce in the range
+        """
+        prefix = header.to_bytes[:HEADER.size - 8]
+        started = perf_counter()
+        self.attempts = 0
+
+        chunks = range(start_nonce, max_nonce, self.chunk_size)
+        if self.workers == 1:
+            nonce = None
+            for start in chunks:
+                nonce, attempts = search_nonces(prefix, self.target, start, min(start + self.chunk_size, max_nonce))
+                self.attempts += attempts
+                if nonce is not None:
+                    break
+        else:
+            nonce = self.__mine_parallel(prefix, chunks, max_nonce)
+
+        self.elapsed = perf_counter() - started
+        if nonce is not None:
+            header.nonce = nonce
+        return nonce
+
+    def close(self):
+        """
+        Stop the worker processes
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __mine_parallel(self, prefix, chunks, max_nonce):
+        """
+        a private method that hands out the chunks to the pool, a few ahead of the workers. Once a nonce is found,
+        no chunk after it is started, and the running ones stop at their next check. The chunks before it still finish,
+        they might hold a lower nonce.
+        """
+        if self.executor is None:
+            self.found_chunk = Value('q', NO_CHUNK, lock=False)
+            self.executor = ProcessPoolExecutor(self.workers, initializer=init_worker, initargs=(self.found_chunk,))
+        self.found_chunk.value = NO_CHUNK
+
+        best = None  # (chunk index, nonce)
+        pending = {}
+        chunk = 0
+        while True:
+            while len(pending) < 2 * self.workers and chunk < len(chunks) and (best is None or chunk < best[0]):
+                start = chunks[chunk]
+                future = self.executor.submit(search_nonces, prefix, self.target, start,
+                                              min(start + self.chunk_size, max_nonce), chunk)
+                pending[future] = chunk
+                chunk += 1
+            if not pending:
+                return None if best is None else best[1]
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = pending.pop(future)
+                nonce, attempts = future.result()
+                self.attempts += attempts
+                if nonce is not None and (best is None or index < best[0]):
+                    best = (index, nonce)
+                    self.found_chunk.value = index
+
+
+# test cases
+def test():
+    from BlockHeader import BlockHeader, GENESIS_PREV_HASH
+
+    header = BlockHeader(GENESIS_PREV_HASH, 0, 'ab' * 32, 1546300800.0)
+
+    serial = Miner(difficulty=16, workers=1)
+    nonce = serial.mine(header)
+    print(nonce, header.hash, check_pow(header, 16))
+    print('%.0f hashes per second on 1 process' % serial.hashrate)
+
+    parallel = Miner(difficulty=16, workers=max(2, cpu_count() or 1), chunk_size=1 << 12)
+    header.nonce = 0
+    print(parallel.mine(header) == nonce)
+    print('%.0f hashes per second on %d processes' % (parallel.hashrate, parallel.workers))
+    parallel.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,451 @@
+import asyncio
+from collections import deque
+from struct import Struct
+
+# frame: body length, kind, request id and command length, followed by the command and the payload. Every message of
+# a connection is a frame, so many requests can wait for their responses on one connection at the same time.
+FRAME = Struct('>IBIB')
+MAX_FRAME = 16 * 1024 * 1024
+
+# kinds of frames
+KIND_REQUEST = 1
+KIND_RESPONSE = 2
+KIND_NOTIFY = 3  # a message without response
+KIND_ERROR = 4  # the response to a request that failed, the payload is the error message
+
+# roles of nodes, a full node listens and accepts both, a light weight node only connects to full nodes
+ROLE_FULL = 'full'
+ROLE_LIGHT = 'light'
+
+# commands
+CMD_HELLO = 'hello'  # payload: the role of the node, response: the role of the peer
+CMD_HEADERS = 'headers'  # payload: HEADERS_REQUEST, response: the binary headers from that height
+CMD_TX = 'tx'  # payload: a binary transaction, response: 1 if it was added to the mempool, else 0
+HEADERS_REQUEST = Struct('>QI')  # first height, maximum number of headers
+
+WRITE_BUFFER_LIMIT = 256 * 1024  # bytes buffered for a peer before the writers wait for it
+QUEUE_BYTES = 4 * 1024 * 1024  # payload bytes of the requests of a peer waiting to be served, past it they are refused
+
+
+def pack_frame(kind, request_id, command, payload=b''):
+    """
+    Build a frame
+    :param kind: one of the KIND_ constants
+    :param request_id: id matching a response to its request
+    :param command: the command in string format
+    :param payload: the payload in bytes
+    :return: the frame in bytes
+    """
+    command = command.encode('ascii')
+    body_len = FRAME.size - 4 + len(command) + len(payload)
+    return FRAME.pack(body_len, kind, request_id, len(command)) + command + payload
+
+
+async def read_frame(reader):
+    """
+    Read a frame
+    :param reader: an asyncio StreamReader
+    :return: kind, request id, command and payload
+    """
+    head = await reader.readexactly(FRAME.size)
+    body_len, kind, request_id, command_len = FRAME.unpack(head)
+    if body_len > MAX_FRAME or body_len < FRAME.size - 4 + command_len:
+        raise ValueError('Malformed frame.')
+    body = await reader.readexactly(body_len - (FRAME.size - 4))
+    return kind, request_id, body[:command_len].decode('ascii'), body[command_len:]
+
+
+class Connection:
+    """
+    Connection to a peer. Requests are multiplexed, each one waits for the response with its id. The requests of the
+    peer are served concurrently up to a limit, past it they wait in a queue, and past a budget of queued bytes they are
+    refused. Responses are always read, so a handler can itself make requests to the same peer. A slow peer makes the
+    writers wait once its buffer is full.
+    """
+
+    def __init__(self, network, reader, writer, max_in_flight=64):
+        """
+        Initialize a connection and start reading from it
+        :param network: the Network that handles the requests of the peer
+        :param reader: an asyncio StreamReader
+        :param writer: an asyncio StreamWriter
+        :param max_in_flight: number of requests of the peer served at the same time
+        """
+        self.network = network
+        self.reader = reader
+        self.writer = writer
+        self.writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_LIMIT)
+        self.address = writer.get_extra_info('peername')
+        self.role = None  # the role of the peer, known after the hello
+        self.pending = {}  # request id -> future of the response
+        self.next_id = 0
+        self.max_in_flight = max_in_flight
+        self.requests = deque()  # (kind, request id, command, payload) of the peer waiting for a worker
+        self.queued_bytes = 0
+        self.workers = 0
+        self.closed = False
+
+        # counters
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.refused = 0  # requests and notifications of the peer dropped because the queue was full
+
+        self.task = asyncio.ensure_future(self.__read_loop())
+
+    async def request(self, command, payload=b'', timeout=30):
+        """
+        Send a request and wait for the response
+        :param command: the command in string format
+        :param payload: the payload in bytes
+        :param timeout: seconds to wait for the response
+        :return: the payload of the response
+        """
+        self.next_id = (self.next_id + 1) & 0xffffffff
+        request_id = self.next_id
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            await self.__send(pack_frame(KIND_REQUEST, request_id, command, payload))
+            kind, payload = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(request_id, None)
+        if kind == KIND_ERROR:
+            raise RuntimeError(payload.decode('utf-8'))
+        return payload
+
+    async def notify(self, command, payload=b''):
+        """
+        Send a message without waiting for a response
+        :param command: the command in string format
+        :param payload: the payload in bytes
+        """
+        await self.__send(pack_frame(KIND_NOTIFY, 0, command, payload))
+
+    async def close(self):
+        """
+        Close the connection, the requests still waiting fail
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.network.forget(self)
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed.'))
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    async def __send(self, frame):
+        """
+        a private method that writes a frame, and waits while the buffer of the peer is full
+        """
+        if self.closed:
+            raise ConnectionError('Connection closed.')
+        self.writer.write(frame)
+        self.bytes_sent += len(frame)
+        await self.writer.drain()
+
+    async def __read_loop(self):
+        """
+        a private method that reads frames until the connection closes, and dispatches them
+        """
+        try:
+            while True:
+                kind, request_id, command, payload = await read_frame(self.reader)
+                self.bytes_received += FRAME.size + len(command) + len(payload)
+                if kind in (KIND_RESPONSE, KIND_ERROR):
+                    future = self.pending.get(request_id)
+                    if future is not None and not future.done():
+                        future.set_result((kind, payload))
+                else:
+                    self.__queue(kind, request_id, command, payload)
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, UnicodeDecodeError):
+            pass
+        finally:
+            await self.close()
+
+    def __queue(self, kind, request_id, command, payload):
+        """
+        a private method that queues a request of the peer, and starts a worker if there are less than max_in_flight.
+        The reader never waits here, a request past the budget gets a busy error and a notification is dropped.
+        """
+        if self.requests and self.queued_bytes + len(payload) > QUEUE_BYTES:
+            self.refused += 1
+            if kind == KIND_REQUEST:
+                asyncio.ensure_future(self.__refuse(request_id, command))
+            return
+        self.requests.append((kind, request_id, command, payload))
+        self.queued_bytes += len(payload)
+        if self.workers < self.max_in_flight:
+            self.workers += 1
+            asyncio.ensure_future(self.__work())
+
+    async def __work(self):
+        """
+        a private method that serves the queued requests until there are none left
+        """
+        try:
+            while self.requests and not self.closed:
+                kind, request_id, command, payload = self.requests.popleft()
+                self.queued_bytes -= len(payload)
+                await self.__serve(kind, request_id, command, payload)
+        finally:
+            self.workers -= 1
+
+    async def __refuse(self, request_id, command):
+        """
+        a private method that answers a request with a busy error
+        """
+        try:
+            await self.__send(pack_frame(KIND_ERROR, request_id, command, b'Busy.'))
+        except ConnectionError:
+            pass
+
+    async def __serve(self, kind, request_id, command, payload):
+        """
+        a private method that runs the handler of a request and sends its response
+        """
+        try:
+            response = await self.network.handle(self, command, payload)
+            if kind == KIND_REQUEST:
+                await self.__send(pack_frame(KIND_RESPONSE, request_id, command, response or b''))
+        except ConnectionError:
+            pass
+        except Exception as e:
+            if kind == KIND_REQUEST and not self.closed:
+                await self.__send(pack_frame(KIND_ERROR, request_id, command, str(e).encode('utf-8')))
+            if command == CMD_HELLO:
+                await self.close()
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class Network:
+    """
+    The peers of a node, over asyncio streams so one node serves thousands of connections without a thread for each.
+    Connections are kept open and reused, and the number of peers of each role is bounded.
+    """
+
+    def __init__(self, role, heavy_peers_limit=10, light_peers_limit=10, heavy_peers=None, light_peers=None,
+                 max_in_flight=64):
+        """
+        Initialize a network
+        :param role: ROLE_FULL or ROLE_LIGHT, the role of this node
+        :param heavy_peers_limit: number of full nodes to be connected to
+        :param light_peers_limit: number of light weight nodes to accept
+        :param heavy_peers: the list of connections to full nodes, shared with the node
+        :param light_peers: the list of connections to light weight nodes, shared with the node
+        :param max_in_flight: number of requests of a peer served at the same time
+        """
+        self.role = role
+        self.heavy_peers_limit = heavy_peers_limit
+        self.light_peers_limit = light_peers_limit
+        self.heavy_peers = [] if heavy_peers is None else heavy_peers
+        self.light_peers = [] if light_peers is None else light_peers
+        self.max_in_flight = max_in_flight
+        self.handlers = {}  # command -> coroutine function (connection, payload) returning the response payload
+        self.pool = {}  # (host, port) -> connection to a full node
+        self.server = None
+        self.handshakes = set()  # inbound connections before their hello
+        self.close_handlers = []  # functions called with every connection that closes
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        Start accepting connections
+        :param host: the address to listen on
+        :param port: the port to listen on, 0 for any free port
+        :return: the address and the port listened on
+        """
+        self.server = await asyncio.start_server(self.__accept, host, port)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def connect(self, host, port):
+        """
+        Connect to a full node, or reuse the open connection to it
+        :param host: address of the node
+        :param port: port of the node
+        :return: the connection
+        """
+        connection = self.pool.get((host, port))
+        if connection is not None and not connection.closed:
+            return connection
+        if len(self.heavy_peers) >= self.heavy_peers_limit:
+            raise RuntimeError('Too many full node peers.')
+
+        reader, writer = await asyncio.open_connection(host, port)
+        connection = Connection(self, reader, writer, self.max_in_flight)
+        try:
+            role = (await connection.request(CMD_HELLO, self.role.encode('ascii'))).decode('ascii')
+        except Exception:
+            await connection.close()
+            raise
+        if role != ROLE_FULL:
+            await connection.close()
+            raise RuntimeError('Peer at ' + str(host) + ':' + str(port) + ' is not a full node.')
+        # a concurrent connect to the same peer might have finished first, its connection is kept
+        existing = self.pool.get((host, port))
+        if existing is not None and not existing.closed:
+            await connection.close()
+            return existing
+        if len(self.heavy_peers) >= self.heavy_peers_limit:
+            await connection.close()
+            raise RuntimeError('Too many full node peers.')
+
+        connection.role = role
+        self.heavy_peers.append(connection)
+        self.pool[(host, port)] = connection
+        return connection
+
+    async def handle(self, connection, command, payload):
+        """
+        Run the handler of a request, only a hello is served before the peer said hello
+        :param connection: the connection of the request
+        :param command: the command in string format
+        :param payload: the payload in bytes
+        :return: the payload of the response
+        """
+        if command == CMD_HELLO:
+            return self.__hello(connection, payload)
+        if connection.role is None:
+            raise RuntimeError('Hello expected.')
+        handler = self.handlers.get(command)
+        if handler is None:
+            raise RuntimeError('Unknown command ' + command + '.')
+        return await handler(connection, payload)
+
+    async def broadcast(self, command, payload, peers=None):
+        """
+        Send a message to peers without waiting for responses
+        :param command: the command in string format
+        :param payload: the payload in bytes
+        :param peers: the connections, all of them by default
+        """
+        peers = list(self.heavy_peers + self.light_peers if peers is None else peers)
+        await asyncio.gather(*(peer.notify(command, payload) for peer in peers), return_exceptions=True)
+
+    def forget(self, connection):
+        """
+        Remove a closed connection from the peers
+        :param connection: the connection
+        """
+        self.handshakes.discard(connection)
+        for handler in self.close_handlers:
+            handler(connection)
+        for peers in (self.heavy_peers, self.light_peers):
+            if connection in peers:
+                peers.remove(connection)
+        for key, pooled in list(self.pool.items()):
+            if pooled is connection:
+                del self.pool[key]
+
+    async def close(self):
+        """
+        Stop accepting connections and close all of them
+        """
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for connection in self.heavy_peers + self.light_peers + list(self.handshakes):
+            await connection.close()
+
+    async def __accept(self, reader, writer):
+        """
+        a private method called for every inbound connection
+        """
+        self.handshakes.add(Connection(self, reader, writer, self.max_in_flight))
+
+    def __hello(self, connection, payload):
+        """
+        a private method that admits a peer if there is room for its role
+        """
+        if connection.role is not None:
+            raise RuntimeError('Hello already received.')
+        role = payload.decode('ascii')
+        if self.role != ROLE_FULL:
+            raise RuntimeError('Only full nodes accept connections.')
+        if role == ROLE_FULL:
+            peers, limit = self.heavy_peers, self.heavy_peers_limit
+        elif role == ROLE_LIGHT:
+            peers, limit = self.light_peers, self.light_peers_limit
+        else:
+            raise RuntimeError('Unknown role ' + role + '.')
+        if len(peers) >= limit:
+            raise RuntimeError('Too many ' + role + ' node peers.')
+
+        self.handshakes.discard(connection)
+        connection.role = role
+        peers.append(connection)
+        return self.role.encode('ascii')
+
+
+# test cases
+def test():
+    from BlockHeader import BlockHeader
+    from FullNode import FullNode
+    from LightWeightNode import LightWeightNode
+    from Transaction import Tx
+
+    async def run():
+        full = FullNode()
+        full.light_peers_limit = 200
+        for i in range(500):
+            full.headers.append(BlockHeader(full.headers.tip_hash, i, '%064x' % i, 1546300800.0 + 600 * i))
+        host, port = await full.create_network().start()
+
+        # many light weight nodes on one full node, each with one connection and without a thread
+        lights = [LightWeightNode(difficulty=0) for _ in range(200)]
+        await asyncio.gather(*(light.find_peers([(host, port)]) for light in lights))
+        print(len(full.light_peers), all(len(light.peers_heavy) == 1 for light in lights))
+
+        # past the limit, a node is refused
+        late = LightWeightNode(difficulty=0)
+        try:
+            await late.find_peers([(host, port)])
+        except RuntimeError as e:
+            print(e)
+
+        # concurrent requests share the connection, and the headers download in batches
+        light = lights[0]
+        peer = light.peers_heavy[0]
+        print(await light.download_headers(peer, batch=64), light.headers.tip_hash == full.headers.tip_hash)
+        responses = await asyncio.gather(*(peer.request(CMD_HEADERS, HEADERS_REQUEST.pack(i, 1)) for i in range(100)))
+        print(all(responses[i] == bytes(full.headers.header_bytes(i)) for i in range(100)))
+
+        tx = Tx('connect', '00' * 64, '01' * 64, 'data')
+        print(await light.send_tx(tx), await light.send_tx(tx), tx.txid in full.mempool)
+
+        # handlers that make requests back to the same peer get their responses, even past max_in_flight
+        async def ping(connection, payload):
+            return await connection.request('echo', payload, timeout=2)
+
+        async def echo(connection, payload):
+            return payload
+
+        server = Network(ROLE_FULL, max_in_flight=2)
+        server.handlers['ping'] = ping
+        client = Network(ROLE_FULL, max_in_flight=2)
+        client.handlers['echo'] = echo
+        address = await server.start()
+        connections = await asyncio.gather(*(client.connect(*address) for _ in range(3)))
+        print(len(set(connections)), len(client.heavy_peers), len(client.pool))
+        connection = connections[0]
+        print(await asyncio.gather(*(connection.request('ping', b'%d' % i, timeout=5) for i in range(5))))
+        await client.close()
+        await server.close()
+
+        for light in lights:
+            await light.network.close()
+        await full.network.close()
+        print(len(full.light_peers))
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    test()
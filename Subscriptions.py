@@ -0,0 +1,256 @@
+from BloomFilter import BloomFilter, item_positions
+
+# commands, a light weight node sends the filter ones and a full node answers with the matching transactions
+CMD_FILTERLOAD = 'filterload'  # notify, payload: number of hashes in 1 byte, then the bits of the filter
+CMD_FILTERADD = 'filteradd'  # notify, payload: an item to add to the filter
+CMD_FILTERCLEAR = 'filterclear'  # notify, the node does not want transactions anymore
+CMD_MATCH_TX = 'matchtx'  # notify, payload: a binary unconfirmed transaction
+CMD_MERKLE_TX = 'merkletx'  # notify, payload: the hash of a block, a binary transaction and its compact proof
+CMD_BLOCK = 'block'  # notify, payload: the binary header of a new block, sent before the proofs of its transactions
+
+MAX_FILTER_BYTES = 36000
+MAX_FILTER_HASHES = 50
+
+
+class SubscriptionIndex:
+    """
+    Bloom filters of subscribers sharing one geometry, stored bit sliced: for every bit of the filters, an integer with
+    one bit per subscriber. Matching an item against all the filters is then an AND of a few integers, whatever the
+    number of subscribers.
+    """
+
+    def __init__(self, bits, hashes):
+        """
+        Initialize an empty index
+        :param bits: number of bits of the filters
+        :param hashes: number of hashes of the filters
+        """
+        self.bits = bits
+        self.hashes = hashes
+        self.columns = [0] * bits  # bit position -> bit s set if the filter of slot s has the bit
+        self.slots = {}  # subscriber -> slot
+        self.subscribers = []  # slot -> subscriber, None for a free slot
+        self.filters = {}  # subscriber -> BloomFilter
+        self.free = []  # free slots
+
+    def load(self, subscriber, bloom):
+        """
+        set the filter of a subscriber, replacing the one it had
+        :param subscriber: any hashable object, like a connection
+        :param bloom: a BloomFilter with the geometry of the index
+        """
+        self.remove(subscriber)
+        slot = self.free.pop() if self.free else len(self.subscribers)
+        if slot == len(self.subscribers):
+            self.subscribers.append(None)
+        self.subscribers[slot] = subscriber
+        self.slots[subscriber] = slot
+        self.filters[subscriber] = bloom
+
+        bit = 1 << slot
+        for p in self.__set_bits(bloom):
+            self.columns[p] |= bit
+
+    def add(self, subscriber, item):
+        """
+        add an item to the filter of a subscriber
+        :param subscriber: a subscriber of the index
+        :param item: bytes, or a string
+        """
+        bit = 1 << self.slots[subscriber]
+        for p in self.filters[subscriber].add(item):
+            self.columns[p] |= bit
+
+    def remove(self, subscriber):
+        """
+        remove a subscriber, nothing happens if it is not in the index
+        :param subscriber: a subscriber
+        """
+        slot = self.slots.pop(subscriber, None)
+        if slot is None:
+            return
+        mask = ~(1 << slot)
+        for p in self.__set_bits(self.filters.pop(subscriber)):
+            self.columns[p] &= mask
+        self.subscribers[slot] = None
+        self.free.append(slot)
+
+    def match(self, items):
+        """
+        :param items: a list of items, bytes or strings
+        :return: the set of subscribers whose filter matches any of the items
+        """
+        matched = 0
+        for item in items:
+            positions = item_positions(item, self.bits, self.hashes)
+            mask = self.columns[positions[0]]
+            for p in positions[1:]:
+                if not mask:
+                    break
+                mask &= self.columns[p]
+            matched |= mask
+
+        subscribers = set()
+        while matched:
+            low = matched & -matched
+            subscribers.add(self.subscribers[low.bit_length() - 1])
+            matched ^= low
+        return subscribers
+
+    def __len__(self):
+        return len(self.slots)
+
+    @staticmethod
+    def __set_bits(bloom):
+        """
+        a private method that lists the positions of the bits set in a filter
+        """
+        return [8 * i + j for i, byte in enumerate(bloom.data) if byte for j in range(8) if byte >> j & 1]
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class Subscriptions:
+    """
+    Transaction subscriptions of light weight nodes. Every subscriber has a Bloom filter of the addresses it cares
+    about, a transaction goes to the subscribers whose filter matches its sender or its recipient.
+    """
+
+    def __init__(self):
+        self.indexes = {}  # (bits, hashes) -> SubscriptionIndex
+        self.geometry = {}  # subscriber -> (bits, hashes)
+
+        # counters
+        self.checked = 0
+        self.matches = 0
+
+    def load(self, subscriber, bloom):
+        """
+        set the filter of a subscriber
+        :param subscriber: any hashable object, like a connection
+        :param bloom: a BloomFilter
+        """
+        if len(bloom.data) > MAX_FILTER_BYTES or not 0 < bloom.hashes <= MAX_FILTER_HASHES:
+            raise ValueError('Bloom filter too large.')
+        self.remove(subscriber)
+        key = (bloom.bits, bloom.hashes)
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = SubscriptionIndex(*key)
+        index.load(subscriber, bloom)
+        self.geometry[subscriber] = key
+
+    def add(self, subscriber, item):
+        """
+        add an item to the filter of a subscriber
+        :param subscriber: a subscriber
+        :param item: bytes, or a string
+        """
+        key = self.geometry.get(subscriber)
+        if key is None:
+            raise ValueError('No filter loaded.')
+        self.indexes[key].add(subscriber, item)
+
+    def remove(self, subscriber):
+        """
+        remove a subscriber, nothing happens if it has no filter
+        :param subscriber: a subscriber
+        """
+        key = self.geometry.pop(subscriber, None)
+        if key is None:
+            return
+        index = self.indexes[key]
+        index.remove(subscriber)
+        if not len(index):
+            del self.indexes[key]
+
+    def match_tx(self, tx):
+        """
+        :param tx: a transaction object
+        :return: the set of subscribers whose filter matches the sender or the recipient
+        """
+        subscribers = set()
+        for index in self.indexes.values():
+            subscribers |= index.match((tx.sender, tx.recipient))
+        self.checked += 1
+        self.matches += len(subscribers)
+        return subscribers
+
+    def __contains__(self, subscriber):
+        return subscriber in self.geometry
+
+    def __len__(self):
+        return len(self.geometry)
+
+
+# test cases
+def test():
+    import time
+    from Transaction import Tx
+
+    # many light weight nodes, each watching its own address
+    subscriptions = Subscriptions()
+    addresses = ['%0128x' % i for i in range(2000)]
+    for i, address in enumerate(addresses):
+        bloom = BloomFilter(capacity=10, fp_rate=0.001)
+        bloom.add(address)
+        subscriptions.load(i, bloom)
+
+    txs = [Tx('connect', addresses[i], '%0128x' % (10 ** 6 + i), 'data') for i in range(2000)]
+    started = time.perf_counter()
+    matched = [subscriptions.match_tx(tx) for tx in txs]
+    elapsed = time.perf_counter() - started
+    print(all(i in m for i, m in enumerate(matched)), sum(len(m) for m in matched) - len(txs))
+    print('%.0f transactions matched per second against %d filters' % (len(txs) / elapsed, len(subscriptions)))
+
+    # filters change incrementally
+    subscriptions.add(0, addresses[1999])
+    subscriptions.remove(1999)
+    print(subscriptions.match_tx(txs[1999]), len(subscriptions))
+
+    # a light weight node gets its transactions from a full node, then the proof they are in a block
+    import asyncio
+    from BlockHeader import BlockHeader
+    from FullNode import FullNode
+    from LightWeightNode import LightWeightNode
+    from Miner import Miner
+
+    async def run():
+        full = FullNode()
+        address = await full.create_network().start()
+        light = LightWeightNode(difficulty=0)
+        await light.find_peers([address])
+        await light.subscribe()
+        await asyncio.sleep(0.05)
+
+        mine = Tx('connect', '00' * 64, light.export_public_key_ecc(), 'data')
+        for tx in [mine] + txs[:100]:
+            full.mempool.add(tx)
+            full.gossip.announce(tx)
+        await asyncio.sleep(0.05)
+        print(list(light.tx_db.in_uc) == [mine.txid], light.false_positives)
+
+        # the header of a mined block is announced before the proofs, the light weight node has it to check them
+        print(full.mine_block(Miner(difficulty=0, workers=1)))
+        await asyncio.sleep(0.05)
+        print(list(light.tx_db.in_co) == [mine.txid], light.unproven, len(light.headers) == len(full.headers))
+
+        # a light weight node that missed a block keeps the proofs of the next one until it caught up
+        full.headers.append(BlockHeader(full.headers.tip_hash, 0, '00' * 32, time.time()))
+        late = Tx('connect', '01' * 64, light.export_public_key_ecc(), 'data')
+        full.mempool.add(late)
+        full.gossip.announce(late)
+        await asyncio.sleep(0.05)
+        print(full.mine_block(Miner(difficulty=0, workers=1)))
+        await asyncio.sleep(0.05)
+        print(late.txid in light.tx_db.in_co, light.unproven, len(light.pending), len(light.headers))
+
+        await light.network.close()
+        await full.network.close()
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    test()
@@ -1,18 +1,44 @@
 import time
+from bisect import bisect_left, insort
 from json import dumps, loads
+from struct import Struct
+
+from MerkleTree import MerkleTree
+
+# formats a transaction can be sent in, two nodes agree on one before exchanging transactions
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+
+# binary transaction: body length, then flags, timestamp and the lengths of message, sender, recipient and content,
+# followed by the four fields themselves and, for a signed transaction, the signature up to the end of the body
+TX_LENGTH = Struct('>I')
+TX_HEAD = Struct('>BdIIII')
+
+# bits of the flags, set when a field is a hex string sent as raw bytes
+FLAG_SENDER_HEX = 1
+FLAG_RECIPIENT_HEX = 2
+FLAG_CONTENT_HEX = 4
+FLAG_SIGNED = 8
+FLAG_INT_TIMESTAMP = 16  # the timestamp is an integer, so the id computed from the decoded transaction is the same
 
 
 class Tx:
     """
     Transaction class
     """
-    def __init__(self, message, sender, recipient, content, timestamp=time.time()):
+    # fields of a transaction, a mempool holds many of them so they are kept in slots instead of a __dict__
+    FIELDS = ('message', 'sender', 'recipient', 'content', 'timestamp')
+    __slots__ = FIELDS + ('signature', '_txid')
+
+    def __init__(self, message, sender, recipient, content, timestamp=None, signature=None):
         """
         Initialize a transaction object
         :param message:
-        :param sender:
+        :param sender: the public ecc key of the sender in hex
         :param recipient:
         :param content:
+        :param timestamp: the creation time, now by default
+        :param signature: the signature of the sender in hex, None for an unsigned transaction
         """
 
         # Todo: finalize the transaction format
@@ -21,14 +47,172 @@ class Tx:
         self.sender = sender
         self.recipient = recipient
         self.content = content
-        self.timestamp = timestamp
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.signature = signature
+
+    def __setattr__(self, name, value):
+        """
+        Set a field, and forget the cached id since the transaction changed
+        """
+        object.__setattr__(self, name, value)
+        if name != '_txid':
+            object.__setattr__(self, '_txid', None)
+
+    def __eq__(self, other):
+        return isinstance(other, Tx) and self.txid == other.txid
+
+    def __hash__(self):
+        return hash(self.txid)
+
+    @property
+    def txid(self):
+        """
+        :return: the id of the transaction, the hash of its canonical string with the signature. It is computed on
+        first use and kept until a field changes.
+        """
+        if self._txid is None:
+            self._txid = MerkleTree.calculate_hash(self.to_string)
+        return self._txid
+
+    @property
+    def to_json(self):
+        """
+        :return: a dict of the fields of the transaction, with the signature if it is signed
+        """
+        j = {field: getattr(self, field) for field in self.FIELDS}
+        if self.signature is not None:
+            j['signature'] = self.signature
+        return j
 
     @property
     def to_string(self):
         """
-        :return: a string representation of the transaction with double quotes surround the key values.
+        :return: the canonical string representation of the transaction, json with sorted keys and no spaces, with
+        double quotes surround the key values.
         """
-        return dumps(self.__dict__)
+        return dumps(self.to_json, sort_keys=True, separators=(',', ':'))
+
+    @property
+    def signing_payload(self):
+        """
+        :return: the bytes the sender signs, the canonical string of the transaction without its signature
+        """
+        j = {field: getattr(self, field) for field in self.FIELDS}
+        return dumps(j, sort_keys=True, separators=(',', ':')).encode('utf-8')
+
+    def sign(self, private_key):
+        """
+        Sign the transaction, the id changes since it covers the signature
+        :param private_key: the private ecc key of the sender, of type ecdsa.SigningKey
+        """
+        self.signature = private_key.sign(self.signing_payload).hex()
+
+    @property
+    def to_bytes(self):
+        """
+        :return: a length prefixed binary representation of the transaction. Keys and encrypted content in hex are
+        written as raw bytes, the timestamp as an 8 bytes float.
+        """
+        flags = 0
+        if isinstance(self.timestamp, int):
+            if int(float(self.timestamp)) != self.timestamp:
+                raise ValueError('Timestamp does not fit in the binary format.')
+            flags |= FLAG_INT_TIMESTAMP
+        fields = []
+        for field, flag in ((self.sender, FLAG_SENDER_HEX),
+                            (self.recipient, FLAG_RECIPIENT_HEX),
+                            (self.content, FLAG_CONTENT_HEX)):
+            raw = hex_to_bytes(field)
+            if raw is None:
+                raw = field.encode('utf-8')
+            else:
+                flags |= flag
+            fields.append(raw)
+        sender, recipient, content = fields
+        message = self.message.encode('utf-8')
+        signature = b''
+        if self.signature is not None:
+            flags |= FLAG_SIGNED
+            signature = bytes.fromhex(self.signature)
+
+        body = TX_HEAD.pack(flags, self.timestamp, len(message), len(sender), len(recipient), len(content))
+        body += message + sender + recipient + content + signature
+        return TX_LENGTH.pack(len(body)) + body
+
+
+def hex_to_bytes(s):
+    """
+    Convert a hex string to bytes, only if the bytes convert back to the very same string
+    :param s: a string
+    :return: the bytes, None if the string is not lowercase hex
+    """
+    try:
+        raw = bytes.fromhex(s)
+    except ValueError:
+        return None
+    return raw if raw.hex() == s else None
+
+
+def tx_from_bytes(b, offset=0):
+    """
+    Create a transaction object from its binary representation.
+    :param b: bytes or a memoryview holding one or more binary transactions
+    :param offset: position of the transaction in b
+    :return: a transaction object and the position right after it
+    """
+    view = memoryview(b)
+    if len(view) < offset + TX_LENGTH.size + TX_HEAD.size:
+        raise ValueError('Truncated binary transaction.')
+    length, = TX_LENGTH.unpack_from(view, offset)
+    start = offset + TX_LENGTH.size
+    end = start + length
+    flags, timestamp, message_len, sender_len, recipient_len, content_len = TX_HEAD.unpack_from(view, start)
+    signature_len = length - (TX_HEAD.size + message_len + sender_len + recipient_len + content_len)
+    if end > len(view) or signature_len < 0 or (signature_len > 0) != bool(flags & FLAG_SIGNED):
+        raise ValueError('Malformed binary transaction.')
+
+    pos = start + TX_HEAD.size
+    fields = []
+    for field_len, flag in ((message_len, 0),
+                            (sender_len, FLAG_SENDER_HEX),
+                            (recipient_len, FLAG_RECIPIENT_HEX),
+                            (content_len, FLAG_CONTENT_HEX)):
+        raw = view[pos:pos + field_len]
+        fields.append(raw.hex() if flags & flag else str(raw, 'utf-8'))
+        pos += field_len
+    message, sender, recipient, content = fields
+    signature = view[pos:end].hex() if flags & FLAG_SIGNED else None
+    if flags & FLAG_INT_TIMESTAMP:
+        timestamp = int(timestamp)
+    return Tx(message, sender, recipient, content, timestamp, signature), end
+
+
+def encode_tx(tx, fmt=FORMAT_JSON):
+    """
+    Encode a transaction in the format agreed with the other node.
+    :param tx: a transaction object
+    :param fmt: FORMAT_JSON or FORMAT_BINARY
+    :return: the transaction in bytes
+    """
+    if fmt == FORMAT_BINARY:
+        return tx.to_bytes
+    if fmt == FORMAT_JSON:
+        return tx.to_string.encode('utf-8')
+    raise ValueError('Unknown transaction format ' + str(fmt) + '.')
+
+
+def decode_tx(b, fmt=FORMAT_JSON):
+    """
+    Decode a transaction encoded by encode_tx().
+    :param b: the transaction in bytes
+    :param fmt: FORMAT_JSON or FORMAT_BINARY
+    :return: a transaction object
+    """
+    if fmt == FORMAT_BINARY:
+        return tx_from_bytes(b)[0]
+    if fmt == FORMAT_JSON:
+        return tx_from_string(bytes(b).decode('utf-8'))
+    raise ValueError('Unknown transaction format ' + str(fmt) + '.')
 
 
 def tx_from_string(s):
@@ -49,7 +233,7 @@ def tx_from_json(j):
     :param j: a transaction in json
     :return:
     """
-    return Tx(j["message"], j["sender"], j["recipient"], j["content"], j["timestamp"])
+    return Tx(j["message"], j["sender"], j["recipient"], j["content"], j["timestamp"], j.get("signature"))
 
 
 "---------------------------------------------------------------------------------------------------------------------"
@@ -57,67 +241,225 @@ def tx_from_json(j):
 
 class TxDB:
 
-    def __init__(self):
-        self.in_uc = []  # unconfirmed incoming transactions
-        self.in_co = []  # confirmed incoming transactions
-        self.out_uc = []  # unconfirmed outgoing transactions
-        self.out_co = []  # confirmed outgoing transactions
+    def __init__(self, store=None):
+        """
+        Initialize a transaction database
+        :param store: a TxStore to keep the transactions on disk, None to keep them in memory
+        """
+        # every table maps the txid of a transaction to the transaction object
+        self.store = store
+        if store is None:
+            self.in_uc = {}  # unconfirmed incoming transactions
+            self.in_co = {}  # confirmed incoming transactions
+            self.out_uc = {}  # unconfirmed outgoing transactions
+            self.out_co = {}  # confirmed outgoing transactions
+        else:
+            self.in_uc, self.in_co, self.out_uc, self.out_co = store.open_tables()
+
+        # secondary indexes over the transactions of all four tables. With a store they are built on first use, so
+        # opening the database does not read every transaction.
+        self.by_sender = {}  # sender -> set of txids
+        self.by_recipient = {}  # recipient -> set of txids
+        self.by_time = []  # (timestamp, txid) pairs sorted by time
+        self.indexed = store is None
 
     def add_in_uc(self, tx):
         """
-        add a transaction to unconfirmed incoming tx array
+        add a transaction to unconfirmed incoming tx table
         :param tx:
         """
-        self.in_uc.append(tx)
+        self.__add(self.in_uc, tx)
 
     def add_in_co(self, tx):
         """
-        add a transaction to confirmed incoming tx array
+        add a transaction to confirmed incoming tx table
         :param tx:
         """
-        self.in_co.append(tx)
+        self.__add(self.in_co, tx)
 
     def add_out_uc(self, tx):
         """
-        add a transaction to unconfirmed outgoing tx array
+        add a transaction to unconfirmed outgoing tx table
         :param tx:
         """
-        self.out_uc.append(tx)
+        self.__add(self.out_uc, tx)
 
     def add_out_co(self, tx):
         """
-        add a transaction to confirmed outgoing tx array
+        add a transaction to confirmed outgoing tx table
         :param tx:
         """
-        self.out_co.append(tx)
+        self.__add(self.out_co, tx)
 
     def del_in_uc(self, tx):
         """
-        delete a transaction from unconfirmed incoming tx array
-        :param tx:
+        delete a transaction from unconfirmed incoming tx table
+        :param tx: a transaction or its txid
         """
-        self.in_uc.remove(tx)
+        self.__delete(self.in_uc, tx)
 
     def del_in_co(self, tx):
         """
-         delete a transaction from confirmed incoming tx array
-        :param tx:
+         delete a transaction from confirmed incoming tx table
+        :param tx: a transaction or its txid
         """
-        self.in_co.remove(tx)
+        self.__delete(self.in_co, tx)
 
     def del_out_uc(self, tx):
         """
-        delete a transaction from unconfirmed outgoing tx array
-        :param tx:
+        delete a transaction from unconfirmed outgoing tx table
+        :param tx: a transaction or its txid
         """
-        self.out_uc.remove(tx)
+        self.__delete(self.out_uc, tx)
 
     def del_out_co(self, tx):
         """
-        delete a transaction from confirmed outgoing tx array
+        delete a transaction from confirmed outgoing tx table
+        :param tx: a transaction or its txid
+        """
+        self.__delete(self.out_co, tx)
+
+    def get(self, txid):
+        """
+        find a transaction in any table
+        :param txid: the id of a transaction
+        :return: the transaction, None if it is not in the database
+        """
+        for table in (self.in_uc, self.in_co, self.out_uc, self.out_co):
+            tx = table.get(txid)
+            if tx is not None:
+                return tx
+        return None
+
+    def is_confirmed(self, txid):
+        """
+        :param txid: the id of a transaction
+        :return: true if the transaction is in a confirmed table
+        """
+        return txid in self.in_co or txid in self.out_co
+
+    def confirm(self, txid):
+        """
+        move a transaction from the unconfirmed to the confirmed table of the same direction
+        :param txid: the id of an unconfirmed transaction
+        :return: the transaction
+        """
+        return self.confirm_all([txid])[0]
+
+    def confirm_all(self, txids):
+        """
+        move transactions, like the ones of a block, from the unconfirmed to the confirmed tables. Either all of them
+        are moved, or none if one of them is not unconfirmed or appears twice.
+        :param txids: the ids of unconfirmed transactions
+        :return: the list of transactions
+        """
+        # find every transaction before moving any of them
+        moves = []
+        seen = set()
+        for txid in txids:
+            if txid in seen:
+                raise ValueError('Transaction ' + str(txid) + ' appears twice.')
+            seen.add(txid)
+            if txid in self.in_uc:
+                moves.append((self.in_uc, self.in_co, txid))
+            elif txid in self.out_uc:
+                moves.append((self.out_uc, self.out_co, txid))
+            else:
+                raise ValueError('Transaction ' + str(txid) + ' is not unconfirmed.')
+
+        # a transaction stays in the database, so the secondary indexes do not change. It is added to the new table
+        # before it leaves the old one, a store then keeps its record instead of writing it again.
+        confirmed = []
+        for unconfirmed, table, txid in moves:
+            tx = unconfirmed[txid]
+            table[txid] = tx
+            del unconfirmed[txid]
+            confirmed.append(tx)
+        return confirmed
+
+    def find_by_sender(self, sender):
+        """
+        :param sender: a public key
+        :return: a list of the transactions sent by the key
+        """
+        self.__build_indexes()
+        return [self.get(txid) for txid in self.by_sender.get(sender, ())]
+
+    def find_by_recipient(self, recipient):
+        """
+        :param recipient: a public key
+        :return: a list of the transactions sent to the key
+        """
+        self.__build_indexes()
+        return [self.get(txid) for txid in self.by_recipient.get(recipient, ())]
+
+    def find_by_time(self, start, end):
+        """
+        :param start: the earliest timestamp, included
+        :param end: the latest timestamp, excluded
+        :return: a list of the transactions created between start and end, ordered by time
+        """
+        self.__build_indexes()
+        first = bisect_left(self.by_time, (start,))
+        last = bisect_left(self.by_time, (end,))
+        return [self.get(txid) for _, txid in self.by_time[first:last]]
+
+    def __contains__(self, txid):
+        return any(txid in table for table in (self.in_uc, self.in_co, self.out_uc, self.out_co))
+
+    def __add(self, table, tx):
+        """
+        a private method that adds a transaction to a table and, the first time it is seen, to the secondary indexes
+        :param table: one of the four tables
         :param tx:
         """
-        self.out_co.remove(tx)
+        txid = tx.txid
+        if self.indexed and txid not in self:
+            self.__index(tx)
+        table[txid] = tx
+
+    def __index(self, tx):
+        """
+        a private method that adds a transaction to the secondary indexes
+        :param tx:
+        """
+        self.by_sender.setdefault(tx.sender, set()).add(tx.txid)
+        self.by_recipient.setdefault(tx.recipient, set()).add(tx.txid)
+        insort(self.by_time, (tx.timestamp, tx.txid))
+
+    def __build_indexes(self):
+        """
+        a private method that builds the secondary indexes from the tables, the first time they are needed
+        """
+        if self.indexed:
+            return
+        for table in (self.in_uc, self.in_co, self.out_uc, self.out_co):
+            for tx in table.values():
+                if tx.txid not in self.by_recipient.get(tx.recipient, ()):
+                    self.__index(tx)
+        self.indexed = True
+
+    def __delete(self, table, tx):
+        """
+        a private method that deletes a transaction from a table and, if no table holds it anymore, from the
+        secondary indexes
+        :param table: one of the four tables
+        :param tx: a transaction or its txid
+        """
+        txid = tx if isinstance(tx, str) else tx.txid
+        if txid not in table:
+            raise ValueError('Transaction ' + txid + ' is not in the table.')
+        tx = table.pop(txid)
+        if txid in self or not self.indexed:
+            return
+
+        for index, key in ((self.by_sender, tx.sender), (self.by_recipient, tx.recipient)):
+            txids = index[key]
+            txids.discard(txid)
+            if not txids:
+                del index[key]
+        i = bisect_left(self.by_time, (tx.timestamp, txid))
+        del self.by_time[i]
 
 
 # test cases
@@ -126,6 +468,8 @@ def test():
 
     print(t1.to_string)
 
+    print(t1.txid)
+
     print(type(t1.to_string))
 
     j1 = loads(t1.to_string)
@@ -140,7 +484,41 @@ def test():
 
     print(t3.to_string)
 
-    # Todo: test transaction database
+    # test the binary format, with hex keys and content like real transactions
+    t4 = Tx('connect', '0a' * 64, 'b1' * 64, 'c2' * 128)
+    for t in (t1, t4):
+        for fmt in (FORMAT_JSON, FORMAT_BINARY):
+            b = encode_tx(t, fmt)
+            print(fmt, len(b), decode_tx(b, fmt) == t)
+
+    # a signed transaction keeps its signature in both formats, the signature is not part of what is signed
+    t5 = Tx('connect', '0a' * 64, 'b1' * 64, 'c2' * 128, t4.timestamp, 'd3' * 64)
+    for fmt in (FORMAT_JSON, FORMAT_BINARY):
+        print(fmt, decode_tx(encode_tx(t5, fmt), fmt).signature == t5.signature)
+    print(t5.txid != t4.txid, t5.signing_payload == t4.signing_payload)
+
+    # an integer timestamp stays an integer, and a field larger than 64KB fits, so the id survives the binary format
+    t6 = Tx('m' * 70000, '0a' * 64, 'b1' * 64, 'data', 1546300800)
+    t7 = decode_tx(encode_tx(t6, FORMAT_BINARY), FORMAT_BINARY)
+    print(t7.timestamp, t7.txid == t6.txid)
+
+    # the id follows the fields
+    t3.content = 'hello again'
+    print(t3.txid != t1.txid)
+
+    # test transaction database
+    db = TxDB()
+    db.add_in_uc(t1)
+    db.add_out_uc(t4)
+    print(db.find_by_sender('1') == [t1], db.find_by_time(0, t4.timestamp) == [t1])
+    try:
+        db.confirm_all([t1.txid, t1.txid])
+    except ValueError as e:
+        print(e, len(db.in_uc), len(db.in_co))
+    db.confirm_all([t1.txid, t4.txid])
+    print(len(db.in_uc), len(db.in_co), len(db.out_uc), len(db.out_co), db.is_confirmed(t1.txid))
+    db.del_out_co(t4)
+    print(t4.txid in db, db.find_by_recipient('b1' * 64))
 
 
 if __name__ == "__main__":
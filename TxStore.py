@@ -0,0 +1,559 @@
+import os
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from zlib import crc32
+
+from Transaction import tx_from_bytes
+
+# tables of a transaction database, a transaction can be in several of them
+TABLE_IN_UC = 0  # unconfirmed incoming transactions
+TABLE_IN_CO = 1  # confirmed incoming transactions
+TABLE_OUT_UC = 2  # unconfirmed outgoing transactions
+TABLE_OUT_CO = 3  # confirmed outgoing transactions
+
+# operations written to the log
+OP_PUT = 1  # store a transaction and add it to a table, the record carries the binary transaction
+OP_ADD = 2  # add a stored transaction to one more table
+OP_DROP = 3  # remove a transaction from a table, the transaction is removed with its last table
+
+# a record of the log: payload length, crc32 of the record with this field set to 0, operation, table and txid
+RECORD = Struct('>IIBB32s')
+
+# the index file starts with a header: magic, capacity, used slots, live transactions, bytes of the live records,
+# first segment, and the position in the log up to which the index is saved on disk
+INDEX_MAGIC = b'TXINDEX1'
+INDEX_HEADER = Struct('>8sQQQQQQQ')
+
+# then comes a hash table of slots: txid, bit mask of the tables holding the tx, segment, offset and length of the
+# record that carries the binary transaction
+SLOT = Struct('>32sBxHQI')
+SLOT_EMPTY = 0
+SLOT_DELETED = 0xff
+
+INDEX_CAPACITY = 1024  # initial number of slots, always a power of 2
+INDEX_LOAD = 0.7  # the table grows when used slots, including deleted ones, go above this share
+SEGMENT_SIZE = 64 * 1024 * 1024  # a new segment is started when the current one reaches this size
+
+
+class TxIndex:
+    """
+    Hash table from txid to the location of a transaction in the log, kept in a memory mapped file so that opening it
+    costs the same however many transactions it holds.
+    """
+
+    def __init__(self, path, capacity=INDEX_CAPACITY, first_segment=0):
+        """
+        Open an index file, create it if it does not exist
+        :param path: path of the index file
+        :param capacity: number of slots of a new index, a power of 2
+        :param first_segment: first segment of the log of a new index
+        """
+        self.path = path
+        if not os.path.exists(path):
+            self.__create(path, capacity, first_segment)
+        self.file = open(path, 'r+b')
+        self.map = mmap(self.file.fileno(), 0)
+
+        magic, self.capacity, self.used, self.count, self.live_bytes, self.first_segment, segment, offset = \
+            INDEX_HEADER.unpack_from(self.map)
+        if magic != INDEX_MAGIC:
+            raise RuntimeError('File ' + path + ' is not a transaction index.')
+        self.checkpoint = (segment, offset)
+
+    @staticmethod
+    def __create(path, capacity, first_segment):
+        """
+        a private method that writes an empty index file
+        """
+        with open(path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, capacity, 0, 0, 0, first_segment, first_segment, 0))
+            f.truncate(INDEX_HEADER.size + capacity * SLOT.size)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def find(self, txid):
+        """
+        look up a transaction
+        :param txid: the txid in bytes
+        :return: the bit mask of its tables, 0 if it is not stored, followed by segment, offset and length of its record
+        """
+        slot, found = self.__probe(txid)
+        if not found:
+            return 0, 0, 0, 0
+        return SLOT.unpack_from(self.map, INDEX_HEADER.size + slot * SLOT.size)[1:]
+
+    def apply(self, op, table, txid, segment, offset, length):
+        """
+        apply a record of the log. Applying the same records again, in the same order, gives the same index, which is
+        what makes replaying the log after a crash safe. The counters in the header are updated with the slot, so
+        the two never disagree in the memory map.
+        :param op: OP_PUT, OP_ADD or OP_DROP
+        :param table: one of the four tables
+        :param txid: the txid in bytes
+        :param segment: segment of the record
+        :param offset: offset of the record in the segment
+        :param length: length of the record
+        """
+        if op == OP_PUT and self.used + 1 > self.capacity * INDEX_LOAD:
+            self.__resize()
+        self.__update_slot(op, table, txid, segment, offset, length)
+        self.__write_header()
+
+    def __update_slot(self, op, table, txid, segment, offset, length):
+        """
+        a private method that applies a record of the log to the slot of its transaction
+        """
+        slot, found = self.__probe(txid)
+        base = INDEX_HEADER.size + slot * SLOT.size
+        if not found:
+            if op != OP_PUT:
+                return
+            if SLOT.unpack_from(self.map, base)[1] == SLOT_EMPTY:
+                self.used += 1
+            self.count += 1
+            self.live_bytes += length
+            SLOT.pack_into(self.map, base, txid, 1 << table, segment, offset, length)
+            return
+
+        _, tables, old_segment, old_offset, old_length = SLOT.unpack_from(self.map, base)
+        if op == OP_PUT:
+            # a newer copy of the record, like the ones written by a compaction
+            self.live_bytes += length - old_length
+            SLOT.pack_into(self.map, base, txid, tables | 1 << table, segment, offset, length)
+        elif op == OP_ADD:
+            SLOT.pack_into(self.map, base, txid, tables | 1 << table, old_segment, old_offset, old_length)
+        elif tables & ~(1 << table):
+            SLOT.pack_into(self.map, base, txid, tables & ~(1 << table), old_segment, old_offset, old_length)
+        else:
+            self.count -= 1
+            self.live_bytes -= old_length
+            SLOT.pack_into(self.map, base, txid, SLOT_DELETED, 0, 0, 0)
+
+    def slots(self):
+        """
+        :return: a generator of (txid, tables, segment, offset, length) of every stored transaction
+        """
+        for slot in range(self.capacity):
+            entry = SLOT.unpack_from(self.map, INDEX_HEADER.size + slot * SLOT.size)
+            if entry[1] not in (SLOT_EMPTY, SLOT_DELETED):
+                yield entry
+
+    def save(self, checkpoint, sync=True):
+        """
+        write the header, and the slots with it, to disk
+        :param checkpoint: the (segment, offset) position in the log the index is up to date with
+        :param sync: also wait until the disk has the data
+        """
+        self.checkpoint = checkpoint
+        self.__write_header()
+        if sync:
+            self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __write_header(self):
+        INDEX_HEADER.pack_into(self.map, 0, INDEX_MAGIC, self.capacity, self.used, self.count, self.live_bytes,
+                               self.first_segment, self.checkpoint[0], self.checkpoint[1])
+
+    def __probe(self, txid):
+        """
+        a private method that finds the slot of a txid with linear probing
+        :return: the slot number and true if the txid is there, or the first free slot for it and false
+        """
+        mask = self.capacity - 1
+        slot = int.from_bytes(txid[:8], 'big') & mask
+        free = None
+        while True:
+            key, tables = SLOT.unpack_from(self.map, INDEX_HEADER.size + slot * SLOT.size)[:2]
+            if tables == SLOT_EMPTY:
+                return (slot if free is None else free), False
+            if tables == SLOT_DELETED:
+                if free is None:
+                    free = slot
+            elif key == txid:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def __resize(self):
+        """
+        a private method that rebuilds the table without deleted slots, with twice the capacity if it is still too full
+        """
+        capacity = self.capacity
+        while self.count + 1 > capacity * INDEX_LOAD / 2:
+            capacity *= 2
+
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        resized = TxIndex(tmp_path, capacity, self.first_segment)
+        for txid, tables, segment, offset, length in self.slots():
+            slot = resized.__probe(txid)[0]
+            SLOT.pack_into(resized.map, INDEX_HEADER.size + slot * SLOT.size, txid, tables, segment, offset, length)
+        resized.used = resized.count = self.count
+        resized.live_bytes = self.live_bytes
+        resized.save(self.checkpoint)
+        resized.close()
+
+        self.close()
+        os.replace(tmp_path, self.path)
+        self.__init__(self.path)
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class TxStore:
+    """
+    Durable storage of transactions: an append-only log of binary transactions, split in segment files, and a memory
+    mapped index from txid to the record. Transactions are read straight from the memory mapped segments.
+    """
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE, compact_ratio=0.5):
+        """
+        Open a store, recover the records written after the last checkpoint of the index
+        :param path: a directory, created if it does not exist
+        :param segment_size: size at which a new segment is started
+        :param compact_ratio: the log is compacted when the share of removed records goes above this ratio
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.compact_ratio = compact_ratio
+        os.makedirs(path, exist_ok=True)
+
+        self.index = TxIndex(os.path.join(path, 'index.dat'))
+        self.maps = {}  # segment number -> read only memory map of the segment
+        self.log_bytes = 0  # size of all segments
+        self.segment = self.index.first_segment  # segment open for writing
+        self.log = None
+        self.__recover()
+
+    def add(self, tx, table):
+        """
+        add a transaction to a table, the transaction is only written to the log the first time
+        :param tx: a transaction object
+        :param table: one of the four tables
+        """
+        txid = bytes.fromhex(tx.txid)
+        tables = self.index.find(txid)[0]
+        if tables & 1 << table:
+            return
+        if tables:
+            self.__append(OP_ADD, table, txid)
+        else:
+            self.__append(OP_PUT, table, txid, tx.to_bytes)
+
+    def drop(self, txid, table):
+        """
+        remove a transaction from a table, its record becomes garbage when it is in no table anymore
+        :param txid: the id of the transaction
+        :param table: one of the four tables
+        """
+        raw = bytes.fromhex(txid)
+        if not self.index.find(raw)[0] & 1 << table:
+            raise KeyError(txid)
+        self.__append(OP_DROP, table, raw)
+        if self.log_bytes > self.segment_size and self.index.live_bytes < self.log_bytes * (1 - self.compact_ratio):
+            self.compact()
+
+    def tables(self, txid):
+        """
+        :param txid: the id of a transaction
+        :return: the bit mask of the tables holding the transaction, 0 if it is not stored
+        """
+        return self.index.find(bytes.fromhex(txid))[0]
+
+    def get_bytes(self, txid):
+        """
+        :param txid: the id of a transaction
+        :return: a memoryview of the binary transaction in the memory mapped log, None if it is not stored
+        """
+        tables, segment, offset, length = self.index.find(bytes.fromhex(txid))
+        if not tables:
+            return None
+        return memoryview(self.__map(segment, offset + length))[offset + RECORD.size:offset + length]
+
+    def get(self, txid):
+        """
+        :param txid: the id of a transaction
+        :return: the transaction object, None if it is not stored
+        """
+        view = self.get_bytes(txid)
+        return None if view is None else tx_from_bytes(view)[0]
+
+    def txids(self, table=None):
+        """
+        :param table: one of the four tables, None for all transactions
+        :return: a generator of the txids
+        """
+        for txid, tables, _, _, _ in self.index.slots():
+            if table is None or tables & 1 << table:
+                yield txid.hex()
+
+    def __len__(self):
+        return self.index.count
+
+    def open_tables(self):
+        """
+        :return: views of the four tables, in the order in_uc, in_co, out_uc, out_co of TxDB
+        """
+        return tuple(StoreTable(self, table) for table in (TABLE_IN_UC, TABLE_IN_CO, TABLE_OUT_UC, TABLE_OUT_CO))
+
+    def sync(self):
+        """
+        Write the log and the index to disk, and move the checkpoint of the index to the end of the log
+        """
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.index.save((self.segment, self.log.tell()))
+
+    def compact(self):
+        """
+        Copy the stored transactions into new segments, switch to a new index and delete the old segments
+        """
+        self.sync()
+        first_segment = self.segment + 1
+
+        tmp_path = os.path.join(self.path, 'index.tmp')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        capacity = INDEX_CAPACITY
+        while self.index.count + 1 > capacity * INDEX_LOAD / 2:
+            capacity *= 2
+        index = TxIndex(tmp_path, capacity, first_segment)
+
+        # the records of a transaction in several tables are one put followed by adds, like in the original log
+        segment, log, size = first_segment, None, 0
+        for txid, tables, old_segment, offset, length in self.index.slots():
+            payload = self.__map(old_segment, offset + length)[offset + RECORD.size:offset + length]
+            for table in range(4):
+                if not tables & 1 << table:
+                    continue
+                record = self.__record(OP_PUT if payload else OP_ADD, table, txid, payload)
+                if log is None or (size > 0 and size + len(record) > self.segment_size):
+                    if log is not None:
+                        self.__close_segment(log)
+                        segment += 1
+                    log, size = open(self.__segment_path(segment), 'wb'), 0
+                log.write(record)
+                index.apply(OP_PUT if payload else OP_ADD, table, txid, segment, size, len(record))
+                size += len(record)
+                payload = b''
+        if log is None:
+            log = open(self.__segment_path(segment), 'wb')
+        self.__close_segment(log)
+        index.save((segment, size))
+        index.close()
+
+        # the new index takes over in one rename, the old segments are garbage after it
+        self.index.close()
+        self.log.close()
+        os.replace(tmp_path, os.path.join(self.path, 'index.dat'))
+        self.index = TxIndex(os.path.join(self.path, 'index.dat'))
+        self.maps = {}
+        for number in self.__segments():
+            if number < first_segment:
+                os.remove(self.__segment_path(number))
+        self.__recover()
+
+    def close(self):
+        self.sync()
+        self.log.close()
+        self.index.close()
+
+    def __append(self, op, table, txid, payload=b''):
+        """
+        a private method that writes a record to the end of the log and applies it to the index
+        """
+        record = self.__record(op, table, txid, payload)
+        offset = self.log.tell()
+        if offset > 0 and offset + len(record) > self.segment_size:
+            self.sync()
+            self.log.close()
+            self.segment += 1
+            self.log = open(self.__segment_path(self.segment), 'ab')
+            offset = 0
+
+        self.log.write(record)
+        self.log.flush()
+        self.log_bytes += len(record)
+        self.index.apply(op, table, txid, self.segment, offset, len(record))
+
+    @staticmethod
+    def __record(op, table, txid, payload):
+        """
+        a private method that builds a record of the log
+        """
+        crc = crc32(payload, crc32(RECORD.pack(len(payload), 0, op, table, txid)))
+        return RECORD.pack(len(payload), crc, op, table, txid) + bytes(payload)
+
+    def __recover(self):
+        """
+        a private method that replays the records written after the checkpoint of the index. A record cut short by a
+        crash, and anything after it, is removed from the log.
+        """
+        for number in self.__segments():
+            if number < self.index.first_segment:
+                os.remove(self.__segment_path(number))  # left over by a compaction that did not finish
+
+        segments = [number for number in self.__segments() if number >= self.index.checkpoint[0]]
+        self.log_bytes = sum(os.path.getsize(self.__segment_path(number)) for number in self.__segments())
+        for i, number in enumerate(segments):
+            offset = self.index.checkpoint[1] if number == self.index.checkpoint[0] else 0
+            with open(self.__segment_path(number), 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+
+            # apply every complete record, stop at the first one that is cut short or corrupted
+            pos = 0
+            while pos + RECORD.size <= len(data):
+                length, crc, op, table, txid = RECORD.unpack_from(data, pos)
+                end = pos + RECORD.size + length
+                if end > len(data) or crc != self.__crc(data, pos, length, op, table, txid):
+                    break
+                self.index.apply(op, table, txid, number, offset + pos, end - pos)
+                pos = end
+
+            if pos < len(data):
+                self.log_bytes -= len(data) - pos
+                with open(self.__segment_path(number), 'r+b') as f:
+                    f.truncate(offset + pos)
+                for later in segments[i + 1:]:
+                    self.log_bytes -= os.path.getsize(self.__segment_path(later))
+                    os.remove(self.__segment_path(later))
+                break
+
+        existing = self.__segments()
+        self.segment = existing[-1] if existing else self.index.first_segment
+        self.log = open(self.__segment_path(self.segment), 'ab')
+        self.sync()
+
+    @staticmethod
+    def __crc(data, pos, length, op, table, txid):
+        """
+        a private method that computes the crc of a record read from the log
+        """
+        payload = memoryview(data)[pos + RECORD.size:pos + RECORD.size + length]
+        return crc32(payload, crc32(RECORD.pack(length, 0, op, table, txid)))
+
+    def __map(self, segment, end):
+        """
+        a private method that memory maps a segment, again if it grew past the old map
+        :param segment: segment number
+        :param end: the map must reach this offset
+        """
+        segment_map = self.maps.get(segment)
+        if segment_map is None or len(segment_map) < end:
+            # an old map is not closed, memoryviews of transactions read from it stay valid
+            with open(self.__segment_path(segment), 'rb') as f:
+                segment_map = mmap(f.fileno(), 0, access=ACCESS_READ)
+            self.maps[segment] = segment_map
+        return segment_map
+
+    def __segments(self):
+        """
+        a private method that lists the segment numbers, in order
+        """
+        return sorted(int(name[:-4]) for name in os.listdir(self.path) if name.endswith('.seg'))
+
+    def __segment_path(self, segment):
+        return os.path.join(self.path, '%08d.seg' % segment)
+
+    @staticmethod
+    def __close_segment(log):
+        log.flush()
+        os.fsync(log.fileno())
+        log.close()
+
+
+"---------------------------------------------------------------------------------------------------------------------"
+
+
+class StoreTable:
+    """
+    One table of a TxStore, with the dict methods TxDB uses on its tables
+    """
+
+    def __init__(self, store, table):
+        """
+        :param store: a TxStore
+        :param table: one of the four tables
+        """
+        self.store = store
+        self.table = table
+
+    def __contains__(self, txid):
+        return bool(self.store.tables(txid) & 1 << self.table)
+
+    def __getitem__(self, txid):
+        if txid not in self:
+            raise KeyError(txid)
+        return self.store.get(txid)
+
+    def __setitem__(self, txid, tx):
+        self.store.add(tx, self.table)
+
+    def __delitem__(self, txid):
+        self.store.drop(txid, self.table)
+
+    def __iter__(self):
+        return self.store.txids(self.table)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def get(self, txid, default=None):
+        return self[txid] if txid in self else default
+
+    def pop(self, txid, *default):
+        if txid not in self:
+            if default:
+                return default[0]
+            raise KeyError(txid)
+        tx = self.store.get(txid)
+        self.store.drop(txid, self.table)
+        return tx
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [self.store.get(txid) for txid in self]
+
+    def items(self):
+        return [(txid, self.store.get(txid)) for txid in self]
+
+
+# test cases
+def test():
+    from tempfile import mkdtemp
+    from Transaction import Tx, TxDB
+
+    path = mkdtemp()
+    store = TxStore(path, segment_size=4096)
+    txs = [Tx('connect', '%0128x' % i, '%0128x' % (i + 1), 'message ' + str(i)) for i in range(200)]
+    for tx in txs:
+        store.add(tx, TABLE_IN_UC)
+    for tx in txs[:150]:
+        store.add(tx, TABLE_IN_CO)
+        store.drop(tx.txid, TABLE_IN_UC)
+    for tx in txs[:100]:
+        store.drop(tx.txid, TABLE_IN_CO)
+    print(len(store), store.get(txs[120].txid) == txs[120], bytes(store.get_bytes(txs[199].txid)) == txs[199].to_bytes)
+    store.close()
+
+    # reopen, only the index is mapped
+    store = TxStore(path, segment_size=4096)
+    print(len(store), sorted(store.txids(TABLE_IN_UC)) == sorted(tx.txid for tx in txs[150:]))
+    print(store.get(txs[50].txid), store.get(txs[180].txid) == txs[180])
+
+    # a transaction database on top of the store
+    db = TxDB(store)
+    db.confirm_all([tx.txid for tx in txs[150:160]])
+    print(len(db.in_uc), len(db.in_co), db.find_by_sender(txs[155].sender) == [txs[155]])
+    store.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+from time import perf_counter
+
+from ecdsa import BadSignatureError, MalformedPointError
+
+from KeyUtils import key_registry
+
+
+def verify_signature(sender, signature, payload):
+    """
+    Verify the signature of a transaction. The key of the sender comes from the key registry of the process, so the
+    keys of frequent senders are parsed once and precomputed.
+    :param sender: the public ecc key of the sender in hex
+    :param signature: the signature in hex
+    :param payload: the signed bytes
+    :return: true if the signature is valid, false if it is not or if the key or the signature are malformed
+    """
+    try:
+        return key_registry.ecc_key(sender).verify(bytes.fromhex(signature), payload)
+    except (BadSignatureError, MalformedPointError, ValueError):
+        return False
+
+
+def verify_signatures(items):
+    """
+    Verify a list of signatures, the work a worker process gets at once
+    :param items: a list of (sender, signature, payload)
+    :return: a list of booleans
+    """
+    return [verify_signature(*item) for item in items]
+
+
+class TxValidator:
+    """
+    Signature verification of transactions, in bulk on a pool of processes. The valid (txid, sender) pairs are kept in
+    a bounded cache, so a transaction checked when it entered the mempool is not checked again when its block arrives.
+    Since the txid covers the signature, a cached pair can only stand for that very signature.
+    """
+
+    def __init__(self, workers=None, cache_size=100000, batch_min=64, chunk_size=128):
+        """
+        Initialize a validator
+        :param workers: number of processes, 1 to verify in this process, the number of cores by default
+        :param cache_size: number of valid (txid, sender) pairs to remember
+        :param batch_min: smaller batches are verified in this process, the pool costs more than it saves for them
+        :param chunk_size: number of signatures sent to a worker at once
+        """
+        self.workers = workers or cpu_count() or 1
+        self.cache_size = cache_size
+        self.batch_min = batch_min
+        self.chunk_size = chunk_size
+        self.executor = None
+        self.cache = OrderedDict()  # (txid, sender) -> None, the least recently used first
+
+        # counters
+        self.verified = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        """
+        :return: signatures verified per second, over the time spent verifying
+        """
+        return self.verified / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def stats(self):
+        """
+        :return: a dict of the counters
+        """
+        return {'verified': self.verified,
+                'failures': self.failures,
+                'cache_hits': self.cache_hits,
+                'cache_size': len(self.cache),
+                'throughput': self.throughput}
+
+    def verify(self, tx):
+        """
+        verify the signature of a transaction
+        :param tx: a transaction object
+        :return: true if it is signed by its sender
+        """
+        return self.verify_all([tx])[0]
+
+    def verify_all(self, txs):
+        """
+        verify the signatures of transactions, like the ones of a block
+        :param txs: a list of transaction objects
+        :return: a list of booleans, in the order of the transactions
+        """
+        results = [False] * len(txs)
+        pending = {}  # (txid, sender) -> positions of the transactions
+        for i, tx in enumerate(txs):
+            if tx.signature is None:
+                continue
+            key = (tx.txid, tx.sender)
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                results[i] = True
+            else:
+                pending.setdefault(key, []).append(i)
+        if not pending:
+            return results
+
+        started = perf_counter()
+        items = [(sender, txs[positions[0]].signature, txs[positions[0]].signing_payload)
+                 for (_, sender), positions in pending.items()]
+        if self.workers == 1 or len(items) < self.batch_min:
+            valid = verify_signatures(items)
+        else:
+            valid = self.__verify_parallel(items)
+        self.elapsed += perf_counter() - started
+        self.verified += len(items)
+
+        for (key, positions), ok in zip(pending.items(), valid):
+            if not ok:
+                self.failures += 1
+                continue
+            self.cache[key] = None
+            for i in positions:
+                results[i] = True
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return results
+
+    def forget(self, txid, sender):
+        """
+        drop a pair from the cache
+        :param txid: the id of a transaction
+        :param sender: the public key of its sender in hex
+        """
+        self.cache.pop((txid, sender), None)
+
+    def close(self):
+        """
+        Stop the worker processes
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __verify_parallel(self, items):
+        """
+        a private method that splits the signatures in chunks for the pool
+        """
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+        chunks = [items[i:i + self.chunk_size] for i in range(0, len(items), self.chunk_size)]
+        return [ok for chunk in self.executor.map(verify_signatures, chunks) for ok in chunk]
+
+
+# test cases
+def test():
+    from KeyUtils import generate_private_key_ecc, generate_public_key_ecc
+    from Transaction import Tx
+
+    keys = [generate_private_key_ecc() for _ in range(4)]
+    txs = []
+    for i in range(200):
+        key = keys[i % len(keys)]
+        tx = Tx('connect', generate_public_key_ecc(key).to_string().hex(), '00' * 64, 'data %d' % i, 1546300800.0 + i)
+        tx.sign(key)
+        txs.append(tx)
+
+    # a forged transaction, and an unsigned one
+    txs[7].content = 'forged'
+    txs[8].signature = None
+
+    validator = TxValidator(workers=2, chunk_size=32)
+    results = validator.verify_all(txs)
+    print(results.count(True), results[7], results[8])
+    print('%.0f signatures per second' % validator.throughput)
+
+    # the second time, the valid transactions come from the cache
+    print(validator.verify_all(txs) == results, validator.stats)
+    validator.close()
+
+
+if __name__ == '__main__':
+    test()